@@ -1,7 +1,21 @@
-import pymysql.cursors
-from flask import Flask
+import logging
+
+from flask import Flask, g, request
+from werkzeug.local import LocalProxy
 
 from config import *
+from dialects import DIALECTS, dialect_of
+from pool import ConnectionPool, process_pool
+from cache import EntityCache
+from cookable import CookableIndex
+from entities import Food, Menu, Recipe
+from fridge import FridgeIndex
+from menu_calendar import CalendarIndex
+from search import NameIndex
+import instrument
+from instrument import RequestTrace, TracedConnection, current_trace, finish_trace, slow_query_log
+from metrics import RequestMetrics
+from versions import TableVersions, TABLES, table_versions, publish_changes, discard_changes, listeners
 from utils import CustomJSONEncoder, DateConverter
 
 # Initialize the app object
@@ -22,24 +36,207 @@ else:
 app.json_encoder = CustomJSONEncoder
 # Add a date url parameter type
 app.url_map.converters['date'] = DateConverter
+# Per-table change counters shared by all workers, used for ETags
+app.extensions['table_versions'] = TableVersions(app.config['TABLE_VERSIONS_FILE'])
+# Read-through cache of records looked up by key
+if app.config['ENTITY_CACHE_SIZE'] > 0:
+    app.extensions['entity_cache'] = EntityCache(max_size=app.config['ENTITY_CACHE_SIZE'],
+                                                 ttl=app.config['ENTITY_CACHE_TTL'])
+# The food in the fridge, kept up to date by the writes published through this worker
+if app.config['FRIDGE_INDEX']:
+    app.extensions['fridge_index'] = FridgeIndex(Food, interval=app.config['FRIDGE_RECONCILE_SECONDS'])
+    listeners.append(app.extensions['fridge_index'].published)
+# The number of ingredients each recipe lacks, for /recipe/cookable/
+if app.config['COOKABLE_INDEX']:
+    app.extensions['cookable_index'] = CookableIndex(interval=app.config['FRIDGE_RECONCILE_SECONDS'])
+    listeners.append(app.extensions['cookable_index'].published)
+# The menus by date, for the date and date range lookups of /menu/
+if app.config['CALENDAR_INDEX']:
+    app.extensions['calendar_index'] = CalendarIndex(Menu, interval=app.config['FRIDGE_RECONCILE_SECONDS'])
+    listeners.append(app.extensions['calendar_index'].published)
+# The food and recipe names, searched by /search/
+if app.config['SEARCH_INDEX']:
+    app.extensions['search_indexes'] = {
+        Food.__table__: NameIndex(Food, "food_name", interval=app.config['SEARCH_RECONCILE_SECONDS']),
+        Recipe.__table__: NameIndex(Recipe, "rec_name", interval=app.config['SEARCH_RECONCILE_SECONDS'])
+    }
+    listeners.extend(index.published for index in app.extensions['search_indexes'].values())
+# Structured log of the statements slower than SLOW_QUERY_MS, to stderr unless SLOW_QUERY_LOG is set
+if app.config['SQL_INSTRUMENTATION'] and not slow_query_log.handlers:
+    slow_query_log.addHandler(logging.FileHandler(app.config['SLOW_QUERY_LOG']) if app.config['SLOW_QUERY_LOG']
+                              else logging.StreamHandler())
+    slow_query_log.setLevel(logging.WARNING)
+# Request metrics of every worker, summed up at /metrics
+if app.config['SQL_INSTRUMENTATION'] and app.config['METRICS']:
+    app.extensions['request_metrics'] = RequestMetrics(app.config['METRICS_DIR'])
+
+
+def connect():
+    """
+    Opens a brand new connection to the database. Only the
+    connection pool should call this; requests borrow
+    connections through `get_pool`
+    :return:
+    """
+    return DIALECTS[app.config['DB_BACKEND']].connect(app.config)
+
+
+def get_pool():
+    """
+    The connection pool for this process. Built on first use so that
+    every gunicorn worker gets its own pool after it has been forked
+    :return:
+    """
+    return process_pool(lambda: ConnectionPool(connect,
+                                               size=app.config['MYSQL_POOL_SIZE'],
+                                               max_overflow=app.config['MYSQL_POOL_MAX_OVERFLOW'],
+                                               recycle=app.config['MYSQL_POOL_RECYCLE'],
+                                               pre_ping=app.config['MYSQL_POOL_PRE_PING'],
+                                               timeout=app.config['MYSQL_POOL_TIMEOUT']))
 
 
-# Connect to the database
+# Requests borrow a database connection from the pool the first
+# time they touch g.db, so requests that never need the database
+# (e.g. conditional GETs answered with a 304) never check one out
 @app.before_request
 def check_db_connection():
-    g.db = pymysql.connect(host=app.config['MYSQL_DB_HOST'],
-                           user=app.config['MYSQL_USER_NAME'],
-                           password=app.config['MYSQL_PASSWORD'],
-                           db=app.config['MYSQL_DB_NAME'],
-                           charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
+    g.autocommit = app.config['MYSQL_AUTOCOMMIT']
+    g.db = LocalProxy(get_db)
+    if app.config['SQL_INSTRUMENTATION']:
+        g.sql_trace = RequestTrace(cap=app.config['SQL_QUERY_CAP'])
+
+
+def get_db():
+    """
+    The connection of the current request, borrowed from the pool on first
+    use. Borrowing it opens the transaction the whole request runs in: reads
+    get a consistent snapshot, writes are held until the request finishes.
+    With SQL_INSTRUMENTATION on, the connection records every statement in
+    the request's trace
+    :return:
+    """
+    db = getattr(g, '_db', None)
+    if db is None:
+        db = get_pool().connect()
+        trace = current_trace()
+        if trace is not None:
+            db = TracedConnection(db, trace)
+        g._db = db
+        if not g.autocommit:
+            # Anything read in the transaction is at least as new as these
+            g.snapshot_versions = dict(zip(TABLES, table_versions().get(*TABLES)))
+            begin_transaction(db, read_only=request.method in ("GET", "HEAD", "OPTIONS"))
+    return db
+
+
+def begin_transaction(db, read_only=False):
+    """
+    Starts the request's transaction
+    :param db: The request's connection
+    :param read_only: Whether to start a read only snapshot
+    :return:
+    """
+    dialect_of(db).begin(db, read_only)
+
+
+# Registered before end_transaction so it runs after it, and the commit is timed
+@app.after_request
+def add_server_timing(response):
+    """
+    Tells the client how many statements the request ran and how long they
+    and the JSON encoding took. For streamed responses the header only covers
+    what happened before the body started, while the request's trace goes on
+    to count the bytes of the body as they are sent
+    :param response:
+    :return:
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.status = response.status_code
+        response.headers['Server-Timing'] = trace.server_timing()
+        trace.size = response.calculate_content_length()
+        if trace.size is None and response.is_streamed:
+            trace.size = 0
+            response.response = counted(response.response, trace)
+    return response
+
+
+def counted(body, trace):
+    """
+    Passes the chunks of a streamed body through, adding up their size in the trace
+    :param body: The iterable body of a response
+    :param trace: The request's RequestTrace
+    :return:
+    """
+    try:
+        for chunk in body:
+            trace.size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+@app.after_request
+def end_transaction(response):
+    """
+    Commits the request's writes if the request succeeded, and
+    throws them away if it returned an error
+    :param response:
+    :return:
+    """
+    db = getattr(g, '_db', None)
+    if db is not None:
+        if response.status_code < 400:
+            db.commit()
+            publish_changes()
+        else:
+            db.rollback()
+            discard_changes()
+    return response
 
 
 @app.teardown_request
 def teardown_request(exception):
-    db = getattr(g, 'db', None)
+    # The pool rolls back anything still pending when the connection
+    # is returned, which covers requests that died with an exception
+    db = getattr(g, '_db', None)
     if db is not None:
-        db.close()
+        g._db = None
+        get_pool().release(getattr(db, 'raw', db))
+    trace = current_trace()
+    if trace is not None:
+        trace.endpoint = request.url_rule.rule if request.url_rule else None
+        trace.view = request.endpoint
+        trace.exception = exception is not None
+        finish_trace(trace)
+
+
+def record_metrics(trace):
+    """
+    Adds a finished request to the metrics, along with the
+    current state of this worker's connection pool and entity cache
+    :param trace: The request's RequestTrace
+    :return:
+    """
+    metrics = app.extensions.get('request_metrics', None)
+    if metrics is None:
+        return
+    metrics.observe(trace.view, trace.status, trace.duration, size=trace.size, db_seconds=trace.db_time,
+                    db_statements=trace.count, serialize_seconds=trace.serialize_time, exception=trace.exception)
+    pool = get_pool()
+    values = dict(pool_size=pool.size, pool_checked_out=pool.checked_out, pool_overflow=pool.overflow)
+    cache = app.extensions.get('entity_cache', None)
+    if cache is not None:
+        stats = cache.stats()
+        values.update(entity_cache_entries=stats['size'], entity_cache_max_entries=stats['max_size'],
+                      entity_cache_hits=stats['hits'], entity_cache_misses=stats['misses'],
+                      entity_cache_evictions=stats['evictions'],
+                      entity_cache_invalidations=stats['invalidations'])
+    metrics.set_process(**values)
+
+
+instrument.listeners.append(record_metrics)
 
 
 # Views (routes) imported here and not at the top
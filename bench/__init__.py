@@ -0,0 +1,11 @@
+"""
+Benchmarks for the API. `bench.generate` fills a database with a seeded
+synthetic dataset, `bench.run` drives every route through the Flask test
+client and writes a JSON report, and `bench.compare` compares two reports,
+e.g. from two commits. By default everything runs on a throwaway SQLite
+database, so no MySQL server or network is needed:
+
+    python -m bench.run --scale 10k --out bench/results/before.json
+    python -m bench.run --scale 10k --out bench/results/after.json
+    python -m bench.compare bench/results/before.json bench/results/after.json
+"""
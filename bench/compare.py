@@ -0,0 +1,72 @@
+"""
+Compares two reports written by bench.run, route by route.
+
+Usage: python -m bench.compare BASELINE.json CANDIDATE.json [--fail-over PERCENT]
+"""
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    """
+    The relative change from `before` to `after` in percent, or None if it can not be computed
+    """
+    if before is None or after is None or not before:
+        return None
+    return (after - before) * 100.0 / before
+
+
+def compare(baseline, candidate):
+    """
+    Pairs up the routes measured in both reports
+    :param baseline: A report loaded from JSON
+    :param candidate: A report loaded from JSON
+    :return: A list of (route, baseline stats, candidate stats, p50 change, throughput change)
+    """
+    ret = []
+    for route, after in candidate["routes"].items():
+        before = baseline["routes"].get(route, None)
+        if before is None:
+            continue
+        ret.append((route, before, after, change(before["p50_ms"], after["p50_ms"]),
+                    change(before["throughput"], after["throughput"])))
+    return ret
+
+
+def fmt(value, suffix=""):
+    return "-" if value is None else "{:+.1f}{}".format(value, suffix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--fail-over", type=float, default=None, metavar="PERCENT",
+                        help="Exit with an error if any route's p50 latency grew by more than this")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for key in ("backend", "sizes", "seed", "entity_cache", "concurrency", "gevent"):
+        if baseline["meta"].get(key) != candidate["meta"].get(key):
+            print("Warning: the reports differ in {}: {} vs {}".format(
+                key, baseline["meta"].get(key), candidate["meta"].get(key)))
+
+    print("{:<62} {:>10} {:>10} {:>8} {:>8} {:>13}".format(
+        "route ({} -> {})".format(baseline["meta"]["label"], candidate["meta"]["label"]),
+        "p50 ms", "p50 ms", "p50", "req/s", "queries"))
+    regressions = []
+    for route, before, after, p50, throughput in compare(baseline, candidate):
+        print("{:<62} {:>10} {:>10} {:>8} {:>8} {:>13}".format(
+            route, before["p50_ms"], after["p50_ms"], fmt(p50, "%"), fmt(throughput, "%"),
+            "{} -> {}".format(before["queries"], after["queries"])))
+        if args.fail_over is not None and p50 is not None and p50 > args.fail_over:
+            regressions.append(route)
+
+    if regressions:
+        print("{} route(s) got slower by more than {}%".format(len(regressions), args.fail_over))
+        sys.exit(1)
@@ -0,0 +1,201 @@
+"""
+Fills the database with a seeded synthetic dataset. The same scale and seed
+always produce the same rows, with the same ids, so results measured on two
+commits can be compared.
+
+Usage: python -m bench.generate [--scale 10k] [--seed 545] [--size table=rows ...]
+"""
+import argparse
+import random
+from collections import OrderedDict
+from datetime import date, timedelta
+from itertools import islice
+
+from dialects import dialect_of
+from entities import BULK_CHUNK_SIZE
+
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000, "1m": 1000000}
+
+# Per-owner averages used to size the association tables
+INGREDIENTS_PER_RECIPE = 6
+RECIPES_PER_MENU = 3
+
+FIRST_MENU_DATE = date(2016, 1, 1)
+TIMES_OF_DAY = ('breakfast', 'lunch', 'dinner')
+FOOD_GROUPS = ('grain', 'meat', 'veggies')
+CATEGORIES = ('entree', 'appetizer', 'dessert')
+ADJECTIVES = ('fresh', 'smoked', 'roasted', 'spicy', 'sweet', 'sour', 'pickled', 'grilled', 'raw', 'dried',
+              'baked', 'steamed', 'crispy', 'creamy', 'salted', 'wild', 'green', 'red', 'golden', 'aged')
+NOUNS = ('apple', 'salmon', 'rice', 'bean', 'pepper', 'cheese', 'tomato', 'onion', 'garlic', 'chicken',
+         'pork', 'tofu', 'lentil', 'carrot', 'potato', 'noodle', 'mushroom', 'egg', 'corn', 'spinach',
+         'lemon', 'bread', 'beef', 'shrimp', 'basil', 'yogurt', 'oat', 'pear', 'squash', 'walnut')
+DISHES = ('stew', 'salad', 'soup', 'pie', 'curry', 'bowl', 'roast', 'tart', 'casserole', 'stir fry')
+
+# The order tables are filled in, so every foreign key points at existing rows
+TABLES = ("nutritional_fact", "food", "recipes", "ingredients", "menu", "serves")
+
+COLUMNS = {
+    "nutritional_fact": ("nfact_id", "sodium", "fat", "calories", "sugar", "protein", "food_group", "amount"),
+    "food": ("food_id", "in_fridge", "food_name", "fk_nfact_id"),
+    "recipes": ("rec_id", "rec_name", "instructions", "category"),
+    "ingredients": ("recipe_id", "food_id"),
+    "menu": ("id", "time_of_day", "date"),
+    "serves": ("menu_id", "recipe_id"),
+}
+
+
+def parse_scale(scale):
+    """
+    Reads a scale such as "10k", "1m" or "2500"
+    :param scale:
+    :return: The number of foods
+    """
+    scale = str(scale).lower()
+    if scale in SCALES:
+        return SCALES[scale]
+    if scale.endswith("k"):
+        return int(float(scale[:-1]) * 1000)
+    if scale.endswith("m"):
+        return int(float(scale[:-1]) * 1000000)
+    return int(scale)
+
+
+def sizes(scale, overrides=None):
+    """
+    The number of rows to generate in each table. Every food has a nutritional
+    fact, there is a recipe for every four foods and a menu for every ten
+    :param scale: The number of foods, see `parse_scale`
+    :param overrides: A dict of table name to number of rows, replacing the derived sizes
+    :return: An OrderedDict of table name to number of rows, in the order they are filled
+    """
+    food = parse_scale(scale)
+    recipes = max(food // 4, 1)
+    menus = max(food // 10, len(TIMES_OF_DAY))
+    ret = OrderedDict([
+        ("nutritional_fact", food),
+        ("food", food),
+        ("recipes", recipes),
+        ("ingredients", recipes * INGREDIENTS_PER_RECIPE),
+        ("menu", menus),
+        ("serves", menus * RECIPES_PER_MENU),
+    ])
+    for table, count in (overrides or {}).items():
+        if table not in ret:
+            raise ValueError("Unknown table {}".format(table))
+        ret[table] = int(count)
+    return ret
+
+
+def rows(table, counts, rng):
+    """
+    Generates the rows of one table
+    :param table: The table name
+    :param counts: The sizes of every table, as returned by `sizes`
+    :param rng: A random.Random
+    :return: A generator of tuples ordered like COLUMNS[table]
+    """
+    if table == "nutritional_fact":
+        for i in range(1, counts[table] + 1):
+            yield (i, round(rng.uniform(0, 2000), 2), round(rng.uniform(0, 80), 2), round(rng.uniform(0, 900), 2),
+                   round(rng.uniform(0, 60), 2), round(rng.uniform(0, 90), 2), rng.choice(FOOD_GROUPS),
+                   round(rng.uniform(1, 500), 2))
+    elif table == "food":
+        for i in range(1, counts[table] + 1):
+            yield (i, int(rng.random() < 0.3), "{} {}".format(rng.choice(ADJECTIVES), rng.choice(NOUNS)),
+                   i if i <= counts["nutritional_fact"] else None)
+    elif table == "recipes":
+        for i in range(1, counts[table] + 1):
+            name = "{} {} {}".format(rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(DISHES))
+            yield (i, name, "Combine everything and cook the {} until done.".format(name), rng.choice(CATEGORIES))
+    elif table in ("ingredients", "serves"):
+        owner, related = ("recipes", "food") if table == "ingredients" else ("menu", "recipes")
+        owners, available = counts[owner], counts[related]
+        if not owners or not available:
+            return
+        # Spread the rows evenly over the owners, each linking distinct related rows
+        per_owner, extra = divmod(counts[table], owners)
+        for i in range(1, owners + 1):
+            k = min(per_owner + (1 if i <= extra else 0), available)
+            picked = set()
+            while len(picked) < k:
+                picked.add(rng.randint(1, available))
+            for related_id in sorted(picked):
+                yield (i, related_id)
+    elif table == "menu":
+        for i in range(counts[table]):
+            day = FIRST_MENU_DATE + timedelta(days=i // len(TIMES_OF_DAY))
+            yield (i + 1, TIMES_OF_DAY[i % len(TIMES_OF_DAY)], day)
+
+
+def clear(db):
+    """
+    Empties every table
+    :param db: A connection
+    :return:
+    """
+    cursor = db.cursor()
+    for table in reversed(TABLES):
+        # TRUNCATE skips the delete triggers; SQLite has no TRUNCATE,
+        # but the tables are emptied children first so the triggers find nothing
+        if dialect_of(db).name == "mysql":
+            cursor.execute("TRUNCATE TABLE {}".format(table))
+        else:
+            cursor.execute("DELETE FROM {}".format(table))
+    db.commit()
+    cursor.close()
+
+
+def generate(db, counts, seed=545, verbose=False):
+    """
+    Replaces the contents of every table with a synthetic dataset
+    :param db: A connection
+    :param counts: The number of rows per table, as returned by `sizes`
+    :param seed: The random seed
+    :param verbose: Print progress
+    :return:
+    """
+    dialect = dialect_of(db)
+    clear(db)
+    for table in TABLES:
+        # One generator per table, so changing the size of one
+        # table does not change the rows generated for the others
+        rng = random.Random("{}:{}".format(seed, table))
+        columns = COLUMNS[table]
+        batch = dialect.batch_size(len(columns), BULK_CHUNK_SIZE)
+        generated = rows(table, counts, rng)
+        written = 0
+        cursor = db.cursor()
+        dialect.begin(db)
+        while True:
+            chunk = list(islice(generated, batch))
+            if not chunk:
+                break
+            cursor.execute("INSERT INTO {table} ({columns}) VALUES {rows}".format(
+                table=table,
+                columns=", ".join(columns),
+                rows=", ".join(["({})".format(", ".join(["%s"] * len(columns)))] * len(chunk))),
+                tuple(value.strftime('%Y-%m-%d') if isinstance(value, date) else value
+                      for row in chunk for value in row))
+            written += len(chunk)
+        db.commit()
+        cursor.close()
+        if verbose:
+            print("{:<18} {:>9} rows".format(table, written))
+
+
+if __name__ == "__main__":
+    import migrate
+
+    parser = argparse.ArgumentParser(description="Fill the configured database with synthetic data")
+    parser.add_argument("--scale", default="10k", help="Number of foods: 1k, 10k, 100k, 1m or any number")
+    parser.add_argument("--seed", type=int, default=545)
+    parser.add_argument("--size", action="append", default=[], metavar="TABLE=ROWS",
+                        help="Override the number of rows of one table")
+    args = parser.parse_args()
+
+    db = migrate.connect()
+    try:
+        migrate.migrate(db)
+        generate(db, sizes(args.scale, dict(s.split("=", 1) for s in args.size)), args.seed, verbose=True)
+    finally:
+        db.close()
@@ -0,0 +1,59 @@
+"""
+Measures the memory a result set takes as the dicts the DictCursor returns
+and as the Records read with COMPACT_ROWS (see records.py). No database is
+needed: the rows are built from bench.generate. Sizes count each row object
+and the values it holds, so they are what one more row of each table costs.
+
+Usage: python -m bench.memory [--records 100000]
+"""
+import argparse
+import random
+import sys
+
+from bench import generate
+
+
+def deep_size(row, seen):
+    """
+    :param row: A dict or a Record
+    :param seen: The ids of the values already counted, shared between rows
+    :return: The bytes taken by the row and the values not counted yet
+    """
+    size = sys.getsizeof(row)
+    for value in row.values():
+        if id(value) not in seen:
+            seen.add(id(value))
+            size += sys.getsizeof(value)
+    return size
+
+
+def measure(rows):
+    """
+    :param rows: A list of dicts or Records
+    :return: The total size in bytes, and the size of the row objects alone
+    """
+    seen = set()
+    return sum(deep_size(row, seen) for row in rows), sum(sys.getsizeof(row) for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the memory taken by dict rows and Records")
+    parser.add_argument("--records", type=int, default=100000, help="Rows of each table")
+    parser.add_argument("--seed", type=int, default=545)
+    args = parser.parse_args()
+
+    import entities
+    from records import record_class, register
+
+    register(entities.Food, entities.NutritionalFact, entities.Recipe, entities.Menu)
+    counts = generate.sizes(args.records)
+
+    print("{:<18} {:<8} {:>14} {:>14} {:>12}".format("table", "rows as", "total bytes", "row bytes", "bytes/row"))
+    for table in ("nutritional_fact", "food", "recipes", "menu"):
+        columns = generate.COLUMNS[table]
+        values = list(generate.rows(table, counts, random.Random("{}:{}".format(args.seed, table))))
+        cls = record_class(table, columns)
+        for kind, rows in (("dict", [dict(zip(columns, row)) for row in values]),
+                           ("Record", [cls(*row) for row in values])):
+            total, own = measure(rows)
+            print("{:<18} {:<8} {:>14} {:>14} {:>12}".format(table, kind, total, own, own // len(rows)))
@@ -0,0 +1,443 @@
+"""
+Drives every route in views.py through the Flask test client and reports the
+throughput, latency percentiles, statements run and peak memory of each one
+as JSON, to be compared across commits with `python -m bench.compare`.
+
+By default the app runs on a fresh copy of a SQLite database filled by
+bench.generate, so the numbers do not depend on a network or on what an
+earlier run wrote. With `--backend mysql` the database in config.Config is
+filled instead, replacing its contents.
+
+With `--concurrency N` every route is driven by N threads at once, or by N
+greenlets with `--gevent`, which serves the app the way gunicorn's gevent
+worker does. SQLite calls block the whole process, so compare the two on
+`--backend mysql`.
+
+Usage: python -m bench.run [--scale 10k] [--iterations 100] [--concurrency 1] [--gevent]
+                           [--out FILE] [--route TEXT]
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no allocation tracing; peak memory is then left out
+    tracemalloc = None
+
+from bench import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+PAGE = 50
+
+# The trace of the last request made by each thread, see instrument.listeners
+_last = threading.local()
+
+
+class Case(object):
+    """
+    One kind of request to measure
+    """
+
+    def __init__(self, method, path, body=None, label=None, heavy=False):
+        """
+        :param method: The HTTP method
+        :param path: A callable taking a Context and returning the path of one request
+        :param body: A callable taking a Context and returning the JSON body of one request
+        :param label: The name of the case in the report. Defaults to the method and route
+        :param heavy: Whether every request reads a whole table, so it is run fewer times
+        """
+        self.method = method
+        self.path = path
+        self.body = body
+        self.label = label
+        self.heavy = heavy
+
+
+class Context(object):
+    """
+    Picks the ids, names and dates requests are made with
+    """
+
+    def __init__(self, counts, seed):
+        self.counts = counts
+        self.rng = random.Random(seed)
+        self._taken = dict()
+        self._lock = threading.Lock()
+
+    def any_id(self, table):
+        return self.rng.randint(1, max(self.counts[table], 1))
+
+    def take(self, table):
+        # Every delete targets a different row, counting down from the last
+        with self._lock:
+            taken = self._taken.get(table, self.counts[table] + 1) - 1
+            self._taken[table] = taken
+        return max(taken, 1)
+
+    def food_name(self, quoted=False):
+        name = "{} {}".format(self.rng.choice(generate.ADJECTIVES), self.rng.choice(generate.NOUNS))
+        return quote(name) if quoted else name
+
+    def recipe_name(self, quoted=False):
+        name = "{} {} {}".format(self.rng.choice(generate.ADJECTIVES), self.rng.choice(generate.NOUNS),
+                                 self.rng.choice(generate.DISHES))
+        return quote(name) if quoted else name
+
+    def misspelled(self, name):
+        # Drops one letter, as a typo would
+        i = self.rng.randint(1, len(name) - 1)
+        return quote(name[:i] + name[i + 1:])
+
+    def any_date(self):
+        days = max(self.counts["menu"] // len(generate.TIMES_OF_DAY), 1)
+        return generate.FIRST_MENU_DATE + timedelta(days=self.rng.randint(0, days - 1))
+
+    def ids(self, table, k):
+        return sorted(set(self.any_id(table) for _ in range(k)))
+
+    def id_list(self, table, k):
+        # Unsorted, and ending with an id past the generated rows, as a client would ask for
+        return ",".join(str(self.any_id(table)) for _ in range(k - 1)) + ",{}".format(self.counts[table] + 1)
+
+
+def cases():
+    """
+    The requests made, covering every route
+    :return: A list of Cases
+    """
+    paged = "?limit={}".format(PAGE)
+    return [
+        Case("GET", lambda c: "/fridge/"),
+        Case("GET", lambda c: "/fridge/" + paged),
+        Case("GET", lambda c: "/food/all/", heavy=True),
+        Case("GET", lambda c: "/food/all/" + paged),
+        Case("GET", lambda c: "/food/{}/".format(c.any_id("food"))),
+        Case("GET", lambda c: "/food/many/?ids={}".format(c.id_list("food", PAGE)),
+             label="GET /food/many/ ({} ids)".format(PAGE)),
+        Case("GET", lambda c: "/food/{}/".format(c.food_name(quoted=True))),
+        Case("GET", lambda c: "/food/{}/{}".format(c.food_name(quoted=True), paged)),
+        Case("GET", lambda c: "/nutrition/all/", heavy=True),
+        Case("GET", lambda c: "/nutrition/all/" + paged),
+        Case("GET", lambda c: "/nutrition/{}/".format(c.any_id("nutritional_fact"))),
+        Case("GET", lambda c: "/nutrition/many/?ids={}".format(c.id_list("nutritional_fact", PAGE)),
+             label="GET /nutrition/many/ ({} ids)".format(PAGE)),
+        Case("GET", lambda c: "/recipe/all/", heavy=True),
+        Case("GET", lambda c: "/recipe/all/" + paged),
+        Case("GET", lambda c: "/recipe/cookable/"),
+        Case("GET", lambda c: "/recipe/cookable/?missing=2&limit={}".format(PAGE)),
+        Case("GET", lambda c: "/recipe/{}/".format(c.any_id("recipes"))),
+        Case("GET", lambda c: "/recipe/many/?ids={}".format(c.id_list("recipes", PAGE)),
+             label="GET /recipe/many/ ({} ids)".format(PAGE)),
+        Case("GET", lambda c: "/recipe/{}/".format(c.recipe_name(quoted=True))),
+        Case("GET", lambda c: "/menu/all/", heavy=True),
+        Case("GET", lambda c: "/menu/all/" + paged),
+        Case("GET", lambda c: "/menu/{}/".format(c.any_id("menu"))),
+        Case("GET", lambda c: "/menu/many/?ids={}".format(c.id_list("menu", PAGE)),
+             label="GET /menu/many/ ({} ids)".format(PAGE)),
+        Case("GET", lambda c: "/menu/{}/".format(c.rng.choice(generate.TIMES_OF_DAY)), heavy=True),
+        Case("GET", lambda c: "/menu/{}/{}".format(c.rng.choice(generate.TIMES_OF_DAY), paged)),
+        Case("GET", lambda c: "/menu/{}/{}/".format(c.rng.choice(generate.TIMES_OF_DAY), c.any_date())),
+        Case("GET", lambda c: "/menu/date/{}/".format(c.any_date())),
+        Case("GET", lambda c: "/menu/date/between/{}/{}/".format(*sorted([c.any_date(), c.any_date()])),
+             label="GET /menu/date/between/<date:begin>/<date:end>/ (random range)"),
+        Case("GET", lambda c: "/search/?q={}".format(quote(c.food_name()[:4])), label="GET /search/ (prefix)"),
+        Case("GET", lambda c: "/search/?q={}".format(c.misspelled(c.recipe_name())),
+             label="GET /search/ (misspelled)"),
+        Case("GET", lambda c: "/menu/date/between/{}/{}/nutrition/".format(*sorted([c.any_date(), c.any_date()])),
+             label="GET /menu/date/between/<date:begin>/<date:end>/nutrition/ (random range)"),
+        Case("GET", lambda c: "/cache/stats/"),
+        Case("GET", lambda c: "/metrics"),
+        Case("POST", lambda c: "/food/", lambda c: {"food": [
+            {"food_name": c.food_name(), "in_fridge": c.rng.random() < 0.5} for _ in range(10)]},
+             label="POST /food/ (create 10)"),
+        Case("POST", lambda c: "/food/", lambda c: {"food": [
+            {"food_id": id, "in_fridge": c.rng.random() < 0.5} for id in c.ids("food", 10)]},
+             label="POST /food/ (update 10)"),
+        Case("POST", lambda c: "/nutrition/", lambda c: {"facts": [
+            {"food_group": c.rng.choice(generate.FOOD_GROUPS), "calories": c.rng.randint(0, 900)}
+            for _ in range(10)]}, label="POST /nutrition/ (create 10)"),
+        Case("POST", lambda c: "/recipe/", lambda c: {"recipes": [
+            {"rec_name": c.recipe_name(), "category": c.rng.choice(generate.CATEGORIES),
+             "ingredients": c.ids("food", 6)} for _ in range(10)]}, label="POST /recipe/ (create 10)"),
+        Case("POST", lambda c: "/menu/", lambda c: {"menus": [
+            {"id": id, "recipes": c.ids("recipes", 3)} for id in c.ids("menu", 10)]},
+             label="POST /menu/ (update 10)"),
+        Case("DELETE", lambda c: "/food/{}/del/".format(c.take("food"))),
+        Case("DELETE", lambda c: "/nutrition/{}/del/".format(c.take("nutritional_fact"))),
+        Case("DELETE", lambda c: "/recipe/{}/del/".format(c.take("recipes"))),
+        Case("DELETE", lambda c: "/menu/{}/del/".format(c.take("menu"))),
+    ]
+
+
+def percentile(ordered, p):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not ordered:
+        return None
+    return ordered[min(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, len(ordered) - 1)]
+
+
+def request(client, case, context):
+    """
+    Makes one request and reads the whole response
+    :return: A tuple of (seconds taken, status code, the request's instrument.RequestTrace)
+    """
+    path = case.path(context)
+    kwargs = dict()
+    if case.body is not None:
+        kwargs = dict(data=json.dumps(case.body(context)), content_type='application/json')
+    _last.trace = None
+    start = timeit.default_timer()
+    response = client.open(path, method=case.method, **kwargs)
+    response.get_data()
+    elapsed = timeit.default_timer() - start
+    response.close()
+    return elapsed, response.status_code, _last.trace
+
+
+def measure(client, case, context, iterations, warmup, concurrency=1):
+    """
+    Runs a case and summarizes it
+    :param concurrency: How many threads make the requests at once, each with a client of its own
+    :return: A dict of statistics
+    """
+    for _ in range(warmup):
+        request(client, case, context)
+    made = []
+
+    def work(client, count):
+        for _ in range(count):
+            made.append(request(client, case, context))
+
+    start = timeit.default_timer()
+    if concurrency > 1:
+        threads = [threading.Thread(target=work, args=(client.application.test_client(),
+                                                       iterations // concurrency + (i < iterations % concurrency)))
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        work(client, iterations)
+    wall = timeit.default_timer() - start
+
+    latencies = []
+    queries = 0
+    db_time = 0.0
+    serialize_time = 0.0
+    statuses = dict()
+    for elapsed, status, trace in made:
+        latencies.append(elapsed)
+        queries += trace.count
+        db_time += trace.db_time
+        serialize_time += trace.serialize_time
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    peak = None
+    if tracemalloc is not None:
+        # Traced separately, since tracing slows every allocation down
+        tracemalloc.start()
+        request(client, case, context)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+
+    def ms(seconds):
+        return round(seconds * 1000, 3) if seconds is not None else None
+
+    return OrderedDict([
+        ("requests", iterations),
+        ("throughput", round(iterations / wall, 2) if wall else None),
+        ("mean_ms", ms(sum(latencies) / len(latencies)) if latencies else None),
+        ("p50_ms", ms(percentile(latencies, 50))),
+        ("p95_ms", ms(percentile(latencies, 95))),
+        ("p99_ms", ms(percentile(latencies, 99))),
+        ("queries", round(float(queries) / iterations, 2) if iterations else None),
+        ("db_ms", ms(db_time / iterations) if iterations else None),
+        ("serialize_ms", ms(serialize_time / iterations) if iterations else None),
+        ("peak_memory_kb", round(peak / 1024.0, 1) if peak is not None else None),
+        ("statuses", statuses),
+    ])
+
+
+def sqlite_database(work, counts, seed):
+    """
+    Creates a fresh SQLite database holding the dataset. The dataset is generated
+    once into a template file, keyed by everything that shapes it, and copied for each run
+    :param work: The path of the database to create
+    :param counts: The number of rows per table
+    :param seed: The random seed
+    :return:
+    """
+    digest = hashlib.sha1(json.dumps([list(counts.items()), seed]).encode('utf-8'))
+    for directory in (os.path.join(ROOT, "resources"), os.path.join(ROOT, "resources", "migrations")):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".sql") and (name.startswith("sqlite") or directory.endswith("migrations")):
+                with open(os.path.join(directory, name), "rb") as f:
+                    digest.update(f.read())
+    template = os.path.join(tempfile.gettempdir(), "mongoose-bench-{}.db".format(digest.hexdigest()[:12]))
+    if not os.path.exists(template):
+        from dialects import SQLITE
+        import migrate
+
+        building = template + ".building"
+        for path in (building, building + "-wal", building + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        db = SQLITE.connect({'SQLITE_PATH': building, 'SQLITE_BUSY_TIMEOUT': 5, 'SQLITE_CACHED_STATEMENTS': 100})
+        try:
+            migrate.migrate(db)
+            generate.generate(db, counts, seed, verbose=True)
+        finally:
+            db.close()
+        os.rename(building, template)
+
+    for path in (work, work + "-wal", work + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.copyfile(template, work)
+
+
+def git_commit():
+    """
+    The commit being measured, with a "+" appended if the tree has uncommitted changes
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if dirty.strip() else "")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every route of the API")
+    parser.add_argument("--scale", default="10k", help="Number of foods: 1k, 10k, 100k, 1m or any number")
+    parser.add_argument("--size", action="append", default=[], metavar="TABLE=ROWS",
+                        help="Override the number of rows of one table")
+    parser.add_argument("--seed", type=int, default=545)
+    parser.add_argument("--iterations", type=int, default=100, help="Requests per route")
+    parser.add_argument("--heavy-iterations", type=int, default=5,
+                        help="Requests per route for the routes returning whole tables")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests per route")
+    parser.add_argument("--backend", choices=("sqlite", "mysql"), default="sqlite")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--gevent", action="store_true",
+                        help="Make the concurrent requests from greenlets, with the standard library patched")
+    parser.add_argument("--no-entity-cache", action="store_true", help="Turn the entity cache off")
+    parser.add_argument("--route", action="append", default=[], help="Only run cases whose name contains this")
+    parser.add_argument("--label", default=None, help="Name of the run. Defaults to the git commit")
+    parser.add_argument("--out", default=None, help="Where to write the JSON report")
+    args = parser.parse_args(argv)
+
+    if args.gevent:
+        from gevent import monkey
+
+        monkey.patch_all()
+
+    counts = generate.sizes(args.scale, dict(s.split("=", 1) for s in args.size))
+
+    # The app reads its configuration when config.py is first imported
+    os.environ["MONGOOSE_SERVER_ENV"] = "TESTING"
+    os.environ["DB_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.gettempdir(), "mongoose-bench-run.db")
+    os.environ["SQL_INSTRUMENTATION"] = "true"
+    os.environ["TABLE_VERSIONS_FILE"] = os.path.join(tempfile.gettempdir(), "mongoose-bench-versions")
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="mongoose-bench-metrics-")
+    if args.no_entity_cache:
+        os.environ["ENTITY_CACHE_SIZE"] = "0"
+    if args.backend == "sqlite":
+        sqlite_database(os.environ["SQLITE_PATH"], counts, args.seed)
+    else:
+        import migrate
+
+        db = migrate.connect()
+        try:
+            migrate.migrate(db)
+            generate.generate(db, counts, args.seed, verbose=True)
+        finally:
+            db.close()
+
+    from app import app as flask_app
+    import instrument
+
+    instrument.listeners.append(lambda trace: setattr(_last, 'trace', trace))
+    client = flask_app.test_client()
+    adapter = flask_app.url_map.bind("localhost")
+    context = Context(counts, args.seed)
+
+    results = OrderedDict()
+    covered = set()
+    for case in cases():
+        path = case.path(Context(counts, args.seed))
+        endpoint = adapter.match(path.split("?")[0], method=case.method)[0]
+        rule = next(r.rule for r in flask_app.url_map.iter_rules(endpoint))
+        covered.add(endpoint)
+        label = case.label or "{} {}{}".format(case.method, rule, "?" + path.split("?")[1] if "?" in path else "")
+        if args.route and not any(text in label for text in args.route):
+            continue
+        iterations = min(args.iterations, args.heavy_iterations) if case.heavy else args.iterations
+        results[label] = measure(client, case, context, iterations, args.warmup, args.concurrency)
+        stats = results[label]
+        print("{:<62} {:>8} req/s  p50 {:>9} ms  p99 {:>9} ms  {:>6} queries".format(
+            label, stats["throughput"], stats["p50_ms"], stats["p99_ms"], stats["queries"]))
+
+    uncovered = sorted(rule.rule for rule in flask_app.url_map.iter_rules()
+                       if rule.endpoint != "static" and rule.endpoint not in covered)
+    if uncovered:
+        print("Routes without a benchmark: {}".format(", ".join(uncovered)))
+
+    commit = git_commit()
+    report = OrderedDict([
+        ("meta", OrderedDict([
+            ("label", args.label or commit or "local"),
+            ("commit", commit),
+            ("created", datetime.utcnow().isoformat() + "Z"),
+            ("python", platform.python_version()),
+            ("backend", args.backend),
+            ("scale", args.scale),
+            ("sizes", counts),
+            ("seed", args.seed),
+            ("iterations", args.iterations),
+            ("heavy_iterations", args.heavy_iterations),
+            ("entity_cache", not args.no_entity_cache),
+            ("concurrency", args.concurrency),
+            ("gevent", args.gevent),
+            ("uncovered", uncovered),
+        ])),
+        ("routes", results),
+    ])
+    out = args.out or os.path.join(RESULTS_DIR, "{}.json".format(report["meta"]["label"]))
+    if os.path.dirname(out) and not os.path.isdir(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print("Wrote {}".format(out))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
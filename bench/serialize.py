@@ -0,0 +1,71 @@
+"""
+Measures the JSON encoding of each entity's records, nested relations
+included, with the encoder `jsonify` uses and with every backend of the
+serializers module. No database is needed: the records are built from
+bench.generate, with Decimal values in the DECIMAL columns like MySQL returns.
+
+Usage: python -m bench.serialize [--records 1000] [--iterations 20]
+"""
+import argparse
+import random
+import timeit
+from decimal import Decimal
+
+from simplejson import dumps
+
+from bench import generate
+
+
+def records(count, seed=545):
+    """
+    Builds records of every entity shaped like the views send them
+    :param count: The number of records of each entity
+    :param seed: The random seed
+    :return: A dict of entity name to a list of records
+    """
+    counts = generate.sizes(count)
+    tables = dict()
+    for table in ("nutritional_fact", "food", "recipes", "menu"):
+        rng = random.Random("{}:{}".format(seed, table))
+        tables[table] = [dict(zip(generate.COLUMNS[table], row)) for row in generate.rows(table, counts, rng)]
+    for fact in tables["nutritional_fact"]:
+        for column in ("sodium", "fat", "calories", "sugar", "protein", "amount"):
+            fact[column] = Decimal(str(fact[column])).quantize(Decimal("0.01"))
+    food = [dict(f, nutrition=tables["nutritional_fact"][f["fk_nfact_id"] - 1]) for f in tables["food"]]
+    rng = random.Random(seed)
+    recipes = [dict(r, ingredients=[tables["food"][rng.randrange(len(food))] for _ in range(6)])
+               for r in tables["recipes"]]
+    menus = [dict(m, recipes=[tables["recipes"][rng.randrange(len(recipes))] for _ in range(3)])
+             for m in tables["menu"]]
+    return {"NutritionalFact": tables["nutritional_fact"], "Food": food, "Recipe": recipes, "Menu": menus}
+
+
+def timed(encode, iterations):
+    """
+    :return: The best time of `iterations` calls in milliseconds, and the size of the output
+    """
+    best = min(timeit.repeat(encode, number=1, repeat=iterations))
+    return round(best * 1000, 3), len(encode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the JSON encoders")
+    parser.add_argument("--records", type=int, default=1000, help="Records of each entity")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    import entities
+    import serializers
+    from utils import CustomJSONEncoder
+
+    print("{:<16} {:<12} {:>10} {:>10}".format("entity", "encoder", "ms", "bytes"))
+    for name, rows in sorted(records(args.records).items()):
+        entity = getattr(entities, name)
+        payload = {"records": rows}
+        # What jsonify did: sorted keys, indented, dates through CustomJSONEncoder.default
+        ms, size = timed(lambda: dumps(payload, cls=CustomJSONEncoder, indent=2, sort_keys=True), args.iterations)
+        print("{:<16} {:<12} {:>10} {:>10}".format(name, "jsonify", ms, size))
+        for backend, encode in sorted(serializers.BACKENDS.items()):
+            compiled = serializers.serializer(entity, backend)
+            ms, size = timed(lambda: encode({"records": compiled.convert_many(rows)}), args.iterations)
+            print("{:<16} {:<12} {:>10} {:>10}".format(name, backend, ms, size))
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g
+
+from records import Record
+from versions import table_versions
+
+# Returned by EntityCache.get when there is no usable entry, since
+# None (or an empty list) is a perfectly good thing to cache
+MISSING = object()
+
+
+class EntityCache(object):
+    """
+    A bounded in-process cache of records read through DbEntity. Entries are
+    evicted least recently used first once `max_size` is reached, and expire
+    `ttl` seconds after they were stored.
+
+    Every entry is tagged with the tables it was read from and their versions
+    (see versions.TableVersions) at the time of the read. An entry is only served
+    while those versions are still current, so writes made by any worker, as well
+    as the rows the schema triggers delete or update, invalidate it without the
+    workers having to talk to each other. Writes made in this process also drop
+    the affected entries right away through `invalidate`.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        :param max_size: The most entries kept at once
+        :param ttl: How many seconds an entry may be served for. 0 or less means forever
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._by_table = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        """
+        Look up an entry
+        :param key: The entry key
+        :param versions: The current versions of the tables the entry was read from
+        :return: The cached value, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            value, tables, stored_versions, expires = entry
+            if stored_versions != versions or (expires is not None and expires < time.time()):
+                self._unindex(key, tables)
+                self.misses += 1
+                return MISSING
+            # Re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value, tables, versions):
+        """
+        Store an entry, evicting the least recently used entries if the cache is full
+        :param key: The entry key
+        :param value: The value to cache. Must not be modified afterwards
+        :param tables: The names of the tables the value was read from
+        :param versions: The versions of those tables the value was read at
+        :return:
+        """
+        if self.max_size <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unindex(key, old[1])
+            self._entries[key] = (value, tables, versions, expires)
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest, entry = self._entries.popitem(last=False)
+                self._unindex(oldest, entry[1])
+                self.evictions += 1
+
+    def invalidate(self, *tables):
+        """
+        Drop every entry read from any of the tables
+        :param tables: Table names
+        :return:
+        """
+        with self._lock:
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._unindex(key, entry[1])
+                        self.invalidations += 1
+
+    def clear(self):
+        """
+        Drop every entry
+        :return:
+        """
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+
+    def stats(self):
+        """
+        The hit and miss counters and the current size of the cache
+        :return: A dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _unindex(self, key, tables):
+        for table in tables:
+            keys = self._by_table.get(table, None)
+            if keys is not None:
+                keys.discard(key)
+
+
+def entity_cache():
+    """
+    The EntityCache of the running app, or None if caching is turned off
+    :return:
+    """
+    return current_app.extensions.get('entity_cache', None)
+
+
+def read_through(key, tables, load):
+    """
+    Serve a value from the entity cache, calling `load` to read it from the
+    database on a miss and caching the result. The cache is bypassed while the
+    current request has uncommitted writes to any of the tables, so a request
+    always reads its own writes and never publishes them before they commit.
+
+    Values are tagged with the table versions seen when the request's snapshot
+    was opened (or right before the read in autocommit mode), never later ones,
+    so data read from an older snapshot can not outlive the write that replaced it.
+    :param key: The entry key
+    :param tables: The names of the tables `load` reads from
+    :param load: A callable taking no arguments that reads the value
+    :return: A copy of the value, which the caller is free to modify
+    """
+    cache = entity_cache()
+    changed = getattr(g, 'changed_tables', None)
+    if cache is None or (changed and not changed.isdisjoint(tables)):
+        return load()
+    versions = table_versions().get(*tables)
+    value = cache.get(key, versions)
+    if value is MISSING:
+        snapshot = getattr(g, 'snapshot_versions', None)
+        value = load()
+        cache.put(key, value, tables, tuple(snapshot[t] for t in tables) if snapshot else versions)
+    return detached(value)
+
+
+def read_through_many(namespace, ids, tables, load):
+    """
+    The batch form of `read_through`: looks up one entry per id, keyed by
+    (namespace, id), and reads all the missing ones with a single call to `load`
+    :param namespace: The first part of every entry key, e.g. a table name
+    :param ids: The ids to look up
+    :param tables: The names of the tables `load` reads from
+    :param load: A callable taking a list of ids and returning a dict of id to value.
+    Ids left out of the dict are cached as None
+    :return: A dict of id to a copy of its value
+    """
+    cache = entity_cache()
+    changed = getattr(g, 'changed_tables', None)
+    if cache is None or (changed and not changed.isdisjoint(tables)):
+        return load(ids)
+    versions = table_versions().get(*tables)
+    found = dict()
+    missing = []
+    for id in ids:
+        value = cache.get((namespace, id), versions)
+        if value is MISSING:
+            missing.append(id)
+        else:
+            found[id] = detached(value)
+    if missing:
+        snapshot = getattr(g, 'snapshot_versions', None)
+        tag = tuple(snapshot[t] for t in tables) if snapshot else versions
+        loaded = load(missing)
+        for id in missing:
+            value = loaded.get(id, None)
+            cache.put((namespace, id), value, tables, tag)
+            found[id] = detached(value)
+    return found
+
+
+def detached(value):
+    """
+    A copy of a cached record, or list of records, that can be modified
+    without changing the cached one
+    :param value:
+    :return:
+    """
+    if isinstance(value, (dict, Record)):
+        return value.copy()
+    if isinstance(value, (list, tuple)):
+        return [detached(v) for v in value]
+    return value
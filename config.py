@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config(object):
@@ -15,11 +16,70 @@ class Config(object):
     ORACLE_USER_NAME = os.environ.get("ORACLE_USER_NAME", "foo")
     ORACLE_PASSWORD = os.environ.get("ORACLE_PASSWORD", "bar")
     ORACLE_DB_HOST = os.environ.get("ORACLE_DB_HOST", "localhost")
+    # The database the app runs on: "mysql", or "sqlite" for an embedded
+    # database file at SQLITE_PATH that is created on first use
+    DB_BACKEND = os.environ.get("DB_BACKEND", "mysql").lower()
+    SQLITE_PATH = os.environ.get("SQLITE_PATH", "mongoose.db")
+    # Seconds to wait for another worker's write transaction to finish
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5))
+    # How many prepared statements each SQLite connection keeps for reuse
+    SQLITE_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", 256))
     MYSQL_USER_NAME = os.environ.get("MYSQL_USER_NAME", 'foo')
     MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", 'bar')
     MYSQL_DB_HOST = os.environ.get("MYSQL_DB_HOST", 'localhost')
     MYSQL_DB_PORT = os.environ.get("MYSQL_DB_PORT", 3306)
     MYSQL_DB_NAME = os.environ.get("MYSQL_DB_NAME", 'mongoose')
+    MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 5))
+    MYSQL_POOL_MAX_OVERFLOW = int(os.environ.get("MYSQL_POOL_MAX_OVERFLOW", 10))
+    MYSQL_POOL_RECYCLE = int(os.environ.get("MYSQL_POOL_RECYCLE", 3600))
+    MYSQL_POOL_PRE_PING = os.environ.get("MYSQL_POOL_PRE_PING", "true").lower() == "true"
+    MYSQL_POOL_TIMEOUT = int(os.environ.get("MYSQL_POOL_TIMEOUT", 30))
+    # When false (the default) every request runs in one transaction that is
+    # committed when the request succeeds and rolled back otherwise
+    MYSQL_AUTOCOMMIT = os.environ.get("MYSQL_AUTOCOMMIT", "false").lower() == "true"
+    # Stream the /all/ endpoints row by row from server-side cursors
+    STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "true").lower() == "true"
+    # Shared file holding the per-table change counters behind the ETags of
+    # GET responses. Every worker of one deployment must use the same file
+    TABLE_VERSIONS_FILE = os.environ.get("TABLE_VERSIONS_FILE",
+                                         os.path.join(tempfile.gettempdir(), "mongoose-table-versions"))
+    # Answer GETs with ETags and 304s; when false every GET is sent with no-cache headers
+    CONDITIONAL_GETS = os.environ.get("CONDITIONAL_GETS", "true").lower() == "true"
+    # Size bound (0 turns it off) and time to live in seconds of the
+    # per-process cache of records looked up by key
+    ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", 10000))
+    ENTITY_CACHE_TTL = int(os.environ.get("ENTITY_CACHE_TTL", 300))
+    # Record the statements of every request, for the Server-Timing header and the slow-query log
+    SQL_INSTRUMENTATION = os.environ.get("SQL_INSTRUMENTATION", "true").lower() == "true"
+    # Statements taking at least this many milliseconds are written to the
+    # slow-query log, in the file at SLOW_QUERY_LOG if set
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+    SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG", None)
+    # The most statements any request may run, unless its view sets its own cap
+    # with utils.max_queries. Going over raises in testing mode and logs otherwise
+    SQL_QUERY_CAP = int(os.environ["SQL_QUERY_CAP"]) if os.environ.get("SQL_QUERY_CAP") else None
+    # Serve /fridge/ from an in-memory index of the food in the fridge (see fridge.py),
+    # read again in full from the database at least every FRIDGE_RECONCILE_SECONDS
+    FRIDGE_INDEX = os.environ.get("FRIDGE_INDEX", "true").lower() == "true"
+    FRIDGE_RECONCILE_SECONDS = int(os.environ.get("FRIDGE_RECONCILE_SECONDS", 60))
+    # Serve /recipe/cookable/ from an in-memory count of the ingredients each recipe
+    # lacks (see cookable.py), read again in full at least every FRIDGE_RECONCILE_SECONDS
+    COOKABLE_INDEX = os.environ.get("COOKABLE_INDEX", "true").lower() == "true"
+    # Serve the date lookups of /menu/ from an in-memory index of the menus sorted by
+    # date (see menu_calendar.py), read again in full at least every FRIDGE_RECONCILE_SECONDS
+    CALENDAR_INDEX = os.environ.get("CALENDAR_INDEX", "true").lower() == "true"
+    # Serve /search/ from in-memory indexes of the food and recipe names (see search.py),
+    # read again in full from the database at least every SEARCH_RECONCILE_SECONDS
+    SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "true").lower() == "true"
+    SEARCH_RECONCILE_SECONDS = int(os.environ.get("SEARCH_RECONCILE_SECONDS", 300))
+    # Read rows into compact slotted records (see records.py) instead of dicts
+    COMPACT_ROWS = os.environ.get("COMPACT_ROWS", "false").lower() == "true"
+    # The library encoding JSON responses: "simplejson", "ujson", or "auto" to use ujson when installed
+    JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto").lower()
+    # Serve request, pool and cache metrics at /metrics. Needs SQL_INSTRUMENTATION.
+    # Every worker of one deployment must use the same METRICS_DIR, emptied when the app restarts
+    METRICS = os.environ.get("METRICS", "true").lower() == "true"
+    METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "mongoose-metrics"))
     SECRET_KEY = os.environ.get('APP_SECRET', 'S00p3rs3cr3t')
 
 
@@ -29,7 +89,7 @@ class TestingConfig(Config):
     requires different configuration than a development or
     production environment
     """
-    pass
+    TESTING = True
 
 
 class DevelopmentConfig(Config):
@@ -0,0 +1,140 @@
+from bisect import bisect_right
+
+from flask import current_app
+
+from entities import Food, Recipe
+from fridge import query as fridge_query
+from indexes import TableIndex, cursor_id
+
+
+class CookableIndex(TableIndex):
+    """
+    How many ingredients of each recipe are not in the fridge, kept in memory
+    by each worker (see indexes.TableIndex) so the recipes that can be cooked,
+    or nearly, are found without reading the recipes and their ingredients.
+
+    Each recipe holds the set of its ingredients' food ids, each food the set of
+    the recipes using it, and the recipes are grouped by their number of missing
+    ingredients. Putting a food in the fridge or taking it out only moves the
+    recipes using it to the next group, and replacing the ingredients of a recipe
+    only counts that recipe again, so the recipes missing at most k ingredients
+    are the union of the first k + 1 groups. Recipes with no ingredients are left out.
+    """
+
+    def __init__(self, interval=60):
+        """
+        :param interval: See indexes.TableIndex
+        """
+        super(CookableIndex, self).__init__(Recipe, interval, tables=[Food.__table__, "ingredients"])
+        self.relation = Recipe.__relations__["ingredients"]
+        self._ingredients = dict()
+        self._uses = dict()
+        self._stocked = set()
+        self._missing = dict()
+        self._by_missing = dict()
+
+    def page(self, missing=0, limit=None, after=None):
+        """
+        The recipes missing at most `missing` ingredients, ordered by id
+        :param missing: The most ingredients not in the fridge
+        :param limit: The page size. Like `DbEntity.all`, one more recipe is returned
+        if there is a following page. Returns every recipe if None
+        :param after: The recipe id the page starts after, or None
+        :return: A list of (recipe id, sorted ids of its ingredients not in the fridge) tuples
+        """
+        with self._lock:
+            ids = sorted(set().union(*[recipes for count, recipes in self._by_missing.items() if count <= missing]))
+            start = bisect_right(ids, after) if after is not None else 0
+            end = start + limit + 1 if limit is not None else len(ids)
+            return [(id, sorted(self._ingredients[id] - self._stocked)) for id in ids[start:end]]
+
+    def records(self):
+        return set(food[Food.__keys__[0]] for food in fridge_query(Food())), self.relation.links()
+
+    def load(self, records):
+        stocked, links = records
+        self._ingredients = dict()
+        self._uses = dict()
+        self._stocked = stocked
+        self._missing = dict()
+        self._by_missing = dict()
+        for id, foods in links.items():
+            self.link(id, foods)
+
+    def reread(self, table, ids):
+        if table == Food.__table__:
+            return Food().find_many(sorted(ids))
+        return self.relation.links(sorted(ids))
+
+    def update(self, table, id, record):
+        if table == Food.__table__:
+            stocked = record is not None and bool(record["in_fridge"])
+            if stocked == (id in self._stocked):
+                return
+            if stocked:
+                self._stocked.add(id)
+            else:
+                self._stocked.discard(id)
+            for recipe in self._uses.get(id, ()):
+                self.count(recipe, self._missing[recipe] + (-1 if stocked else 1))
+        else:
+            for food in self._ingredients.pop(id, ()):
+                self._uses[food].discard(id)
+            if id in self._missing:
+                self._by_missing[self._missing.pop(id)].discard(id)
+            self.link(id, record or [])
+
+    def link(self, id, foods):
+        """
+        Index the ingredients of a recipe
+        :param id: The recipe id
+        :param foods: The food ids of its ingredients
+        :return:
+        """
+        foods = frozenset(food for food in foods if food is not None)
+        if not foods:
+            return
+        self._ingredients[id] = foods
+        for food in foods:
+            self._uses.setdefault(food, set()).add(id)
+        self.count(id, len(foods - self._stocked))
+
+    def count(self, id, missing):
+        """
+        Move a recipe to the group of its number of missing ingredients
+        :param id: The recipe id
+        :param missing: The number of its ingredients not in the fridge
+        :return:
+        """
+        if id in self._missing:
+            self._by_missing[self._missing[id]].discard(id)
+        self._missing[id] = missing
+        self._by_missing.setdefault(missing, set()).add(id)
+
+    def __len__(self):
+        return len(self._ingredients)
+
+
+def cookable_index():
+    """
+    The CookableIndex of the running app, or None if it is turned off
+    :return:
+    """
+    return current_app.extensions.get('cookable_index', None)
+
+
+def cookable(recipe, missing=0, limit=None, after=None):
+    """
+    The recipes missing at most `missing` ingredients, through the CookableIndex
+    when it is up to date for the request, or else through one loaded right away
+    :param recipe: The Recipe entity whose page cursor `after` is
+    :param missing: See `CookableIndex.page`
+    :param limit: See `CookableIndex.page`
+    :param after: A cursor from `recipe.next_page`
+    :return: See `CookableIndex.page`
+    """
+    index = cookable_index()
+    if index is None or not index.usable():
+        index = CookableIndex()
+        index.load(index.records())
+    return index.page(missing, limit, cursor_id(recipe, after) if after is not None else None)
@@ -0,0 +1,417 @@
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+import pymysql.cursors
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "sqlite_schema.sql")
+
+# pymysql style parameter markers, plus the escaped percent sign
+_PARAMETER = re.compile(r"%(s|%)")
+_translated = dict()
+
+
+class MySQLDialect(object):
+    """
+    The SQL and connection details specific to MySQL (through pymysql)
+    """
+    name = "mysql"
+    # Appended to a SELECT to lock the rows it reads until the transaction ends
+    lock_rows = " FOR UPDATE"
+
+    def connect(self, config):
+        """
+        Opens a new connection
+        :param config: A mapping holding the app configuration
+        :return: A DB-API connection returning rows as dicts
+        """
+        return pymysql.connect(host=config['MYSQL_DB_HOST'],
+                               port=int(config['MYSQL_DB_PORT']),
+                               user=config['MYSQL_USER_NAME'],
+                               password=config['MYSQL_PASSWORD'],
+                               db=config['MYSQL_DB_NAME'],
+                               charset='utf8mb4',
+                               cursorclass=pymysql.cursors.DictCursor)
+
+    def begin(self, db, read_only=False):
+        """
+        Starts a transaction
+        :param db: A connection
+        :param read_only: Whether to start a read only snapshot
+        :return:
+        """
+        cursor = db.cursor()
+        if read_only:
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+        else:
+            cursor.execute("START TRANSACTION")
+        cursor.close()
+
+    def streaming_cursor(self, db):
+        """
+        A cursor that reads rows from the server as they are iterated instead of all at once
+        :param db: A connection
+        :return:
+        """
+        return db.cursor(pymysql.cursors.SSDictCursor)
+
+    def tuple_cursor(self, db):
+        """
+        A cursor returning rows as plain tuples, ordered like cursor.description
+        :param db: A connection
+        :return:
+        """
+        return db.cursor(pymysql.cursors.Cursor)
+
+    def inserted_ids(self, cursor, count):
+        """
+        The ids generated by the multi-row INSERT just run on a cursor. MySQL
+        reports the id of the first row, and the rest follow it consecutively,
+        auto_increment_increment apart
+        :param cursor: The cursor that ran the INSERT
+        :param count: The number of rows inserted
+        :return: A list of ids in the order the rows were inserted
+        """
+        first_id = cursor.lastrowid
+        conn = cursor.connection
+        step = getattr(conn, '_auto_increment_step', None)
+        if step is None:
+            cursor.execute("SELECT @@auto_increment_increment AS step")
+            step = conn._auto_increment_step = cursor.fetchone()['step']
+        return [first_id + i * step for i in range(count)]
+
+    def upsert(self, keys, columns):
+        """
+        The clause turning an INSERT into an update of the rows whose key already exists
+        :param keys: The primary key columns
+        :param columns: The columns to update
+        :return:
+        """
+        return "ON DUPLICATE KEY UPDATE {}".format(", ".join("{column}=VALUES({column})".format(column=column)
+                                                              for column in columns))
+
+    def batch_size(self, width, default):
+        """
+        How many rows of `width` parameters one statement may carry
+        :param width: The number of parameters per row
+        :param default: The most rows wanted per statement
+        :return:
+        """
+        return max(default, 1)
+
+    def columns(self, connection, tables):
+        """
+        Describes the columns of tables
+        :param connection: A connection
+        :param tables: Table names
+        :return: A list of dicts holding TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY
+        and EXTRA like information_schema.COLUMNS, ordered by table and column position
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY, EXTRA\n"
+            "FROM information_schema.COLUMNS\n"
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})\n"
+            "ORDER BY TABLE_NAME, ORDINAL_POSITION".format(placeholders=", ".join(["%s"] * len(tables))),
+            tuple(tables))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def explain(self, connection, sql, values):
+        """
+        The query plan of a statement
+        :param connection: A connection
+        :param sql: The statement
+        :param values: Its parameters
+        :return: A list of dicts holding the `table` read, the access `type` ("ALL" for a
+        full table scan), the `possible_keys` and the `key` used
+        """
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, values)
+        rows = [{k: row[k] for k in ('table', 'type', 'possible_keys', 'key')} for row in cursor.fetchall()]
+        cursor.close()
+        return rows
+
+
+class SQLiteDialect(object):
+    """
+    The SQL and connection details specific to an embedded SQLite database.
+    Connections are opened in WAL mode, so readers never block the writer, and
+    the schema in resources/sqlite_schema.sql is created in an empty database
+    """
+    name = "sqlite"
+    # Write transactions are started with BEGIN IMMEDIATE, which already
+    # keeps every other writer out, so rows need no locking of their own
+    lock_rows = ""
+    # SQLITE_MAX_VARIABLE_NUMBER, raised from 999 in SQLite 3.32
+    max_parameters = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+    def connect(self, config):
+        """
+        Opens a new connection, creating the database if needed
+        :param config: A mapping holding the app configuration
+        :return: A SQLiteConnection
+        """
+        db = sqlite3.connect(config['SQLITE_PATH'],
+                             timeout=config['SQLITE_BUSY_TIMEOUT'],
+                             detect_types=sqlite3.PARSE_DECLTYPES,
+                             isolation_level=None,
+                             check_same_thread=False,
+                             cached_statements=config['SQLITE_CACHED_STATEMENTS'])
+        db.row_factory = _dict_row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='food'").fetchone():
+            with open(SQLITE_SCHEMA) as f:
+                db.executescript(f.read())
+        return SQLiteConnection(db)
+
+    def begin(self, db, read_only=False):
+        """
+        Starts a transaction. A deferred transaction reads from one snapshot of
+        the database, while an immediate one takes the write lock up front
+        :param db: A connection
+        :param read_only: Whether the transaction only reads
+        :return:
+        """
+        cursor = db.cursor()
+        cursor.execute("BEGIN" if read_only else "BEGIN IMMEDIATE")
+        cursor.close()
+
+    def streaming_cursor(self, db):
+        """
+        SQLite cursors always step through the rows as they are iterated
+        :param db: A connection
+        :return:
+        """
+        return db.cursor()
+
+    def tuple_cursor(self, db):
+        """
+        See MySQLDialect.tuple_cursor
+        """
+        return db.cursor(SQLiteTupleCursor)
+
+    def inserted_ids(self, cursor, count):
+        """
+        The ids generated by the multi-row INSERT just run on a cursor. SQLite
+        reports the id of the last row, and the ids of one statement are consecutive
+        :param cursor: The cursor that ran the INSERT
+        :param count: The number of rows inserted
+        :return: A list of ids in the order the rows were inserted
+        """
+        last_id = cursor.lastrowid
+        return list(range(last_id - count + 1, last_id + 1))
+
+    def upsert(self, keys, columns):
+        """
+        See MySQLDialect.upsert
+        """
+        return "ON CONFLICT ({}) DO UPDATE SET {}".format(", ".join(keys),
+                                                          ", ".join("{column}=excluded.{column}".format(column=column)
+                                                                    for column in columns))
+
+    def batch_size(self, width, default):
+        """
+        See MySQLDialect.batch_size. Bound by the number of parameters SQLite accepts
+        """
+        return max(min(default, self.max_parameters // max(width, 1)), 1)
+
+    def columns(self, connection, tables):
+        """
+        See MySQLDialect.columns. Reads every table in one statement through
+        the table-valued form of PRAGMA table_info
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT m.name AS table_name, p.name, p.type, p.pk\n"
+            "FROM sqlite_master m JOIN pragma_table_info(m.name) p\n"
+            "WHERE m.type = 'table' AND m.name IN ({placeholders})\n"
+            "ORDER BY m.name, p.cid".format(placeholders=", ".join(["%s"] * len(tables))),
+            tuple(tables))
+        info = cursor.fetchall()
+        cursor.close()
+        keys = dict()
+        for c in info:
+            if c['pk']:
+                keys[c['table_name']] = keys.get(c['table_name'], 0) + 1
+        rows = []
+        for c in info:
+            # A lone INTEGER PRIMARY KEY is the rowid, which SQLite generates
+            rowid = c['pk'] and keys[c['table_name']] == 1 and c['type'].upper() == "INTEGER"
+            rows.append({
+                "TABLE_NAME": c['table_name'],
+                "COLUMN_NAME": c['name'],
+                "COLUMN_TYPE": c['type'].lower(),
+                "COLUMN_KEY": "PRI" if c['pk'] else "",
+                "EXTRA": "auto_increment" if rowid else ""
+            })
+        return rows
+
+    def explain(self, connection, sql, values):
+        """
+        See MySQLDialect.explain. SQLite only considers indexes it can use, so
+        a table scanned without an index never had one to use
+        """
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, values)
+        rows = []
+        for row in cursor.fetchall():
+            words = row['detail'].split()
+            if words[0] not in ("SCAN", "SEARCH") or len(words) < 2:
+                continue
+            table = words[2] if words[1] == "TABLE" else words[1]
+            key = None
+            if "USING" in words:
+                key = " ".join(words[words.index("USING") + 1:])
+            full_scan = words[0] == "SCAN" and key is None
+            rows.append({"table": table, "type": "ALL" if full_scan else words[0].lower(),
+                         "possible_keys": key, "key": key})
+        cursor.close()
+        return rows
+
+
+class SQLiteConnection(object):
+    """
+    Wraps a sqlite3 connection so it can be used like the pymysql connections
+    the rest of the app is written against: statements use %s parameters, rows
+    come back as dicts and `execute` returns the number of rows affected
+    """
+    dialect = SQLiteDialect()
+
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, cursorclass=None):
+        """
+        :param cursorclass: SQLiteTupleCursor for a cursor returning tuples.
+        Anything else gets a cursor returning dicts
+        :return: A SQLiteCursor
+        """
+        cursor = self._db.cursor()
+        if cursorclass is SQLiteTupleCursor:
+            cursor.row_factory = None
+            return SQLiteTupleCursor(self, cursor)
+        return SQLiteCursor(self, cursor)
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def ping(self, reconnect=False):
+        self._db.execute("SELECT 1")
+
+    def close(self):
+        self._db.close()
+
+
+class SQLiteCursor(object):
+    """
+    A pymysql-like cursor over a sqlite3 cursor
+    """
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self._cursor = cursor
+
+    def execute(self, sql, args=None):
+        """
+        Runs a statement
+        :param sql: The statement, using %s parameters like pymysql
+        :param args: A sequence of parameters, or a single one
+        :return: The number of rows affected
+        """
+        if args is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(_sqlite_sql(sql), _parameters(args))
+        return max(self._cursor.rowcount, 0)
+
+    def executemany(self, sql, args):
+        self._cursor.executemany(_sqlite_sql(sql), [_parameters(a) for a in args])
+        return max(self._cursor.rowcount, 0)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+
+class SQLiteTupleCursor(SQLiteCursor):
+    """
+    A SQLiteCursor returning rows as tuples
+    """
+    pass
+
+
+def _translate(match):
+    return "?" if match.group(1) == "s" else "%"
+
+
+def _sqlite_sql(sql):
+    # The entities run the same statement texts over and over (see queries.py),
+    # so each is translated once, and sqlite3 then finds its prepared statement
+    # in the connection's statement cache
+    ret = _translated.get(sql, None)
+    if ret is None:
+        if len(_translated) >= 4096:
+            _translated.clear()
+        ret = _translated[sql] = _PARAMETER.sub(_translate, sql)
+    return ret
+
+
+def _parameters(args):
+    # pymysql accepts a lone value in place of a sequence of parameters
+    return tuple(args) if isinstance(args, (list, tuple)) else (args,)
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def _date(value):
+    return datetime.strptime(value.decode('ascii'), "%Y-%m-%d").date()
+
+
+# Columns declared as DATE come back as datetime.date, like they do from pymysql
+sqlite3.register_converter("DATE", _date)
+
+MYSQL = MySQLDialect()
+SQLITE = SQLiteConnection.dialect
+
+DIALECTS = {
+    MYSQL.name: MYSQL,
+    SQLITE.name: SQLITE,
+}
+
+
+def dialect_of(connection):
+    """
+    The dialect spoken by a connection
+    :param connection: A connection opened by one of the dialects
+    :return:
+    """
+    return getattr(connection, 'dialect', MYSQL)
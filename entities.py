@@ -1,8 +1,314 @@
+import base64
+import json
 from collections import OrderedDict
 from datetime import date
 
 from flask import g
 
+from cache import read_through, read_through_many
+from dialects import dialect_of
+from metadata import registry
+from queries import compiled, placeholders, comparison_shape, build_where
+from records import row_cursor, fetch_records, from_mappings, register as register_records
+from versions import mark_changed, mark_keys_changed, publish_changes, cascaded
+
+# The most rows written by one multi-row INSERT, which keeps big
+# batches well inside MySQL's max_allowed_packet. SQLite may take
+# fewer, see dialects.SQLiteDialect.batch_size
+BULK_CHUNK_SIZE = 1000
+
+
+class InvalidPage(ValueError):
+    """
+    Raised when a page cursor or page size given for keyset pagination
+    cannot be used
+    """
+    pass
+
+
+class InvalidRecord(ValueError):
+    """
+    Raised when a record given to be saved holds a primary key that
+    cannot be converted to the type of the key column
+    """
+    pass
+
+
+class RecordNotFound(LookupError):
+    """
+    Raised when records given to be updated hold primary keys that no
+    row of the table holds. Nothing is written when it is raised
+    """
+
+    def __init__(self, table, ids):
+        """
+        :param table: The table name
+        :param ids: The keys not found
+        """
+        LookupError.__init__(self, "No {} with id {} found".format(table, ", ".join(str(id) for id in ids)))
+        self.ids = ids
+
+
+def chunked(items, size=BULK_CHUNK_SIZE):
+    """
+    Splits a list into consecutive slices of at most `size` items
+    :param items:
+    :param size:
+    :return:
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class ManyToOne(object):
+    """
+    A relation where each record holds a foreign key to at most one
+    record of another table, e.g. a food and its nutritional fact
+    """
+
+    def __init__(self, foreign_key, target, default=dict):
+        """
+        :param foreign_key: The column on the owning table holding the foreign key
+        :param target: The referenced column in the form of "table.column"
+        :param default: A callable building the value attached when there is no related record
+        """
+        self.foreign_key = foreign_key
+        self.table, self.key = target.split(".")
+        self.default = default
+
+    def attach(self, name, records, key):
+        """
+        Fetch the related record for every record in `records` with one query
+        and store it in each record under `name`
+        :param name: The attribute name the related records are attached as
+        :param records: A list of dict-like records of the owning table
+        :param key: The primary key column of the owning table
+        :return:
+        """
+        fks = list(OrderedDict.fromkeys(r[self.foreign_key] for r in records if r[self.foreign_key] is not None))
+        related = dict()
+        if fks:
+            related = read_through_many(self.table, fks, (self.table,), self.fetch)
+        for record in records:
+            record[name] = related.get(record[self.foreign_key], None) or self.default()
+
+    def fetch(self, ids):
+        """
+        Read the related records with the given keys
+        :param ids: A list of keys of the related table
+        :return: A dict of key to record
+        """
+        cursor = row_cursor(g.db)
+        related = dict()
+        for chunk in chunked(ids, dialect_of(g.db).batch_size(1, len(ids))):
+            cursor.execute(self.fetch_sql(len(chunk)), tuple(chunk))
+            related.update((row[self.key], row) for row in fetch_records(cursor, self.table))
+        cursor.close()
+        return related
+
+    def fetch_sql(self, count):
+        """
+        The statement `fetch` runs
+        :param count: The number of keys fetched
+        :return:
+        """
+        return compiled((self.table, self.key, "fetch", count),
+                        lambda: "SELECT * FROM {table} WHERE {key} IN ({placeholders})".format(
+                            table=self.table, key=self.key, placeholders=placeholders(count)))
+
+    def join_columns(self, name):
+        """
+        The select list for the related table's columns when it is joined, each
+        aliased as "<name>__<column>" so they can be told apart from the owner's
+        :param name: The relation name
+        :return:
+        """
+        return ", ".join("{table}.{column} AS {name}__{column}".format(table=self.table, column=column, name=name)
+                         for column in registry.get(self.table, g.db).columns)
+
+    def join_clause(self, owner):
+        """
+        The LEFT JOIN clause bringing in the related table
+        :param owner: The owning table
+        :return:
+        """
+        return "LEFT JOIN {table} ON {table}.{key} = {owner}.{fk}".format(table=self.table,
+                                                                         key=self.key,
+                                                                         owner=owner,
+                                                                         fk=self.foreign_key)
+
+    def split(self, name, row):
+        """
+        Moves the joined columns of a row selected with `join_columns` into
+        a nested record stored under `name`
+        :param name: The relation name
+        :param row: A dict row containing the owner's and the aliased related columns
+        :return: The row
+        """
+        prefix = "{}__".format(name)
+        related = dict()
+        for column in [c for c in row if c.startswith(prefix)]:
+            related[column[len(prefix):]] = row.pop(column)
+        row[name] = related if related.get(self.key, None) is not None else self.default()
+        return row
+
+
+class ManyToMany(object):
+    """
+    A relation linking records of two tables through an association
+    table, e.g. recipes and their ingredients
+    """
+
+    def __init__(self, target, through, local, remote):
+        """
+        :param target: The related table's primary key in the form of "table.column"
+        :param through: The association table
+        :param local: The association table column referencing the owning table
+        :param remote: The association table column referencing the related table
+        """
+        self.table, self.key = target.split(".")
+        self.through = through
+        self.local = local
+        self.remote = remote
+
+    def attach(self, name, records, key):
+        """
+        Fetch the related records for every record in `records` with one query,
+        group them by owner and store each group under `name`
+        :param name: The attribute name the related records are attached as
+        :param records: A list of dict-like records of the owning table
+        :param key: The primary key column of the owning table
+        :return:
+        """
+        ids = list(OrderedDict.fromkeys(r[key] for r in records if r[key] is not None))
+        related = dict()
+        if ids:
+            related = read_through_many("{}.{}".format(self.through, self.local), ids,
+                                        (self.through, self.table), self.fetch)
+        for record in records:
+            record[name] = related.get(record[key], None) or []
+
+    def fetch(self, ids):
+        """
+        Read the related records of the owners with the given keys
+        :param ids: A list of keys of the owning table
+        :return: A dict of owner key to a list of its related records
+        """
+        cursor = row_cursor(g.db)
+        related = dict()
+        for chunk in chunked(ids, dialect_of(g.db).batch_size(1, len(ids))):
+            cursor.execute(self.fetch_sql(len(chunk)), tuple(chunk))
+            for row in fetch_records(cursor, self.table):
+                related.setdefault(row.pop('__owner__'), []).append(row)
+        cursor.close()
+        return related
+
+    def fetch_sql(self, count):
+        """
+        The statement `fetch` runs
+        :param count: The number of owner keys fetched
+        :return:
+        """
+        return compiled((self.through, self.local, "fetch", count),
+                        lambda: ("SELECT DISTINCT {through}.{local} AS __owner__, {table}.*\n"
+                                 "FROM {table}\n"
+                                 "JOIN {through} ON {through}.{remote} = {table}.{key}\n"
+                                 "WHERE {through}.{local} IN ({placeholders})\n"
+                                 "ORDER BY {table}.{key}").format(table=self.table,
+                                                                  key=self.key,
+                                                                  through=self.through,
+                                                                  local=self.local,
+                                                                  remote=self.remote,
+                                                                  placeholders=placeholders(count)))
+
+    def links(self, ids=None):
+        """
+        Read the related keys of the owners with the given keys from the association table alone
+        :param ids: A list of keys of the owning table, or None for every owner
+        :return: A dict of owner key to the list of its related keys, leaving out the owners with none
+        """
+        cursor = g.db.cursor()
+        chunks = chunked(ids, dialect_of(g.db).batch_size(1, BULK_CHUNK_SIZE)) if ids is not None else [None]
+        links = dict()
+        for chunk in chunks:
+            sql = compiled((self.through, self.local, "links", len(chunk) if chunk is not None else None),
+                           lambda: "SELECT {local}, {remote} FROM {through}{where}".format(
+                               local=self.local,
+                               remote=self.remote,
+                               through=self.through,
+                               where=" WHERE {} IN ({})".format(self.local, placeholders(len(chunk)))
+                               if chunk is not None else ""))
+            cursor.execute(sql, tuple(chunk) if chunk is not None else ())
+            for row in cursor.fetchall():
+                links.setdefault(row[self.local], []).append(row[self.remote])
+        cursor.close()
+        return links
+
+    def replace(self, name, records, key):
+        """
+        Replace the associations of every record in `records` with the related
+        ids each record holds under `name`. The old associations are removed
+        with one DELETE and the new ones written with multi-row INSERTs
+        :param name: The attribute name holding the list of related ids
+        :param records: A list of dict-like records of the owning table
+        :param key: The primary key column of the owning table
+        :return:
+        """
+        ids = list(OrderedDict.fromkeys(r[key] for r in records))
+        if not ids:
+            return
+        cursor = g.db.cursor()
+        for chunk in chunked(ids, dialect_of(g.db).batch_size(1, len(ids))):
+            sql = compiled((self.through, self.local, "unlink", len(chunk)),
+                           lambda: "DELETE FROM {through} WHERE {local} IN ({placeholders})".format(
+                               through=self.through, local=self.local, placeholders=placeholders(len(chunk))))
+            cursor.execute(sql, tuple(chunk))
+        pairs = [(record[key], related_id) for record in records for related_id in record[name]]
+        if pairs:
+            cursor.executemany("INSERT INTO {through} ({local}, {remote}) VALUES (%s, %s)".format(
+                through=self.through,
+                local=self.local,
+                remote=self.remote), pairs)
+        cursor.close()
+
+    def join_columns(self, name):
+        """
+        The select list for the related table's columns when it is joined
+        through the association table, each aliased as "<name>__<column>"
+        :param name: The relation name
+        :return:
+        """
+        return ", ".join("{table}.{column} AS {name}__{column}".format(table=self.table, column=column, name=name)
+                         for column in registry.get(self.table, g.db).columns)
+
+    def join_clause(self, owner, key):
+        """
+        The LEFT JOINs bringing in the association table and the related table
+        :param owner: The owning table
+        :param key: The primary key column of the owning table
+        :return:
+        """
+        return ("LEFT JOIN {through} ON {through}.{local} = {owner}.{owner_key} "
+                "LEFT JOIN {table} ON {table}.{key} = {through}.{remote}").format(through=self.through,
+                                                                                   local=self.local,
+                                                                                   remote=self.remote,
+                                                                                   owner=owner,
+                                                                                   owner_key=key,
+                                                                                   table=self.table,
+                                                                                   key=self.key)
+
+    def pop_related(self, name, row):
+        """
+        Removes the joined columns of a row selected with `join_columns`
+        :param name: The relation name
+        :param row: A dict row containing the owner's and the aliased related columns
+        :return: The related record, or None if the owner has no related record on this row
+        """
+        prefix = "{}__".format(name)
+        related = dict()
+        for column in [c for c in row if c.startswith(prefix)]:
+            related[column[len(prefix):]] = row.pop(column)
+        return related if related.get(self.key, None) is not None else None
+
 
 class DbEntity(object):
     cursor = None
@@ -12,45 +318,91 @@ class DbEntity(object):
     __columns__ = dict()
     __keys__ = []
     __foreign_keys__ = dict()
+    __relations__ = dict()
+    # The columns pages of records are ordered and seeked by. Must end
+    # with a unique column; defaults to the primary key
+    __order_by__ = []
+    next_page = None
 
     def __init__(self):
         """
-        Initializes the database entity using the connection provided
-        by the db parameter. If __columns__ is empty, then it will
+        Initializes the database entity from the table metadata held in
+        the process-wide registry, so building an entity does no I/O once
+        the tables have been introspected. If __columns__ is empty, then it will
         fill the columns with the column names in the database, but will
         not fill in the python type mappings; they will all be null
         """
-        cursor = g.db.cursor()
-        cursor.execute("SELECT * FROM {table} LIMIT 1".format(table=self.__table__))
-        self.data = OrderedDict(**{i[0]: None for i in cursor.description})
+        self.data = self.metadata.empty_row()
         if not self.__columns__:
             self.__columns__ = self.data.copy()
-        cursor.close()
-        self.save()
+
+    @property
+    def metadata(self):
+        """
+        The column, type and key information for the mapped table
+        :return: A metadata.TableMetadata object
+        """
+        return registry.get(self.__table__, g.db)
 
     def find_by_id(self, id):
         """
-        Attempt to pull one record from the database by its id. Updates the
+        Attempt to pull one record from the database by its id, or from the entity
+        cache if it was read recently. Updates the
         `self.data` cache with the returned values, or resets them all to null
         :param id: The id to find
         :return: A dict() representing the returned record from the database
         """
-        cursor = g.db.cursor()
         placeholder, value = self.prep_for_query(id)
-        sql = "SELECT * FROM {table} WHERE {key}={placeholder} LIMIT 1".format(table=self.__table__,
-                                                                               key=self.__keys__[0],
-                                                                               placeholder=placeholder)
-        cursor.execute(sql, value)
-        ret = cursor.fetchone()
+
+        def load():
+            cursor = row_cursor(g.db)
+            sql = compiled((self.__table__, "find_by_id"),
+                           lambda: "SELECT * FROM {table} WHERE {key}={placeholder} LIMIT 1".format(
+                               table=self.__table__, key=self.__keys__[0], placeholder=placeholder))
+            cursor.execute(sql, value)
+            rows = fetch_records(cursor, self.__table__)
+            cursor.close()
+            return rows[0] if rows else None
+
+        ret = read_through((self.__table__, value), (self.__table__,), load)
 
         if ret:
             self.data.update(ret)
         else:
-            self.data = OrderedDict(**{i[0]: None for i in cursor.description})
-        cursor.close()
-        self.save()
+            self.data = self.metadata.empty_row()
         return ret
 
+    def find_by_ids(self, ids):
+        """
+        The batch form of `find_by_id`: pulls many records by id, from the entity
+        cache when they were read recently and otherwise with `find_many`. Unlike
+        `find_by_id`, the `self.data` cache is left as it is
+        :param ids: A list of ids
+        :return: A dict of id to record, leaving out the ids that were not found
+        """
+        found = read_through_many(self.__table__, [self.query_value(id) for id in ids], (self.__table__,),
+                                  self.find_many)
+        return dict((id, record) for id, record in found.items() if record is not None)
+
+    def find_many(self, ids):
+        """
+        Pull the records with the given ids from the database, in as few
+        queries as the dialect allows
+        :param ids: A list of ids
+        :return: A dict of id to record, leaving out the ids that were not found
+        """
+        key = self.__keys__[0]
+        cursor = row_cursor(g.db)
+        found = dict()
+        for chunk in chunked(list(ids), dialect_of(g.db).batch_size(1, BULK_CHUNK_SIZE)):
+            sql = compiled((self.__table__, key, "fetch", len(chunk)),
+                           lambda: "SELECT * FROM {table} WHERE {key} IN ({placeholders})".format(
+                               table=self.__table__, key=key, placeholders=placeholders(len(chunk))))
+            cursor.execute(sql, tuple(self.query_value(id) for id in chunk))
+            found.update((row[key], row) for row in fetch_records(cursor, self.__table__))
+        cursor.close()
+        return found
+
     def find_by_attribute(self, attribute, value, limit=1):
         """
         Attempt to find a record based on an attribute. Will throw a TypeError
@@ -67,23 +419,20 @@ class DbEntity(object):
         """
         if attribute not in self.__columns__:
             raise TypeError("Invalid column name")
-        cursor = g.db.cursor()
+        cursor = row_cursor(g.db)
         placeholder, value = self.prep_for_query(value)
-        sql = "SELECT * FROM {table} WHERE {attr}={placeholder}{limit}".format(table=self.__table__,
-                                                                               attr=attribute,
-                                                                               placeholder=placeholder,
-                                                                               limit=" LIMIT {}".format(
-                                                                                   limit) if limit > 0 else "")
-
-        cursor.execute(sql, value)
-        ret = cursor.fetchall()
+        sql = compiled((self.__table__, "find_by_attribute", attribute, limit > 0),
+                       lambda: "SELECT * FROM {table} WHERE {attr}={placeholder}{limit}".format(
+                           table=self.__table__, attr=attribute, placeholder=placeholder,
+                           limit=" LIMIT %s" if limit > 0 else ""))
+
+        cursor.execute(sql, (value, int(limit)) if limit > 0 else (value,))
+        ret = fetch_records(cursor, self.__table__)
         cursor.close()
 
         if limit == 1 and ret:
             self.data.update(ret[0])
 
-        self.save()
-
         return ret
 
     def update(self, **values):
@@ -95,46 +444,285 @@ class DbEntity(object):
         """
         self.data.update(values)
 
-    def all(self, combinator="AND", comparisons=None):
+    def load_relations(self, records, *relations):
+        """
+        Attach related records (declared in __relations__) to a list of records
+        of this entity. Each relation is loaded for the whole list with a single
+        query, so the number of queries does not grow with the number of records.
+
+        :param records: A list of dicts representing records of this entity, such as
+        the ones returned by `all` or `find_by_attribute`
+        :param relations: The names of the relations to load
+        :return: The same list of records, each holding its related records
+        """
+        for name in relations:
+            if name not in self.__relations__:
+                raise TypeError("Invalid relation name")
+            self.__relations__[name].attach(name, records, self.__keys__[0])
+        return records
+
+    def all(self, combinator="AND", comparisons=None, limit=None, after=None):
         """
         By default, this method pulls every record for a table from the database. If
         comparisons is not an empty dictionary, then the query will be modified to accommodate
         the restrictions they signify.
 
+        If `limit` is given, only one page of at most `limit` records is returned, ordered
+        by __order_by__, and `self.next_page` is set to the cursor of the following page (or
+        None on the last page). Pass that cursor back as `after` to get the next page. Pages
+        seek on the ordering columns instead of using OFFSET, so every page costs the same.
+
         :param combinator: The method which the given comparisons will be logically
           chained together. Valid SQL logical chainers such as AND, OR, etc.
         :param comparisons: A dictionary containing top-level keys that map to column
         names for the table and values that are a list of two elements: comparison type as a string,
         and value to compare. In the event that the comparison type is BETWEEN, the value must be a list
         of the two inclusive values to use the BETWEEN comparison with.
+        :param limit: The page size. Returns every record if None
+        :param after: An opaque cursor from `self.next_page` to continue after
         :return: A list dicts representing all records that were selected
         """
-        if comparisons is None:
-            comparisons = dict()
+        where_string, values = self.filter_clause(combinator, comparisons, limit, after)
+        sql = compiled((self.__table__, "all", where_string),
+                       lambda: "SELECT * FROM {table} {where_string}".format(table=self.__table__,
+                                                                             where_string=where_string))
+        cursor = row_cursor(g.db)
+        cursor.execute(sql, values)
+        ret = fetch_records(cursor, self.__table__)
+        cursor.close()
+
+        return self.paginate(ret, limit)
+
+    def all_joined(self, relation, combinator="AND", comparisons=None, limit=None, after=None):
+        """
+        Works like `all`, but LEFT JOINs the table of a many-to-one relation
+        in the same statement and nests each joined record under the relation
+        name, so the records and their related records cost a single query.
+
+        :param relation: The name of a ManyToOne relation declared in __relations__
+        :param combinator: See `all`
+        :param comparisons: See `all`. Column names refer to this entity's table
+        :param limit: See `all`
+        :param after: See `all`
+        :return: A list of dicts representing the selected records, each holding its related record
+        """
+        rel = self.__relations__.get(relation, None)
+        if not isinstance(rel, ManyToOne):
+            raise TypeError("Only many-to-one relations can be joined")
+        where_string, values = self.filter_clause(combinator, comparisons, limit, after, qualifier=self.__table__)
+        sql = compiled((self.__table__, "all_joined", relation, where_string),
+                       lambda: self.joined_sql(relation, where_string))
         cursor = g.db.cursor()
-        values = []
-        where_string = ""
-        if comparisons:
-            where_string = " {} ".format(combinator.strip())
-            conditions = []
-            for key, value in comparisons.iteritems():
-                if value[0].upper() == "BETWEEN":
-                    values.append(self.prep_for_query(value[1][0])[1])
-                    values.append(self.prep_for_query(value[1][1])[1])
-                    conditions.append("{} {} %s AND %s".format(key, value[0]))
-                else:
-                    values.append(self.prep_for_query(value[1])[1])
-                    conditions.append("{}{}%s".format(key, value[0]))
-
-            where_string = "WHERE {}".format(where_string.join(conditions))
-        sql = "SELECT * FROM {table} {where_string}".format(table=self.__table__,
-                                                            where_string=where_string)
-        cursor.execute(sql, tuple(values))
-        ret = cursor.fetchall()
+        cursor.execute(sql, values)
+        owner, related = from_mappings(self.__table__), from_mappings(rel.table)
+        ret = []
+        for row in cursor.fetchall():
+            row = rel.split(relation, row)
+            row[relation] = related(row[relation])
+            ret.append(owner(row))
         cursor.close()
-        self.save()
 
-        return ret
+        return self.paginate(ret, limit)
+
+    def joined_sql(self, relation, where_string):
+        """
+        The statement `all_joined` runs
+        :param relation: The name of a ManyToOne relation declared in __relations__
+        :param where_string: The clauses from `filter_clause`
+        :return:
+        """
+        rel = self.__relations__[relation]
+        columns = ["{table}.{column}".format(table=self.__table__, column=column)
+                   for column in self.metadata.columns]
+        return "SELECT {columns}, {joined} FROM {table} {join} {where_string}".format(
+            columns=", ".join(columns),
+            joined=rel.join_columns(relation),
+            table=self.__table__,
+            join=rel.join_clause(self.__table__),
+            where_string=where_string)
+
+    def iterate(self, combinator="AND", comparisons=None, relation=None):
+        """
+        Works like `all` (or `all_joined`), but yields the records one at a time
+        from an unbuffered server-side cursor instead of building a list, so
+        memory stays flat no matter how big the table is. The records come out
+        ordered by primary key. Nothing else can run on the connection until
+        the iteration has finished.
+
+        :param combinator: See `all`
+        :param comparisons: See `all`. Column names refer to this entity's table
+        :param relation: The name of a relation declared in __relations__ to load
+        in the same statement. Many-to-many relations are joined through their
+        association table and grouped into a list on each record
+        :return: A generator of dicts representing the selected records
+        """
+        rel = self.__relations__.get(relation, None) if relation else None
+        if relation and rel is None:
+            raise TypeError("Invalid relation name")
+        key = self.__keys__[0]
+        where_string, values = self.where_clause(combinator, comparisons, qualifier=self.__table__)
+        columns = ["{table}.{column}".format(table=self.__table__, column=column)
+                   for column in self.metadata.columns]
+        join = ""
+        if isinstance(rel, ManyToOne):
+            columns.append(rel.join_columns(relation))
+            join = rel.join_clause(self.__table__)
+        elif isinstance(rel, ManyToMany):
+            columns.append(rel.join_columns(relation))
+            join = rel.join_clause(self.__table__, key)
+        sql = "SELECT {columns} FROM {table} {join} {where_string} ORDER BY {table}.{key}".format(
+            columns=", ".join(columns),
+            table=self.__table__,
+            join=join,
+            where_string=where_string,
+            key=key)
+        if isinstance(rel, ManyToMany):
+            sql += ", {table}.{key}".format(table=rel.table, key=rel.key)
+
+        cursor = dialect_of(g.db).streaming_cursor(g.db)
+        try:
+            cursor.execute(sql, values)
+            if isinstance(rel, ManyToOne):
+                for row in cursor:
+                    yield rel.split(relation, row)
+            elif isinstance(rel, ManyToMany):
+                # The rows of one owner are consecutive, one per related record
+                current = None
+                seen = set()
+                for row in cursor:
+                    related = rel.pop_related(relation, row)
+                    if current is None or row[key] != current[key]:
+                        if current is not None:
+                            yield current
+                        current = row
+                        current[relation] = []
+                        seen = set()
+                    if related is not None and related[rel.key] not in seen:
+                        seen.add(related[rel.key])
+                        current[relation].append(related)
+                if current is not None:
+                    yield current
+            else:
+                for row in cursor:
+                    yield row
+        finally:
+            cursor.close()
+
+    def where_clause(self, combinator="AND", comparisons=None, qualifier=None):
+        """
+        Builds the WHERE clause and its parameters for a comparisons
+        dictionary, as described in `all`
+        :param combinator: See `all`
+        :param comparisons: See `all`
+        :param qualifier: If given, every column name is qualified with it (e.g. a table name)
+        :return: A tuple of the WHERE clause (empty if there are no comparisons) and a tuple of values.
+        Raises a TypeError if a comparison names a column the table does not have
+        """
+        if not comparisons:
+            return "", tuple()
+        shape, values = comparison_shape(combinator, comparisons, self.query_value)
+        where_string = compiled((self.__table__, "where", shape, qualifier),
+                                lambda: build_where(self.metadata, shape, qualifier))
+        return where_string, values
+
+    def filter_clause(self, combinator="AND", comparisons=None, limit=None, after=None, qualifier=None):
+        """
+        Builds everything following the FROM clause of a select: the WHERE clause
+        for the comparisons and, when a page is requested, the keyset condition
+        seeking past `after` plus the ORDER BY and LIMIT of the page. One extra
+        record is fetched so `paginate` can tell whether another page follows
+        :param combinator: See `all`
+        :param comparisons: See `all`
+        :param limit: See `all`
+        :param after: See `all`
+        :param qualifier: If given, every column name is qualified with it (e.g. a table name)
+        :return: A tuple of the SQL clauses and a tuple of values
+        """
+        where_string, values = self.where_clause(combinator, comparisons, qualifier)
+        if limit is None:
+            return where_string, values
+        if limit <= 0:
+            raise InvalidPage("Page size must be a positive number")
+
+        if after is not None:
+            last = self.decode_cursor(after)
+            values += tuple(value for i in range(len(last)) for value in last[:i + 1])
+        clauses = compiled((self.__table__, "page", where_string, qualifier, after is not None),
+                           lambda: self.page_clauses(where_string, qualifier, after is not None))
+        return clauses, values + (int(limit) + 1,)
+
+    def page_clauses(self, where_string, qualifier, seek):
+        """
+        The clauses `filter_clause` builds for a page
+        :param where_string: The WHERE clause of the comparisons, if any
+        :param qualifier: See `filter_clause`
+        :param seek: Whether the page continues after a cursor
+        :return:
+        """
+        columns = ["{}.{}".format(qualifier, c) if qualifier else c for c in self.order_by]
+        if seek:
+            # (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y),
+            # which MySQL can turn into a range scan on the ordering index
+            seeks = []
+            for i, column in enumerate(columns):
+                seeks.append("({})".format(" AND ".join(["{}=%s".format(c) for c in columns[:i]] +
+                                                         ["{}>%s".format(column)])))
+            seek = "({})".format(" OR ".join(seeks))
+            if where_string:
+                where_string = "WHERE ({}) AND {}".format(where_string[len("WHERE "):], seek)
+            else:
+                where_string = "WHERE {}".format(seek)
+
+        return "{} ORDER BY {} LIMIT %s".format(where_string, ", ".join(columns))
+
+    def paginate(self, records, limit):
+        """
+        Trims the extra record fetched by a paged query and records the
+        cursor for the following page in `self.next_page`
+        :param records: The records selected with `filter_clause`
+        :param limit: The page size, or None if the query was not paged
+        :return: The records of the page
+        """
+        self.next_page = None
+        if limit is None:
+            return records
+        records = list(records)
+        if len(records) > limit:
+            records = records[:limit]
+            self.next_page = self.encode_cursor(records[-1])
+        return records
+
+    @property
+    def order_by(self):
+        """
+        The columns pages of this entity are ordered by
+        :return:
+        """
+        return self.__order_by__ or self.__keys__
+
+    def encode_cursor(self, record):
+        """
+        Builds the opaque page cursor pointing just past `record`
+        :param record: The last record of a page
+        :return: A URL-safe string
+        """
+        values = [record[column] for column in self.order_by]
+        values = [value.isoformat() if isinstance(value, date) else value for value in values]
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """
+        Reads the ordering column values back out of a page cursor
+        :param cursor: A cursor built by `encode_cursor`
+        :return: A list of values, one per ordering column
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise InvalidPage("Invalid page cursor")
+        if not isinstance(values, list) or len(values) != len(self.order_by):
+            raise InvalidPage("Invalid page cursor")
+        return values
 
     def create(self, **vals):
         """
@@ -144,23 +732,159 @@ class DbEntity(object):
         :return:
         """
         self.data.update(vals)
-        vals = [column for column in self.__columns__ if
-                column not in self.__keys__ and self.data[column] is not None]
-        values = [self.prep_for_query(value)[1] for key, value in self.data.iteritems() if
-                  key in vals and value is not None]
-        placeholders = ", ".join(["%s" for _ in range(len(values))])
-
-        sql = "INSERT INTO {table} ({columns}) VALUES ({placeholders})".format(table=self.__table__,
-                                                                               columns=", ".join(vals),
-                                                                               placeholders=placeholders)
+        self.data.update(self.bulk_create([self.data])[0])
+
+    def bulk_save(self, records):
+        """
+        Create or update many records at once. Records holding a value for the
+        primary key update the existing record with that key, the others are
+        created as new records (see `bulk_update` and `bulk_create`).
+        :param records: A list of dicts mapping column names to values. Keys that
+        are not columns of the table are kept in the returned records but not written
+        :return: A list of the saved records in the same order as `records`
+        """
+        key = self.__keys__[0]
+        records = [dict(record, **{key: self.key_value(record[key])}) if record.get(key, None) else record
+                   for record in records]
+        updates = [record for record in records if record.get(key, None) is not None]
+        creates = [record for record in records if record.get(key, None) is None]
+        updated = iter(self.bulk_update(updates))
+        created = iter(self.bulk_create(creates))
+        return [next(updated) if record.get(key, None) is not None else next(created) for record in records]
+
+    def key_value(self, value):
+        """
+        Converts a primary key value from a payload, such as the string "1",
+        to the type of the key column, so it matches the keys read from the table
+        :param value: The value
+        :return: The converted value. Raises an InvalidRecord error if it cannot be converted
+        """
+        kind = self.__columns__[self.__keys__[0]]
+        try:
+            if isinstance(value, bool) or (isinstance(value, float) and value != int(value)):
+                raise ValueError(value)
+            return kind(value)
+        except (TypeError, ValueError):
+            raise InvalidRecord("{} is not a valid {}".format(value, self.__keys__[0]))
+
+    def bulk_create(self, records):
+        """
+        Create many new records with multi-row INSERT statements, one per set of
+        columns given (and per BULK_CHUNK_SIZE records). Null values are left out
+        so the columns get their defaults, just like `create`. The generated ids are
+        read back from the cursor and stored in the returned records.
+        :param records: A list of dicts mapping column names to values
+        :return: A list of the created records, each holding its new id
+        """
+        meta = self.metadata
+        key = self.__keys__[0]
+        created = []
+        groups = OrderedDict()
+        for record in records:
+            row = meta.empty_row()
+            row.update(record)
+            columns = tuple(column for column in meta.columns if column not in self.__keys__ and row[column] is not None)
+            groups.setdefault(columns, []).append(row)
+            created.append(row)
+
+        dialect = dialect_of(g.db)
         cursor = g.db.cursor()
-        cursor.execute(sql, tuple(values))
-        self.save()
-        cursor.execute("SELECT MAX({key}) AS id FROM {table} LIMIT 1".format(key=self.__keys__[0],
-                                                                             table=self.__table__))
-        self.data[self.__keys__[0]] = cursor.fetchone()['id']
+        for columns, rows in groups.items():
+            for chunk in chunked(rows, dialect.batch_size(len(columns), BULK_CHUNK_SIZE)):
+                sql = compiled((self.__table__, "insert", columns, len(chunk)),
+                               lambda: "INSERT INTO {table} ({columns}) VALUES {rows}".format(
+                                   table=self.__table__,
+                                   columns=", ".join(columns),
+                                   rows=", ".join(["({})".format(placeholders(len(columns)))] * len(chunk))))
+                cursor.execute(sql, tuple(self.prep_for_query(row[column])[1] for row in chunk for column in columns))
+                for row, id in zip(chunk, dialect.inserted_ids(cursor, len(chunk))):
+                    row[key] = id
         cursor.close()
-        self.save()
+        self.save_keys([row[key] for row in created])
+
+        return created
+
+    def bulk_update(self, records):
+        """
+        Update many existing records at once. The current records are read (and
+        locked) with one SELECT, the given values are laid over them, and the result
+        is written back with multi-row upserts (INSERT ... ON DUPLICATE KEY UPDATE on MySQL).
+        Like `flush`, null values leave the stored value alone. Raises an InvalidRecord
+        error for a key that is not a valid key value, and a RecordNotFound error, before
+        anything is written, if any key does not exist.
+        :param records: A list of dicts mapping column names to values, each holding a primary key
+        :return: A list of the updated records
+        """
+        meta = self.metadata
+        key = self.__keys__[0]
+        ids = [self.key_value(record[key]) for record in records]
+        dialect = dialect_of(g.db)
+        cursor = g.db.cursor()
+        existing = dict()
+        for chunk in chunked(list(OrderedDict.fromkeys(ids)),
+                             dialect.batch_size(1, BULK_CHUNK_SIZE)):
+            sql = compiled((self.__table__, "lock", dialect.name, len(chunk)),
+                           lambda: "SELECT * FROM {table} WHERE {key} IN ({placeholders}){lock}".format(
+                               table=self.__table__,
+                               key=key,
+                               placeholders=placeholders(len(chunk)),
+                               lock=dialect.lock_rows))
+            cursor.execute(sql, tuple(chunk))
+            existing.update((row[key], row) for row in cursor.fetchall())
+        missing = [id for id in OrderedDict.fromkeys(ids) if id not in existing]
+        if missing:
+            cursor.close()
+            raise RecordNotFound(self.__table__, missing)
+
+        updated = []
+        stored = []
+        for id, record in zip(ids, records):
+            current = existing[id]
+            row = meta.empty_row()
+            row.update(current)
+            row.update(record)
+            row[key] = id
+            stored.append([self.prep_for_query(row[column] if row[column] is not None else current[column])[1]
+                           for column in meta.columns])
+            updated.append(row)
+
+        upsert = dialect.upsert(self.__keys__, [column for column in meta.columns if column not in self.__keys__])
+        for chunk in chunked(stored, dialect.batch_size(len(meta.columns), BULK_CHUNK_SIZE)):
+            sql = compiled((self.__table__, "upsert", dialect.name, len(chunk)),
+                           lambda: "INSERT INTO {table} ({columns}) VALUES {rows} {upsert}".format(
+                               table=self.__table__,
+                               columns=", ".join(meta.columns),
+                               rows=", ".join(["({})".format(placeholders(len(meta.columns)))] * len(chunk)),
+                               upsert=upsert))
+            cursor.execute(sql, tuple(value for row in chunk for value in row))
+        cursor.close()
+        self.save_keys(existing)
+
+        return updated
+
+    def set_relations(self, records, relation):
+        """
+        Replace the links of a many-to-many relation (declared in __relations__)
+        for a list of records. Each record holds the list of related ids to link
+        under the relation name; once written, the ids are swapped for the related
+        records themselves. Raises a TypeError, before anything is written, if any
+        record holds something other than a list of integers.
+        :param records: A list of dicts representing records of this entity
+        :param relation: The name of the relation to set
+        :return: The same list of records, each holding its related records
+        """
+        rel = self.__relations__.get(relation, None)
+        if not isinstance(rel, ManyToMany):
+            raise TypeError("Only many-to-many relations can be set")
+        for record in records:
+            if not isinstance(record[relation], list):
+                raise TypeError("Attempting to set {}.{} property with a non-list object".format(
+                    type(self).__name__, relation))
+            if not all(type(x) == int for x in record[relation]):
+                raise TypeError("Non-integers being passed to {}.{}".format(type(self).__name__, relation))
+        rel.replace(relation, records, self.__keys__[0])
+        self.save_keys([record[self.__keys__[0]] for record in records], rel.through)
+        return self.load_relations(records, relation)
 
     def __getitem__(self, item):
         """
@@ -198,12 +922,45 @@ class DbEntity(object):
             value = value.strftime('%Y-%m-%d')
         return '%s', value
 
-    def save(self):
+    def query_value(self, value):
+        """
+        The query parameter for a value, see `prep_for_query`
+        :param value:
+        :return:
+        """
+        return self.prep_for_query(value)[1]
+
+    def save(self, *tables):
         """
-        Flushes changes done by the cursor to the database
+        Marks the end of a write. Writes are committed once per request when
+        the request finishes successfully (see app.end_transaction), so this
+        only commits right away when the request runs in autocommit mode
+        :param tables: The tables written to. Defaults to this entity's table
         :return:
         """
-        g.db.commit()
+        mark_changed(*(tables or [self.__table__]))
+        self.commit_autocommitted()
+
+    def save_keys(self, ids, table=None):
+        """
+        Like `save`, for a write to the rows of a table with the given
+        primary keys only (see versions.mark_keys_changed)
+        :param ids: The primary keys of the rows written. For an association table,
+        the keys of the owning records whose links were replaced
+        :param table: The table written to. Defaults to this entity's table
+        :return:
+        """
+        mark_keys_changed(table or self.__table__, ids)
+        self.commit_autocommitted()
+
+    def commit_autocommitted(self):
+        """
+        Commits and publishes the writes made so far if the request runs in autocommit mode
+        :return:
+        """
+        if getattr(g, 'autocommit', False):
+            g.db.commit()
+            publish_changes()
 
     def flush(self):
         """
@@ -213,17 +970,16 @@ class DbEntity(object):
         """
         columns = [column for column in self.__columns__ if
                    column not in self.__keys__ and self.data[column] is not None]
-        values = [self.prep_for_query(value)[1] for key, value in self.data.iteritems() if
-                  key in columns and value is not None]
-        placeholders = ", ".join("{}=%s".format(column) for column in columns)
+        values = [self.query_value(self.data[column]) for column in columns]
         key = self.__keys__[0]
-        key_value = self.prep_for_query(self.data[key])[1]
-        sql = "UPDATE {table} SET {placeholders} WHERE {key}={key_value}".format(table=self.__table__,
-                                                                                 placeholders=placeholders,
-                                                                                 key=key,
-                                                                                 key_value=key_value)
+        key_value = self.query_value(self.data[key])
+        sql = compiled((self.__table__, "flush", tuple(columns)),
+                       lambda: "UPDATE {table} SET {assignments} WHERE {key}=%s".format(
+                           table=self.__table__,
+                           assignments=", ".join("{}=%s".format(column) for column in columns),
+                           key=key))
         cursor = g.db.cursor()
-        cursor.execute(sql, tuple(values))
+        cursor.execute(sql, tuple(values) + (key_value,))
         cursor.close()
         self.save()
 
@@ -240,6 +996,9 @@ class Food(DbEntity):
     __foreign_keys__ = {
         "fk_nfact_id": "nutritional_fact.nfact_id"
     }
+    __relations__ = {
+        "nutrition": ManyToOne("fk_nfact_id", "nutritional_fact.nfact_id")
+    }
 
     def __init__(self):
         DbEntity.__init__(self)
@@ -252,11 +1011,7 @@ class Food(DbEntity):
         finds the nutritional fact by the current foreign key and returns it
         :return:
         """
-        if not self.data.get('fk_nfact_id', None):
-            self.data['nutrition'] = {}
-        else:
-            self.data['nutrition'] = NutritionalFact().find_by_id(self.data['fk_nfact_id'])
-
+        self.load_relations([self.data], 'nutrition')
         return self.data['nutrition']
 
     @nutrition.setter
@@ -273,10 +1028,12 @@ class Food(DbEntity):
             raise TypeError("Attempting to set Food.nutrition with a non-dict object")
         if len(nutrition_facts) == 0 and self.data.get('fk_nfact_id', None):
             cursor = g.db.cursor()
-            cursor.execute("DELETE FROM mongoose.nutritional_fact WHERE nfact_id=%s", (self.data['fk_nfact_id']))
+            cursor.execute("DELETE FROM {table} WHERE {key}=%s".format(table=NutritionalFact.__table__,
+                                                                       key=NutritionalFact.__keys__[0]),
+                           (self.data['fk_nfact_id'],))
             self.data['nutrition'] = {}
             self.data['fk_nfact_id'] = None
-            self.save()
+            self.save(*cascaded(NutritionalFact.__table__))
             cursor.close()
         else:
             nfact = NutritionalFact()
@@ -312,6 +1069,9 @@ class Recipe(DbEntity):
         "category": ('entree', 'appetizer', 'dessert')
     }
     __keys__ = ["rec_id"]
+    __relations__ = {
+        "ingredients": ManyToMany("food.food_id", through="ingredients", local="recipe_id", remote="food_id")
+    }
 
     def __init__(self):
         DbEntity.__init__(self)
@@ -323,15 +1083,7 @@ class Recipe(DbEntity):
         update the internal cache to hold the ingredients
         :return:
         """
-        cursor = g.db.cursor()
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.food\n"
-            "WHERE food_id IN (SELECT food_id\n"
-            "                  FROM mongoose.ingredients\n"
-            "                  WHERE recipe_id = %s)",
-            (self.id,))
-        self.data['ingredients'] = cursor.fetchall()
+        self.load_relations([self.data], 'ingredients')
         return self.data['ingredients']
 
     @ingredients.setter
@@ -346,29 +1098,9 @@ class Recipe(DbEntity):
         ingredients for this recipe
         :return:
         """
-        if not isinstance(ingredient_ids, list):
-            raise TypeError("Attempting to set Recipe.ingredients property with a non-list object")
-        if len(ingredient_ids) > 0 and not all(type(x) == int for x in ingredient_ids):
-            raise TypeError("Non-integers being passed to Recipe.ingredients")
-        cursor = g.db.cursor()
-        # clear out the cached recipe objects ids
-        self.data['ingredients'] = []
-        # Delete the recipe-to-menu records
-        cursor.execute("DELETE FROM mongoose.ingredients WHERE recipe_id=%s", (self.id,))
-        self.save()
-        # insert the new associations if they are there
-        if len(ingredient_ids) > 0:
-            cursor.executemany("INSERT INTO mongoose.ingredients(recipe_id, food_id) VALUES (%s, %s)",
-                               [(self.id, food_id) for food_id in ingredient_ids])
-            self.save()
-            # rebuild the cache
-            cursor.execute(
-                "SELECT * FROM mongoose.food WHERE food_id IN ({placeholders})".format(
-                    placeholders=", ".join(["%s" for _ in range(len(ingredient_ids))])),
-                tuple(ingredient_ids))
-            self.data['ingredients'] = cursor.fetchall()
-        cursor.close()
-        self.save()
+        record = {self.__keys__[0]: self.id, 'ingredients': ingredient_ids}
+        self.set_relations([record], 'ingredients')
+        self.data['ingredients'] = record['ingredients']
 
 
 class Menu(DbEntity):
@@ -379,6 +1111,10 @@ class Menu(DbEntity):
         "date": date
     }
     __keys__ = ["id"]
+    __order_by__ = ["date", "id"]
+    __relations__ = {
+        "recipes": ManyToMany("recipes.rec_id", through="serves", local="menu_id", remote="recipe_id")
+    }
 
     def __init__(self):
         DbEntity.__init__(self)
@@ -390,17 +1126,7 @@ class Menu(DbEntity):
         caches them in the internal cache
         :return:
         """
-        cursor = g.db.cursor()
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.recipes\n"
-            "WHERE rec_id IN (SELECT recipe_id\n"
-            "                 FROM mongoose.serves\n"
-            "                 WHERE menu_id = %s)",
-            (self.id,))
-        self.data['recipes'] = cursor.fetchall()
-        cursor.close()
-        self.save()
+        self.load_relations([self.data], 'recipes')
         return self.data['recipes']
 
     @recipes.setter
@@ -417,28 +1143,46 @@ class Menu(DbEntity):
         associations.
         :return:
         """
-        if not isinstance(recipe_ids, list):
-            raise TypeError("Attempting to set Menu.recipes property with a non-list object")
-        if not all(type(x) == int for x in recipe_ids):
-            raise TypeError("Non-integers being passed to Menu.recipes")
-        cursor = g.db.cursor()
-        # clear out the cached recipe objects ids
-        self.data['recipes'] = []
-        # Delete the recipe-to-menu records
-        cursor.execute("DELETE FROM mongoose.serves WHERE menu_id=%s", (self.id,))
-        self.save()
-        if len(recipe_ids) > 0:
-            # insert the new associations
-            cursor.executemany("INSERT INTO mongoose.serves(menu_id, recipe_id) VALUES (%s, %s)",
-                               [(self.id, recipe_id) for recipe_id in recipe_ids])
-            self.save()
-            # rebuild the cache
-            cursor.execute(
-                "SELECT * FROM mongoose.recipes WHERE rec_id IN ({placeholders})".format(
-                    placeholders=", ".join(["%s" for _ in range(len(recipe_ids))])),
-                tuple(recipe_ids))
-
-            self.data['recipes'] = cursor.fetchall()
+        record = {self.__keys__[0]: self.id, 'recipes': recipe_ids}
+        self.set_relations([record], 'recipes')
+        self.data['recipes'] = record['recipes']
 
+    def nutrition_between(self, begin, end, columns):
+        """
+        Read the nutritional facts of every food the menus between two dates
+        (inclusive) serve, with one query joining the menus to their recipes,
+        ingredients, food and nutritional facts. Each food counts once per
+        recipe and menu, like the relations of `load_relations`
+        :param begin: The first date
+        :param end: The last date
+        :param columns: The nutritional_fact columns to read
+        :return: A list of (date, time_of_day, food_group, <columns>...) tuples, with 0 for
+        null columns. The menus serving no food with nutritional facts have tuples holding
+        None for the food group and 0 for every column
+        """
+        cursor = dialect_of(g.db).tuple_cursor(g.db)
+        cursor.execute(self.nutrition_sql(columns), (self.query_value(begin), self.query_value(end)))
+        rows = [row[3:] for row in cursor.fetchall()]
         cursor.close()
-        self.save()
+        return rows
+
+    @staticmethod
+    def nutrition_sql(columns):
+        """
+        :param columns: See `nutrition_between`
+        :return: The statement `nutrition_between` runs, taking the two dates
+        """
+        return compiled(("menu", "nutrition_between", tuple(columns)),
+                        lambda: ("SELECT DISTINCT menu.id, serves.recipe_id, food.food_id, menu.date, menu.time_of_day, "
+                                 "nutritional_fact.food_group, {columns}\n"
+                                 "FROM menu\n"
+                                 "LEFT JOIN serves ON serves.menu_id = menu.id\n"
+                                 "LEFT JOIN ingredients ON ingredients.recipe_id = serves.recipe_id\n"
+                                 "LEFT JOIN food ON food.food_id = ingredients.food_id\n"
+                                 "LEFT JOIN nutritional_fact ON nutritional_fact.nfact_id = food.fk_nfact_id\n"
+                                 "WHERE menu.date BETWEEN %s AND %s").format(
+                            columns=", ".join("COALESCE(nutritional_fact.{}, 0)".format(column) for column in columns)))
+
+
+registry.register(Food, NutritionalFact, Recipe, Menu)
+register_records(Food, NutritionalFact, Recipe, Menu)
@@ -0,0 +1,86 @@
+from bisect import bisect_left, bisect_right, insort
+
+from flask import current_app
+
+from cache import detached
+from indexes import TableIndex, cursor_id
+
+
+class FridgeIndex(TableIndex):
+    """
+    The food records in the fridge, kept in memory by each worker (see
+    indexes.TableIndex) and sorted by id, so /fridge/ pages are served
+    without querying the database
+    """
+
+    def __init__(self, entity, interval=60):
+        super(FridgeIndex, self).__init__(entity, interval)
+        self._ids = []
+        self._records = dict()
+
+    def page(self, food, limit=None, after=None):
+        """
+        The food in the fridge, a page at a time like `DbEntity.all`
+        :param food: The Food entity to set the following page's cursor on
+        :param limit: See `DbEntity.all`
+        :param after: See `DbEntity.all`
+        :return: A list of food records
+        """
+        if not self.usable():
+            return query(food, limit, after)
+        with self._lock:
+            ids, records = self._ids, self._records
+            start = bisect_right(ids, cursor_id(food, after)) if after is not None else 0
+            end = start + limit + 1 if limit is not None else len(ids)
+            page = [detached(records[id]) for id in ids[start:end]]
+        return food.paginate(page, limit)
+
+    def records(self):
+        return query(self.entity())
+
+    def load(self, records):
+        key = self.entity.__keys__[0]
+        self._records = dict((record[key], record) for record in records)
+        self._ids = sorted(self._records)
+
+    def update(self, table, id, record):
+        if record is not None and record["in_fridge"]:
+            if id not in self._records:
+                insort(self._ids, id)
+            self._records[id] = record
+        elif self._records.pop(id, None) is not None:
+            del self._ids[bisect_left(self._ids, id)]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def fridge_index():
+    """
+    The FridgeIndex of the running app, or None if it is turned off
+    :return:
+    """
+    return current_app.extensions.get('fridge_index', None)
+
+
+def in_fridge(food, limit=None, after=None):
+    """
+    The food in the fridge, from the FridgeIndex when it is turned on
+    :param food: See `FridgeIndex.page`
+    :param limit: See `DbEntity.all`
+    :param after: See `DbEntity.all`
+    :return: A list of food records
+    """
+    index = fridge_index()
+    if index is None:
+        return query(food, limit, after)
+    return index.page(food, limit, after)
+
+
+def query(food, limit=None, after=None):
+    """
+    Reads the food in the fridge from the database
+    :return: A list of food records
+    """
+    return food.all(comparisons={"in_fridge": ["=", True]}, limit=limit, after=after)
+
@@ -1 +1,6 @@
-env/bin/gunicorn --name mongoose --bind 127.0.0.1:9001 -w 2 --reload --log-file /home/ubuntu/gunicorn.log app:app &
\ No newline at end of file
+# The metrics of the previous run's workers are dropped on every restart, see metrics.RequestMetrics
+rm -rf "${METRICS_DIR:-/tmp/mongoose-metrics}"
+# WORKER_CLASS=gevent (pip install gevent) serves up to WORKER_CONNECTIONS requests per worker
+# at once, each yielding to the others while it waits on MySQL. Size the connection pool to match
+env/bin/gunicorn --name mongoose --bind 127.0.0.1:9001 -w 2 -k "${WORKER_CLASS:-sync}" \
+    --worker-connections "${WORKER_CONNECTIONS:-100}" --reload --log-file /home/ubuntu/gunicorn.log app:app &
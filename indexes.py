@@ -0,0 +1,181 @@
+import threading
+import time
+
+from flask import g
+
+from entities import InvalidPage
+from versions import table_versions
+
+
+class TableIndex(object):
+    """
+    The base of the in-memory indexes each worker keeps over a few tables, such
+    as fridge.FridgeIndex, search.NameIndex and cookable.CookableIndex.
+
+    An index is loaded with a few queries and tagged with the versions of its
+    tables (see versions.TableVersions). Writes published by this worker whose
+    rows are known (see versions.mark_keys_changed) only mark those rows, which
+    are read again on the next lookup. Any other change to the tables, such as a
+    write made through another worker or a row a trigger deleted or updated,
+    leaves the index on old versions, and it is then loaded again in full. It is
+    also loaded again every `interval` seconds, to reconcile with writes made to
+    the database outside of the app.
+
+    Subclasses implement `records`, `load`, `update` and `__len__`, and `reread`
+    when they index more than the table of their entity. `load` and `update` are
+    called with the index lock held, which lookups also take.
+    """
+
+    def __init__(self, entity, interval=60, tables=None):
+        """
+        :param entity: The DbEntity class of the table indexed
+        :param interval: The most seconds between two full loads. 0 or less loads on every lookup
+        :param tables: The tables read. Defaults to the entity's table
+        """
+        self.entity = entity
+        self.tables = list(tables or [entity.__table__])
+        self.interval = interval
+        self.loads = 0
+        self.refreshes = 0
+        self._dirty = dict()
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def usable(self):
+        """
+        Bring the index up to date for the current request. The request
+        has to query the database instead if it has uncommitted writes to the
+        tables, or reads from a snapshot older than the latest one
+        :return: Whether the index holds what the request would read from the database
+        """
+        changed = getattr(g, 'changed_tables', None)
+        if changed and not changed.isdisjoint(self.tables):
+            return False
+        versions = table_versions()
+        current = (versions.epoch,) + versions.get(*self.tables)
+        snapshot = getattr(g, 'snapshot_versions', None)
+        if snapshot and tuple(snapshot[table] for table in self.tables) != current[1:]:
+            return False
+        self.sync(current)
+        with self._lock:
+            # A write may have been published while the index was being read
+            return self._version == current and not self._dirty
+
+    def sync(self, current):
+        """
+        Bring the index up to the versions of its tables, reading the rows
+        marked by `published` or, when that is not enough, every row
+        :param current: The epoch followed by the version of each table
+        :return:
+        """
+        with self._lock:
+            if self._version != current or time.time() - self._loaded_at >= self.interval:
+                dirty = None
+            elif self._dirty:
+                dirty = self._dirty
+                self._dirty = dict()
+            else:
+                return
+
+        if dirty is None:
+            records = self.records()
+            with self._lock:
+                self.load(records)
+                self._dirty = dict()
+                self._version = current
+                self._loaded_at = time.time()
+                self.loads += 1
+            return
+
+        found = dict((table, self.reread(table, ids)) for table, ids in dirty.items())
+        with self._lock:
+            if self._version != current:
+                return
+            for table, ids in dirty.items():
+                for id in ids:
+                    self.update(table, id, found[table].get(id, None))
+            self.refreshes += 1
+
+    def published(self, versions, keys):
+        """
+        A versions listener: marks the rows written by a request of
+        this worker, or leaves the index to be loaded again in full
+        :param versions: A dict of the tables written to their new versions
+        :param keys: A dict of the tables written to the keys written, or None
+        :return:
+        """
+        written = [table for table in self.tables if table in versions]
+        if not written:
+            return
+        epoch = table_versions().epoch
+        with self._lock:
+            if self._version is None or self._version[0] != epoch:
+                return
+            version = list(self._version)
+            for i, table in enumerate(self.tables):
+                if table in versions:
+                    if keys[table] is None or version[i + 1] != versions[table] - 1:
+                        self._version = None
+                        return
+                    version[i + 1] = versions[table]
+            for table in written:
+                self._dirty.setdefault(table, set()).update(keys[table])
+            self._version = tuple(version)
+
+    def stats(self):
+        """
+        :return: A dict of counters, for /cache/stats/
+        """
+        with self._lock:
+            return {"size": len(self), "loads": self.loads, "refreshes": self.refreshes, "interval": self.interval}
+
+    def records(self):
+        """
+        Read everything the index holds from the database
+        :return: Anything `load` takes, usually a list of records
+        """
+        raise NotImplementedError
+
+    def load(self, records):
+        """
+        Replace the contents of the index
+        :param records: What `records` returned
+        :return:
+        """
+        raise NotImplementedError
+
+    def reread(self, table, ids):
+        """
+        Read the rows of one of the tables marked by `published`
+        :param table: The table name
+        :param ids: The keys marked
+        :return: A dict of key to record, leaving out the keys that were not found
+        """
+        return self.entity().find_many(sorted(ids))
+
+    def update(self, table, id, record):
+        """
+        Replace one record of the index
+        :param table: The table of the record
+        :param id: The key of the record
+        :param record: The record from `reread`, or None if it was not found
+        :return:
+        """
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+def cursor_id(entity, after):
+    """
+    The key a page cursor of an entity ordered by its key points just past
+    :param entity: A DbEntity
+    :param after: A cursor from `entity.next_page`
+    :return:
+    """
+    try:
+        return int(entity.decode_cursor(after)[0])
+    except (TypeError, ValueError):
+        raise InvalidPage("Invalid page cursor")
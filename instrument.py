@@ -0,0 +1,258 @@
+import json
+import logging
+import re
+import timeit
+
+from flask import g, request, current_app
+
+slow_query_log = logging.getLogger("mongoose.sql.slow")
+log = logging.getLogger("mongoose.sql")
+
+# Called with the RequestTrace of every request once the request is over,
+# including the body of streamed responses
+listeners = []
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER = re.compile(r"%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROWS = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+
+
+class TooManyQueries(Exception):
+    """
+    Raised in testing mode when a request runs more statements than its cap
+    """
+    pass
+
+
+def normalize(sql):
+    """
+    Reduces a statement to its shape, so statements that only differ in their
+    values or in the length of their IN lists and VALUES rows read the same
+    :param sql: A statement
+    :return:
+    """
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PARAMETER.sub("?", sql)
+    sql = _LIST.sub("(...)", sql)
+    sql = _ROWS.sub("(...), ...", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+class Statement(object):
+    """
+    One statement run by a request
+    """
+
+    def __init__(self, sql, duration=0.0, rows=None):
+        """
+        :param sql: The normalized statement
+        :param duration: Seconds spent running it and reading its rows
+        :param rows: The number of rows it returned or changed
+        """
+        self.sql = sql
+        self.duration = duration
+        self.rows = rows
+
+
+class RequestTrace(object):
+    """
+    The statements run by one request and where the request's time went
+    """
+
+    def __init__(self, cap=None):
+        """
+        :param cap: The most statements the request should run, or None
+        """
+        self.started = timeit.default_timer()
+        self.finished = None
+        self.statements = []
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.cap = cap
+        self.status = None
+        # The URL rule and the Flask endpoint name of the view
+        self.endpoint = None
+        self.view = None
+        # The size of the response body, once known
+        self.size = None
+        self.exception = False
+        self._warned = False
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        return (self.finished or timeit.default_timer()) - self.started
+
+    def record(self, sql):
+        """
+        Adds a statement, enforcing the cap
+        :param sql: The statement as sent
+        :return: The new Statement
+        """
+        statement = Statement(normalize(sql))
+        self.statements.append(statement)
+        if self.cap is not None and self.count > self.cap:
+            self._over_cap()
+        return statement
+
+    def spent(self, statement, seconds):
+        statement.duration += seconds
+        self.db_time += seconds
+
+    def server_timing(self):
+        """
+        The value of the Server-Timing header for the work done so far
+        :return:
+        """
+        return 'db;dur={:.3f};desc="{} queries", serialize;dur={:.3f}, total;dur={:.3f}'.format(
+            self.db_time * 1000, self.count, self.serialize_time * 1000, self.duration * 1000)
+
+    def _over_cap(self):
+        message = "{} {} ran {} statements, more than its cap of {}:\n{}".format(
+            request.method, request.path, self.count, self.cap,
+            "\n".join(s.sql for s in self.statements))
+        if current_app.testing:
+            raise TooManyQueries(message)
+        if not self._warned:
+            self._warned = True
+            log.warning(message)
+
+
+class TracedConnection(object):
+    """
+    Wraps a connection so every statement run through its cursors, and every
+    commit and rollback, is timed and recorded in a RequestTrace
+    """
+
+    def __init__(self, connection, trace):
+        self.raw = connection
+        self.trace = trace
+
+    def cursor(self, *args):
+        return TracedCursor(self.raw.cursor(*args), self.trace)
+
+    def commit(self):
+        self._timed("COMMIT", self.raw.commit)
+
+    def rollback(self):
+        self._timed("ROLLBACK", self.raw.rollback)
+
+    def _timed(self, sql, call):
+        statement = self.trace.record(sql)
+        start = timeit.default_timer()
+        try:
+            call()
+        finally:
+            self.trace.spent(statement, timeit.default_timer() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class TracedCursor(object):
+    """
+    A cursor recording the statements it runs in a RequestTrace. Time spent
+    reading rows, e.g. while iterating a server-side cursor, counts as time
+    spent on the statement that returned them
+    """
+
+    def __init__(self, cursor, trace):
+        self.raw = cursor
+        self.trace = trace
+        self._statement = None
+
+    def execute(self, sql, args=None):
+        self._statement = self.trace.record(sql)
+        start = timeit.default_timer()
+        try:
+            ret = self.raw.execute(sql, args)
+        finally:
+            self.trace.spent(self._statement, timeit.default_timer() - start)
+        self._statement.rows = self.raw.rowcount if self.raw.rowcount >= 0 else None
+        return ret
+
+    def executemany(self, sql, args):
+        self._statement = self.trace.record(sql)
+        start = timeit.default_timer()
+        try:
+            ret = self.raw.executemany(sql, args)
+        finally:
+            self.trace.spent(self._statement, timeit.default_timer() - start)
+        self._statement.rows = self.raw.rowcount if self.raw.rowcount >= 0 else None
+        return ret
+
+    def fetchone(self):
+        return self._timed(self.raw.fetchone)
+
+    def fetchall(self):
+        rows = self._timed(self.raw.fetchall)
+        if self._statement is not None:
+            self._statement.rows = len(rows)
+        return rows
+
+    def __iter__(self):
+        rows = iter(self.raw)
+        count = 0
+        while True:
+            start = timeit.default_timer()
+            try:
+                row = next(rows)
+            except StopIteration:
+                break
+            finally:
+                if self._statement is not None:
+                    self.trace.spent(self._statement, timeit.default_timer() - start)
+            count += 1
+            yield row
+        if self._statement is not None:
+            self._statement.rows = count
+
+    def _timed(self, call):
+        start = timeit.default_timer()
+        try:
+            return call()
+        finally:
+            if self._statement is not None:
+                self.trace.spent(self._statement, timeit.default_timer() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def current_trace():
+    """
+    The RequestTrace of the current request, or None if instrumentation is off
+    :return:
+    """
+    return getattr(g, 'sql_trace', None)
+
+
+def finish_trace(trace):
+    """
+    Closes the trace of a finished request: statements slower than SLOW_QUERY_MS
+    are written to the slow-query log, one JSON object per line, and the trace
+    is handed to every function in `listeners`
+    :param trace: The request's RequestTrace
+    :return:
+    """
+    trace.finished = timeit.default_timer()
+    threshold = current_app.config['SLOW_QUERY_MS'] / 1000.0
+    for statement in trace.statements:
+        if statement.duration >= threshold:
+            slow_query_log.warning(json.dumps({
+                "duration_ms": round(statement.duration * 1000, 3),
+                "rows": statement.rows,
+                "sql": statement.sql,
+                "method": request.method,
+                "endpoint": trace.endpoint,
+                "path": request.path,
+            }, sort_keys=True))
+    for listener in listeners:
+        listener(trace)
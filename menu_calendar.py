@@ -0,0 +1,163 @@
+from bisect import bisect_left, bisect_right, insort
+
+from flask import current_app
+
+from cache import detached
+from entities import InvalidPage
+from indexes import TableIndex
+from utils import as_date
+
+
+class CalendarIndex(TableIndex):
+    """
+    The menus, kept in memory by each worker (see indexes.TableIndex) and
+    sorted by date and id, the order their pages follow, so the menus of a
+    date or a range of dates are found by bisection. The ids of the menus of
+    each (date, time of day) are also kept, for /menu/<time_of_day>/<date>/
+    """
+
+    def __init__(self, entity, interval=60):
+        super(CalendarIndex, self).__init__(entity, interval)
+        self._entries = []
+        self._records = dict()
+        self._slots = dict()
+
+    def between(self, menu, begin, end, limit=None, after=None):
+        """
+        The menus between two dates (inclusive), a page at a time like `DbEntity.all`
+        :param menu: The Menu entity to set the following page's cursor on
+        :param begin: The first date
+        :param end: The last date
+        :param limit: See `DbEntity.all`
+        :param after: See `DbEntity.all`
+        :return: A list of menu records, ordered by date and id
+        """
+        if not self.usable():
+            return query(menu, begin, end, limit, after)
+        with self._lock:
+            entries = self._entries
+            start = bisect_left(entries, (begin,))
+            if after is not None:
+                start = max(start, bisect_right(entries, cursor_key(menu, after)))
+            stop = bisect_right(entries, (end, float("inf")))
+            if limit is not None:
+                stop = min(stop, start + limit + 1)
+            page = [detached(self._records[id]) for _, id in entries[start:stop]]
+        return menu.paginate(page, limit)
+
+    def at(self, menu, date, time_of_day):
+        """
+        The menus of a date and time of day
+        :param menu: A Menu entity
+        :param date: The date
+        :param time_of_day: One of the time_of_day values
+        :return: A list of menu records, ordered by id
+        """
+        if not self.usable():
+            return slot_query(menu, date, time_of_day)
+        with self._lock:
+            return [detached(self._records[id]) for id in self._slots.get((date, time_of_day), ())]
+
+    def records(self):
+        return self.entity().all()
+
+    def load(self, records):
+        key = self.entity.__keys__[0]
+        self._entries = []
+        self._records = dict()
+        self._slots = dict()
+        for record in records:
+            id, day = record[key], as_date(record["date"])
+            self._records[id] = record
+            self._entries.append((day, id))
+            self._slots.setdefault((day, record["time_of_day"]), []).append(id)
+        self._entries.sort()
+        for ids in self._slots.values():
+            ids.sort()
+
+    def update(self, table, id, record):
+        old = self._records.pop(id, None)
+        if old is not None:
+            day = as_date(old["date"])
+            del self._entries[bisect_left(self._entries, (day, id))]
+            slot = self._slots[(day, old["time_of_day"])]
+            del slot[bisect_left(slot, id)]
+            if not slot:
+                del self._slots[(day, old["time_of_day"])]
+        if record is not None:
+            day = as_date(record["date"])
+            self._records[id] = record
+            insort(self._entries, (day, id))
+            insort(self._slots.setdefault((day, record["time_of_day"]), []), id)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cursor_key(menu, after):
+    """
+    The (date, id) entry a menu page cursor points just past
+    :param menu: A Menu entity
+    :param after: A cursor from `menu.next_page`
+    :return:
+    """
+    values = menu.decode_cursor(after)
+    try:
+        return as_date(values[0]), int(values[1])
+    except (TypeError, ValueError):
+        raise InvalidPage("Invalid page cursor")
+
+
+def calendar_index():
+    """
+    The CalendarIndex of the running app, or None if it is turned off
+    :return:
+    """
+    return current_app.extensions.get('calendar_index', None)
+
+
+def between(menu, begin, end, limit=None, after=None):
+    """
+    The menus between two dates (inclusive), from the CalendarIndex when it is turned on
+    :param menu: See `CalendarIndex.between`
+    :param begin: The first date
+    :param end: The last date
+    :param limit: See `DbEntity.all`
+    :param after: See `DbEntity.all`
+    :return: A list of menu records
+    """
+    index = calendar_index()
+    if index is None:
+        return query(menu, begin, end, limit, after)
+    return index.between(menu, begin, end, limit, after)
+
+
+def at(menu, date, time_of_day):
+    """
+    The menus of a date and time of day, from the CalendarIndex when it is turned on
+    :param menu: A Menu entity
+    :param date: The date
+    :param time_of_day: One of the time_of_day values
+    :return: A list of menu records
+    """
+    index = calendar_index()
+    if index is None:
+        return slot_query(menu, date, time_of_day)
+    return index.at(menu, date, time_of_day)
+
+
+def query(menu, begin, end, limit=None, after=None):
+    """
+    Reads the menus between two dates from the database
+    :return: A list of menu records
+    """
+    comparisons = {"date": ["=", begin]} if begin == end else {"date": ["BETWEEN", [begin, end]]}
+    return menu.all(comparisons=comparisons, limit=limit, after=after)
+
+
+def slot_query(menu, date, time_of_day):
+    """
+    Reads the menus of a date and time of day from the database
+    :return: A list of menu records
+    """
+    return menu.all(comparisons={"date": ["=", date], "time_of_day": ["=", time_of_day]})
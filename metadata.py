@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+
+from dialects import dialect_of
+from queries import statements
+
+
+class TableMetadata(object):
+    """
+    Column names (in table order), database types and key information
+    for one table, as reported by the database itself
+    """
+
+    def __init__(self, name, columns, types, keys, auto_increment=None):
+        """
+        :param name: The table name
+        :param columns: A list of column names in the order they are defined in the table
+        :param types: A dict mapping each column name to its database type, e.g. "decimal(6,2)"
+        :param keys: A list of the primary key columns
+        :param auto_increment: The auto-increment column of the table, if any
+        """
+        self.name = name
+        self.columns = list(columns)
+        self.types = dict(types)
+        self.keys = list(keys)
+        self.auto_increment = auto_increment
+
+    def empty_row(self):
+        """
+        A fresh record with every column set to null
+        :return:
+        """
+        return OrderedDict((column, None) for column in self.columns)
+
+    def __contains__(self, column):
+        return column in self.types
+
+
+class MetadataRegistry(object):
+    """
+    Process-wide cache of table metadata for the mapped entities. Every
+    registered table is introspected at once (a single query against
+    information_schema on MySQL) the first time any of them is needed, after which
+    looking up metadata does no I/O at all. Call `refresh` after running
+    a migration so the cache, and the compiled statements, pick up the
+    new shape of the tables.
+    """
+
+    def __init__(self):
+        self._tables = dict()
+        self._registered = []
+        self._lock = threading.Lock()
+
+    def register(self, *entities):
+        """
+        Register entity classes whose tables should be introspected
+        :param entities: DbEntity subclasses with a __table__ attribute
+        :return:
+        """
+        for entity in entities:
+            if entity.__table__ not in self._registered:
+                self._registered.append(entity.__table__)
+
+    def get(self, table, connection):
+        """
+        Get the metadata for a table, introspecting every registered table
+        through `connection` if they have not been loaded yet
+        :param table: The table name
+        :param connection: A DB-API connection to introspect with if needed
+        :return: The TableMetadata for the table
+        """
+        meta = self._tables.get(table, None)
+        if meta is None:
+            self.load(connection, [table])
+            meta = self._tables[table]
+        return meta
+
+    def load(self, connection, tables=None):
+        """
+        Introspect the registered tables (plus any extra `tables`) that
+        have not been loaded yet
+        :param connection: A DB-API connection to introspect with
+        :param tables: Additional table names to load
+        :return:
+        """
+        with self._lock:
+            wanted = [t for t in OrderedDict.fromkeys(self._registered + list(tables or [])) if t not in self._tables]
+            if wanted:
+                self._tables.update(self._introspect(connection, wanted))
+        missing = [t for t in tables or [] if t not in self._tables]
+        if missing:
+            raise LookupError("No such table(s): {}".format(", ".join(missing)))
+
+    def refresh(self, connection, tables=None):
+        """
+        Drop the cached metadata and introspect the tables again. Meant to
+        be called after a schema migration
+        :param connection: A DB-API connection to introspect with
+        :param tables: Only refresh these tables. Refreshes everything by default
+        :return:
+        """
+        with self._lock:
+            if tables is None:
+                self._tables.clear()
+            else:
+                for table in tables:
+                    self._tables.pop(table, None)
+        # The compiled statements may name columns that are gone now
+        statements.clear()
+        self.load(connection, tables)
+
+    @staticmethod
+    def _introspect(connection, tables):
+        rows = dialect_of(connection).columns(connection, tables)
+
+        found = OrderedDict()
+        for row in rows:
+            found.setdefault(row['TABLE_NAME'], []).append(row)
+
+        ret = dict()
+        for table, columns in found.items():
+            ret[table] = TableMetadata(
+                table,
+                [c['COLUMN_NAME'] for c in columns],
+                {c['COLUMN_NAME']: c['COLUMN_TYPE'] for c in columns},
+                [c['COLUMN_NAME'] for c in columns if c['COLUMN_KEY'] == 'PRI'],
+                next((c['COLUMN_NAME'] for c in columns if 'auto_increment' in c['EXTRA']), None))
+        return ret
+
+
+registry = MetadataRegistry()
@@ -0,0 +1,261 @@
+import errno
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+
+from flask import current_app
+
+# Upper bounds of the histogram buckets, in seconds and bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 1024, 8192, 65536, 524288, 4194304)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+# The endpoint label of requests that matched no route
+UNMATCHED = "unmatched"
+
+# Per-process values that only make sense while the process is alive
+PROCESS_GAUGES = ("pool_size", "pool_checked_out", "pool_overflow", "entity_cache_entries",
+                  "entity_cache_max_entries")
+# Per-process counters, which still count once their process has exited
+PROCESS_COUNTERS = ("entity_cache_hits", "entity_cache_misses", "entity_cache_evictions",
+                    "entity_cache_invalidations")
+
+# The counters kept for every endpoint, in the order they are laid out
+_ENDPOINT_FIELDS = ([("requests", status) for status in STATUS_CLASSES] +
+                    [("exceptions", None), ("duration_sum", None), ("size_sum", None),
+                     ("db_seconds", None), ("db_statements", None), ("serialize_seconds", None)] +
+                    [("duration_bucket", i) for i in range(len(LATENCY_BUCKETS) + 1)] +
+                    [("size_bucket", i) for i in range(len(SIZE_BUCKETS) + 1)])
+
+_SLOT = struct.Struct("d")
+_FILE = re.compile(r"^([0-9a-f]+)-(\d+)\.metrics$")
+
+
+class RequestMetrics(object):
+    """
+    Request counters and histograms per endpoint, shared by every process
+    serving the app. Like versions.TableVersions, they live in memory-mapped
+    files, but each process writes only to its own file in `directory`, so
+    recording a request takes no lock shared with other processes. The
+    /metrics endpoint sums up the files of every worker, so any worker can
+    answer a scrape. Counters of workers that have exited are kept, while
+    gauges are only read from workers still running.
+
+    Empty `directory` whenever the whole app is restarted, as the files of
+    exited workers are never removed.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Where the per-process files are kept. Created if it does not exist
+        """
+        self.directory = directory
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _mapped(self):
+        # The layout depends on the routes, so it is worked out on first use,
+        # once every view is registered. Map again after a fork, so each
+        # process writes to a file of its own
+        if self._map is None or self._pid != os.getpid():
+            endpoints = sorted(set(rule.endpoint for rule in current_app.url_map.iter_rules())) + [UNMATCHED]
+            width = len(_ENDPOINT_FIELDS) * _SLOT.size
+            self._offsets = {endpoint: i * width for i, endpoint in enumerate(endpoints)}
+            self._fields = {field: i * _SLOT.size for i, field in enumerate(_ENDPOINT_FIELDS)}
+            process = len(endpoints) * len(_ENDPOINT_FIELDS)
+            self._process = {name: (process + i) * _SLOT.size
+                             for i, name in enumerate(PROCESS_GAUGES + PROCESS_COUNTERS)}
+            self._endpoints = endpoints
+            self._size = (process + len(self._process)) * _SLOT.size
+            # Files written by a version of the app with other routes are left out
+            self._layout = hashlib.md5(repr((endpoints, _ENDPOINT_FIELDS, PROCESS_GAUGES, PROCESS_COUNTERS,
+                                             LATENCY_BUCKETS, SIZE_BUCKETS)).encode("utf-8")).hexdigest()[:12]
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            path = os.path.join(self.directory, "{}-{}.metrics".format(self._layout, os.getpid()))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < self._size:
+                    os.ftruncate(fd, self._size)
+                self._map = mmap.mmap(fd, self._size)
+            finally:
+                os.close(fd)
+            self._pid = os.getpid()
+        return self._map
+
+    def observe(self, endpoint, status, duration, size=None, db_seconds=0.0, db_statements=0,
+                serialize_seconds=0.0, exception=False):
+        """
+        Record a finished request
+        :param endpoint: The Flask endpoint name, or None if no route matched
+        :param status: The response status code, or None if the view raised
+        :param duration: Seconds spent on the request, including streaming its body
+        :param size: The size of the response body in bytes, or None if unknown
+        :param db_seconds: Seconds spent on statements
+        :param db_statements: The number of statements run
+        :param serialize_seconds: Seconds spent encoding JSON
+        :param exception: Whether the view raised an exception
+        :return:
+        """
+        status_class = STATUS_CLASSES[min(max((status or 500) // 100, 1), 5) - 1]
+        updates = [(("requests", status_class), 1), (("duration_sum", None), duration),
+                   (("duration_bucket", _bucket(LATENCY_BUCKETS, duration)), 1),
+                   (("db_seconds", None), db_seconds), (("db_statements", None), db_statements),
+                   (("serialize_seconds", None), serialize_seconds)]
+        if exception:
+            updates.append((("exceptions", None), 1))
+        if size is not None:
+            updates.append((("size_sum", None), size))
+            updates.append((("size_bucket", _bucket(SIZE_BUCKETS, size)), 1))
+        with self._lock:
+            mapped = self._mapped()
+            base = self._offsets.get(endpoint or UNMATCHED, None)
+            if base is None:
+                base = self._offsets[UNMATCHED]
+            fields = self._fields
+            for field, amount in updates:
+                offset = base + fields[field]
+                _SLOT.pack_into(mapped, offset, _SLOT.unpack_from(mapped, offset)[0] + amount)
+
+    def set_process(self, **values):
+        """
+        Store the current value of per-process gauges and counters
+        :param values: Names from PROCESS_GAUGES and PROCESS_COUNTERS, and their values
+        :return:
+        """
+        with self._lock:
+            mapped = self._mapped()
+            for name, value in values.items():
+                _SLOT.pack_into(mapped, self._process[name], value)
+
+    def collect(self):
+        """
+        Sum up the files of every process
+        :return: A tuple of ({endpoint: {field: value}}, {process value name: value}, live processes)
+        """
+        with self._lock:
+            self._mapped()
+        endpoints = {endpoint: dict.fromkeys(_ENDPOINT_FIELDS, 0.0) for endpoint in self._endpoints}
+        process = dict.fromkeys(PROCESS_GAUGES + PROCESS_COUNTERS, 0.0)
+        live = 0
+        for name in os.listdir(self.directory):
+            match = _FILE.match(name)
+            if not match or match.group(1) != self._layout:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as f:
+                    data = f.read(self._size)
+            except IOError:
+                continue
+            if len(data) < self._size:
+                continue
+            for endpoint, base in self._offsets.items():
+                fields = endpoints[endpoint]
+                for field, offset in self._fields.items():
+                    fields[field] += _SLOT.unpack_from(data, base + offset)[0]
+            alive = _alive(int(match.group(2)))
+            live += alive
+            for value, offset in self._process.items():
+                if alive or value in PROCESS_COUNTERS:
+                    process[value] += _SLOT.unpack_from(data, offset)[0]
+        return endpoints, process, live
+
+    def render(self):
+        """
+        The metrics of every process in the Prometheus text exposition format
+        :return:
+        """
+        endpoints, process, live = self.collect()
+        endpoints = sorted((endpoint, fields) for endpoint, fields in endpoints.items()
+                           if any(fields[("requests", status)] for status in STATUS_CLASSES))
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        def sample(name, labels, value):
+            lines.append("{}{{{}}} {}".format(name, ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels),
+                                              _number(value)))
+
+        def histogram(name, description, field, sum_field, buckets):
+            family(name, "histogram", description)
+            for endpoint, fields in endpoints:
+                total = 0.0
+                for i, bound in enumerate(buckets + (float("inf"),)):
+                    total += fields[(field, i)]
+                    sample(name + "_bucket", [("endpoint", endpoint), ("le", _number(bound))], total)
+                sample(name + "_sum", [("endpoint", endpoint)], fields[(sum_field, None)])
+                sample(name + "_count", [("endpoint", endpoint)], total)
+
+        family("mongoose_http_requests_total", "counter", "Requests answered, by endpoint and status class")
+        for endpoint, fields in endpoints:
+            for status in STATUS_CLASSES:
+                if fields[("requests", status)]:
+                    sample("mongoose_http_requests_total", [("endpoint", endpoint), ("status", status)],
+                           fields[("requests", status)])
+        family("mongoose_http_request_exceptions_total", "counter", "Requests whose view raised an exception")
+        for endpoint, fields in endpoints:
+            sample("mongoose_http_request_exceptions_total", [("endpoint", endpoint)], fields[("exceptions", None)])
+        histogram("mongoose_http_request_duration_seconds", "Time spent on requests, including streaming the body",
+                  "duration_bucket", "duration_sum", LATENCY_BUCKETS)
+        histogram("mongoose_http_response_size_bytes", "Size of response bodies",
+                  "size_bucket", "size_sum", SIZE_BUCKETS)
+        for name, field, description in (
+                ("mongoose_db_seconds_total", "db_seconds", "Time spent running statements and reading their rows"),
+                ("mongoose_db_statements_total", "db_statements", "Statements run, including BEGIN and COMMIT"),
+                ("mongoose_serialize_seconds_total", "serialize_seconds", "Time spent encoding JSON")):
+            family(name, "counter", description)
+            for endpoint, fields in endpoints:
+                sample(name, [("endpoint", endpoint)], fields[(field, None)])
+        family("mongoose_workers", "gauge", "Processes serving the app")
+        lines.append("mongoose_workers {}".format(live))
+        for name in PROCESS_GAUGES:
+            family("mongoose_" + name, "gauge", name.replace("_", " ").capitalize() + ", summed over the workers")
+            lines.append("mongoose_{} {}".format(name, _number(process[name])))
+        for name in PROCESS_COUNTERS:
+            family("mongoose_" + name + "_total", "counter", name.replace("_", " ").capitalize())
+            lines.append("mongoose_{}_total {}".format(name, _number(process[name])))
+        return "\n".join(lines) + "\n"
+
+
+def _bucket(buckets, value):
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            return i
+    return len(buckets)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def request_metrics():
+    """
+    The RequestMetrics of the running app, or None if metrics are turned off
+    :return:
+    """
+    return current_app.extensions.get('request_metrics', None)
@@ -0,0 +1,132 @@
+"""
+Applies the versioned schema migrations in resources/migrations to the
+database in config.Config, in order, skipping the ones already applied.
+
+Migrations are plain SQL files named <version>_<name>.sql. Every applied
+migration is recorded in the schema_migrations table together with a checksum
+of its file, and the runner refuses to continue if an applied migration has
+been edited since, as the database would no longer match the files.
+
+Usage: python migrate.py [--list]
+"""
+import hashlib
+import os
+import re
+import sys
+
+from config import Config
+from dialects import DIALECTS
+from metadata import registry
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "migrations")
+
+_FILE_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+class MigrationError(Exception):
+    pass
+
+
+def connect():
+    config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+    return DIALECTS[Config.DB_BACKEND].connect(config)
+
+
+def migrations(directory=MIGRATIONS_DIR):
+    """
+    Reads every migration file in a directory
+    :param directory: The directory holding the migration files
+    :return: A list of (version, name, checksum, sql) tuples ordered by version
+    """
+    found = []
+    for file_name in os.listdir(directory):
+        match = _FILE_NAME.match(file_name)
+        if not match:
+            continue
+        with open(os.path.join(directory, file_name), "rb") as f:
+            sql = f.read()
+        found.append((int(match.group(1)), match.group(2), hashlib.sha1(sql).hexdigest(), sql.decode('utf-8')))
+    found.sort()
+    versions = [m[0] for m in found]
+    if len(set(versions)) != len(versions):
+        raise MigrationError("Two migrations share the same version number")
+    return found
+
+
+def statements(sql):
+    """
+    Splits the text of a migration into its statements
+    :param sql: The contents of a migration file
+    :return: A list of SQL statements
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [s.strip() for s in "\n".join(lines).split(";") if s.strip()]
+
+
+def applied(db):
+    """
+    Creates the schema_migrations table if needed and reads the applied migrations
+    :param db: A connection
+    :return: A dict of version to checksum
+    """
+    cursor = db.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (\n"
+                   "  version    INT PRIMARY KEY,\n"
+                   "  name       VARCHAR(100) NOT NULL,\n"
+                   "  checksum   CHAR(40) NOT NULL,\n"
+                   "  applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP\n"
+                   ")")
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    ret = {row['version']: row['checksum'] for row in cursor.fetchall()}
+    cursor.close()
+    return ret
+
+
+def migrate(db, directory=MIGRATIONS_DIR):
+    """
+    Applies every migration that has not been applied yet. MySQL commits DDL
+    statements implicitly, so each migration is recorded as soon as its
+    statements have run; a failing migration is left unrecorded and has to be
+    fixed up by hand before running again
+    :param db: A connection
+    :param directory: The directory holding the migration files
+    :return: The list of (version, name) of the migrations applied
+    """
+    done = applied(db)
+    pending = []
+    for version, name, checksum, sql in migrations(directory):
+        if version in done:
+            if done[version] != checksum:
+                raise MigrationError("Migration {}_{} was changed after it was applied".format(version, name))
+        else:
+            pending.append((version, name, checksum, sql))
+
+    ret = []
+    for version, name, checksum, sql in pending:
+        cursor = db.cursor()
+        for statement in statements(sql):
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                       (version, name, checksum))
+        db.commit()
+        cursor.close()
+        ret.append((version, name))
+
+    if ret:
+        # Pick up the new shape of the tables in this process
+        registry.refresh(db)
+    return ret
+
+
+if __name__ == "__main__":
+    db = connect()
+    try:
+        if "--list" in sys.argv[1:]:
+            done = applied(db)
+            for version, name, checksum, sql in migrations():
+                print("{:04d}_{} {}".format(version, name, "applied" if version in done else "pending"))
+        else:
+            for version, name in migrate(db):
+                print("Applied {:04d}_{}".format(version, name))
+    finally:
+        db.close()
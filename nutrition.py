@@ -0,0 +1,93 @@
+from datetime import timedelta
+from itertools import chain
+
+from utils import as_date
+
+try:
+    import numpy
+except ImportError:
+    # The vectorized backend is optional; plain Python sums the same totals
+    numpy = None
+
+# The nutritional_fact columns totalled
+NUTRIENTS = ("calories", "fat", "sugar", "protein", "sodium")
+
+
+def sums(keys, values):
+    """
+    Sum rows of numbers by key, with NumPy when it is installed
+    :param keys: A list of hashable keys, one per row
+    :param values: A list of rows of len(NUTRIENTS) numbers, such as Decimals
+    :return: A dict of key to a list of the sums of its rows, as floats
+    """
+    codes = dict()
+    rows = [codes.setdefault(key, len(codes)) for key in keys]
+    if numpy is not None and rows:
+        matrix = numpy.fromiter(chain.from_iterable(values), float, len(rows) * len(NUTRIENTS))
+        matrix = matrix.reshape(len(rows), len(NUTRIENTS))
+        rows = numpy.array(rows)
+        totals = numpy.column_stack([numpy.bincount(rows, weights=matrix[:, i], minlength=len(codes))
+                                     for i in range(len(NUTRIENTS))])
+        return dict((key, totals[code].tolist()) for key, code in codes.items())
+    totals = [[0.0] * len(NUTRIENTS) for _ in codes]
+    for code, row in zip(rows, values):
+        total = totals[code]
+        for i, value in enumerate(row):
+            total[i] += float(value)
+    return dict((key, totals[code]) for key, code in codes.items())
+
+
+def report(rows):
+    """
+    Totals the nutrition of the rows read by `Menu.nutrition_between` per day,
+    per week (starting on Mondays), per time of day within each day and per food
+    group within each day and week. The rows are summed once, per day, time of
+    day and food group, and the other totals are added up from those
+    :param rows: A list of (date, time_of_day, food_group, <NUTRIENTS>...) tuples
+    :return: A dict of {"totals": <totals>, "days": [<day totals>], "weeks": [<week totals>]},
+    where every totals object maps each of NUTRIENTS to a number
+    """
+    grouped = sums([(as_date(row[0]), row[1], row[2]) for row in rows], [row[3:] for row in rows])
+    days = dict()
+    weeks = dict()
+    overall = [0.0] * len(NUTRIENTS)
+    for (day, time_of_day, food_group), total in grouped.items():
+        week = day - timedelta(days=day.weekday())
+        day_totals = days.setdefault(day, {"date": day.isoformat(), "totals": [0.0] * len(NUTRIENTS),
+                                           "time_of_day": dict(), "food_group": dict()})
+        week_totals = weeks.setdefault(week, {"week_of": week.isoformat(), "totals": [0.0] * len(NUTRIENTS),
+                                              "food_group": dict()})
+        targets = [overall, day_totals["totals"], week_totals["totals"],
+                   day_totals["time_of_day"].setdefault(time_of_day, [0.0] * len(NUTRIENTS))]
+        if food_group is not None:
+            targets.append(day_totals["food_group"].setdefault(food_group, [0.0] * len(NUTRIENTS)))
+            targets.append(week_totals["food_group"].setdefault(food_group, [0.0] * len(NUTRIENTS)))
+        for target in targets:
+            for i, value in enumerate(total):
+                target[i] += value
+    return {
+        "totals": named(overall),
+        "days": [named_all(days[day]) for day in sorted(days)],
+        "weeks": [named_all(weeks[week]) for week in sorted(weeks)]
+    }
+
+
+def named(total):
+    """
+    :param total: A list of sums in the order of NUTRIENTS
+    :return: A dict of nutrient to its sum, rounded to the cent like the DECIMAL columns
+    """
+    return dict((nutrient, round(value, 2)) for nutrient, value in zip(NUTRIENTS, total))
+
+
+def named_all(totals):
+    """
+    :param totals: A day or week of `report`, holding lists of sums
+    :return: The same dict, holding dicts from `named` instead
+    """
+    totals["totals"] = named(totals["totals"])
+    for breakdown in ("time_of_day", "food_group"):
+        if breakdown in totals:
+            totals[breakdown] = dict((key, named(total)) for key, total in totals[breakdown].items())
+    return totals
+
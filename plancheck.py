@@ -0,0 +1,188 @@
+"""
+Runs EXPLAIN on every shape of SQL statement that DbEntity and views.py
+send to the database, against the database in config.Config, and fails if
+any of them reads a table with a full scan that no index could have avoided.
+
+A table scan is only accepted where the statement reads the whole table
+anyway, e.g. the unfiltered /all/ endpoints. Run it after `python migrate.py`,
+ideally against a database holding realistic data, since the optimizer may
+rightly prefer a scan over an index on a nearly empty table; those scans are
+still reported as long as the table has a usable index.
+
+Usage: python plancheck.py [-v]
+"""
+import sys
+from datetime import date
+
+from flask import g
+
+from app import app
+from dialects import dialect_of
+from entities import Food, NutritionalFact, Recipe, Menu
+import migrate
+from nutrition import NUTRIENTS
+
+PAGE = 50
+
+
+class Shape(object):
+    """
+    One statement to check
+    """
+
+    def __init__(self, label, sql, values=(), scan_ok=()):
+        """
+        :param label: What issues the statement
+        :param sql: The statement
+        :param values: Sample parameters for it
+        :param scan_ok: The tables the statement is allowed to scan in full
+        """
+        self.label = label
+        self.sql = sql
+        self.values = tuple(values)
+        self.scan_ok = set(scan_ok)
+
+
+def selects(entity, comparisons, label, scan_ok=()):
+    """
+    The unpaged, first page and following page forms of an `all` call
+    """
+    table = entity.__table__
+    cursor = entity.encode_cursor({column: 1 if column != "date" else date(2016, 4, 1)
+                                   for column in entity.order_by})
+    ret = []
+    for suffix, limit, after in (("", None, None), (" page", PAGE, None), (" next page", PAGE, cursor)):
+        where_string, values = entity.filter_clause(comparisons=comparisons, limit=limit, after=after)
+        # Only the first page of a listing may start from the beginning of the table
+        allowed = scan_ok if after is None else ()
+        ret.append(Shape(label + suffix, "SELECT * FROM {} {}".format(table, where_string), values, allowed))
+    return ret
+
+
+def joined(entity, relation, comparisons, label, scan_ok=()):
+    """
+    The unpaged, first page and following page forms of an `all_joined` call
+    """
+    table = entity.__table__
+    rel = entity.__relations__[relation]
+    cursor = entity.encode_cursor({column: 1 for column in entity.order_by})
+    columns = ", ".join("{}.{}".format(table, column) for column in entity.metadata.columns)
+    ret = []
+    for suffix, limit, after in (("", None, None), (" page", PAGE, None), (" next page", PAGE, cursor)):
+        where_string, values = entity.filter_clause(comparisons=comparisons, limit=limit, after=after,
+                                                    qualifier=table)
+        allowed = scan_ok if after is None else ()
+        ret.append(Shape(label + suffix, "SELECT {}, {} FROM {} {} {}".format(
+            columns, rel.join_columns(relation), table, rel.join_clause(table), where_string), values, allowed))
+    return ret
+
+
+def streamed(entity, relation, label):
+    """
+    The statement behind `iterate`, which reads every record of the owning table
+    """
+    table = entity.__table__
+    key = entity.__keys__[0]
+    rel = entity.__relations__.get(relation, None) if relation else None
+    columns = ["{}.{}".format(table, column) for column in entity.metadata.columns]
+    join = ""
+    order = "{}.{}".format(table, key)
+    if rel is not None:
+        columns.append(rel.join_columns(relation))
+        if hasattr(rel, 'through'):
+            join = rel.join_clause(table, key)
+            order += ", {}.{}".format(rel.table, rel.key)
+        else:
+            join = rel.join_clause(table)
+    return Shape(label, "SELECT {} FROM {} {} ORDER BY {}".format(", ".join(columns), table, join, order),
+                 scan_ok=[table])
+
+
+def shapes():
+    """
+    Every statement shape the app generates
+    :return: A list of Shapes
+    """
+    food, nfact, recipe, menu = Food(), NutritionalFact(), Recipe(), Menu()
+    lock = dialect_of(g.db).lock_rows
+    ret = []
+
+    for entity in (food, nfact, recipe, menu):
+        table, key = entity.__table__, entity.__keys__[0]
+        ret.append(Shape("{}.find_by_id".format(table),
+                         "SELECT * FROM {} WHERE {}=%s LIMIT 1".format(table, key), [1]))
+        ret.append(Shape("{}.find_many".format(table),
+                         "SELECT * FROM {} WHERE {} IN (%s, %s)".format(table, key), [1, 2]))
+        ret.append(Shape("{}.bulk_update".format(table),
+                         "SELECT * FROM {} WHERE {} IN (%s, %s){}".format(table, key, lock), [1, 2]))
+        ret.append(Shape("DELETE {}".format(table), "DELETE FROM {} WHERE {}=%s".format(table, key), [1]))
+        for name, rel in entity.__relations__.items():
+            ret.append(Shape("{}.{} load".format(table, name), rel.fetch_sql(2), [1, 2]))
+            if hasattr(rel, 'through'):
+                ret.append(Shape("{}.{} replace".format(table, name),
+                                 "DELETE FROM {} WHERE {} IN (%s, %s)".format(rel.through, rel.local), [1, 2]))
+
+    # The statements run by the delete triggers in resources/mysql_schema.sql
+    ret.append(Shape("on_food_delete", "DELETE FROM ingredients WHERE food_id=%s", [1]))
+    ret.append(Shape("on_recipe_delete", "DELETE FROM ingredients WHERE recipe_id=%s", [1]))
+    ret.append(Shape("on_recipe_delete", "DELETE FROM serves WHERE recipe_id=%s", [1]))
+    ret.append(Shape("on_menu_delete", "DELETE FROM serves WHERE menu_id=%s", [1]))
+    ret.append(Shape("on_nutritional_fact_delete", "UPDATE food SET fk_nfact_id = NULL WHERE fk_nfact_id=%s", [1]))
+
+    ret += selects(nfact, None, "/nutrition/all/", scan_ok=["nutritional_fact"])
+    ret += selects(recipe, None, "/recipe/all/", scan_ok=["recipes"])
+    ret += selects(menu, None, "/menu/all/", scan_ok=["menu"])
+    ret += joined(food, "nutrition", None, "/food/all/", scan_ok=["food"])
+    ret.append(streamed(nfact, None, "/nutrition/all/ streamed"))
+    ret.append(streamed(recipe, "ingredients", "/recipe/all/ streamed"))
+    ret.append(streamed(menu, "recipes", "/menu/all/ streamed"))
+    ret.append(streamed(food, "nutrition", "/food/all/ streamed"))
+
+    ret += selects(food, {"in_fridge": ["=", True]}, "/fridge/")
+    ret += selects(recipe, {"rec_name": ["=", "pancakes"]}, "/recipe/<rec_name>/")
+    ret += joined(food, "nutrition", {"food_id": ["=", 1]}, "/food/<id>/")
+    ret += joined(food, "nutrition", {"food_name": ["=", "egg"]}, "/food/<food_name>/")
+    ret += selects(menu, {"time_of_day": ["=", "lunch"]}, "/menu/<time_of_day>/")
+    ret += selects(menu, {"date": ["=", date(2016, 4, 1)]}, "/menu/date/<date>/")
+    ret += selects(menu, {"date": ["BETWEEN", [date(2016, 4, 1), date(2016, 4, 30)]]},
+                   "/menu/date/between/<begin>/<end>/")
+    ret.append(Shape("/menu/date/between/<begin>/<end>/nutrition/", Menu.nutrition_sql(NUTRIENTS),
+                     ["2016-04-01", "2016-04-30"]))
+    where_string, values = menu.filter_clause(comparisons={"date": ["=", date(2016, 4, 1)],
+                                                           "time_of_day": ["=", "lunch"]})
+    ret.append(Shape("/menu/<time_of_day>/<date>/", "SELECT * FROM menu {}".format(where_string), values))
+    return ret
+
+
+def check(db, verbose=False):
+    """
+    EXPLAINs every shape
+    :param db: A connection
+    :param verbose: Print every plan, not only the failing ones
+    :return: A list of (shape, plan row) pairs for the full scans found
+    """
+    failures = []
+    dialect = dialect_of(db)
+    for shape in shapes():
+        for row in dialect.explain(db, shape.sql, shape.values):
+            full_scan = row['type'] == 'ALL' and row['table'] not in shape.scan_ok
+            if full_scan and not row['possible_keys']:
+                failures.append((shape, row))
+            if verbose or (full_scan and not row['possible_keys']):
+                print("{:<45} {:<18} {:<6} {}".format(shape.label, row['table'], row['type'],
+                                                      row['key'] or row['possible_keys'] or "-"))
+    return failures
+
+
+if __name__ == "__main__":
+    db = migrate.connect()
+    try:
+        with app.app_context():
+            g.db = db
+            failures = check(db, verbose="-v" in sys.argv[1:])
+    finally:
+        db.close()
+    if failures:
+        print("{} statement(s) fall back to a full table scan".format(len(failures)))
+        sys.exit(1)
+    print("No full table scans")
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when a connection could not be checked out of the pool
+    before the configured timeout ran out
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of database connections. Up to `size` idle connections are kept
+    around between requests, and up to `max_overflow` extra connections may be opened
+    when the pool is exhausted; overflow connections are closed when they are returned
+    instead of being kept. Connections older than `recycle` seconds are replaced on
+    checkout, and if `pre_ping` is set every checkout pings the server first so a
+    connection dropped by MySQL (wait_timeout, restarts, etc.) is never handed out.
+
+    A pool belongs to the process that created it. Sockets must never be shared
+    between a gunicorn master and its workers, so use `process_pool` to get a pool
+    that is created lazily in each worker after the fork.
+    """
+
+    def __init__(self, creator, size=5, max_overflow=10, recycle=3600, pre_ping=True, timeout=30):
+        """
+        :param creator: A callable that takes no arguments and returns a new DB-API connection
+        :param size: The number of idle connections kept in the pool
+        :param max_overflow: The number of connections allowed on top of `size` when the pool
+        is exhausted. A negative value means no limit
+        :param recycle: Connections older than this many seconds are closed and replaced on
+        checkout. A value of 0 or less disables recycling
+        :param pre_ping: Whether to ping the connection before handing it out
+        :param timeout: How many seconds to wait for a connection when the pool is exhausted
+        """
+        self.creator = creator
+        self.size = size
+        self.max_overflow = max_overflow
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = Queue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    @property
+    def checked_out(self):
+        """
+        The number of connections currently lent out by the pool
+        :return:
+        """
+        return self._opened - self._idle.qsize()
+
+    @property
+    def overflow(self):
+        """
+        The number of connections opened on top of the pool size
+        :return:
+        """
+        return max(self._opened - self.size, 0)
+
+    def connect(self):
+        """
+        Borrow a connection from the pool, opening a new one if no idle connection is
+        available and the overflow allows it. Otherwise waits up to `timeout` seconds
+        for another request to give a connection back.
+        :return: A live DB-API connection
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                if self.max_overflow < 0 or self._opened < self.size + self.max_overflow:
+                    self._opened += 1
+                    reserved = True
+                else:
+                    reserved = False
+            if reserved:
+                try:
+                    return self._open()
+                except Exception:
+                    self._discard(None)
+                    raise
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except Empty:
+                raise PoolTimeout("Connection pool exhausted ({} connections in use)".format(self.checked_out))
+        return self._check(conn)
+
+    def release(self, conn):
+        """
+        Give a connection back to the pool. Anything left uncommitted on it is rolled
+        back so the next borrower starts from a clean session. Connections that cannot
+        be reset, or that were opened as overflow, are closed instead.
+        :param conn: A connection previously returned by `connect`
+        :return:
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            self._discard(conn)
+
+    def dispose(self):
+        """
+        Close every idle connection held by the pool. Connections currently lent out
+        are closed when they are released
+        :return:
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(conn)
+
+    def _open(self):
+        conn = self.creator()
+        conn._pool_created_at = time.time()
+        return conn
+
+    def _check(self, conn):
+        """
+        Make sure a connection taken from the idle queue is fit to hand out,
+        replacing it with a fresh one if it has expired or stopped answering
+        :param conn:
+        :return:
+        """
+        expired = self.recycle > 0 and time.time() - conn._pool_created_at > self.recycle
+        if not expired and self.pre_ping:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                expired = True
+        if not expired:
+            return conn
+        self._close(conn)
+        try:
+            return self._open()
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened -= 1
+        if conn is not None:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_pool(factory):
+    """
+    Returns the connection pool for the current process, building it with `factory`
+    on first use. If the process has forked since the pool was built (e.g. a gunicorn
+    worker spawned from a master that already touched the database) the inherited pool
+    is abandoned without closing its sockets, since they still belong to the parent,
+    and a new one is created for this process.
+    :param factory: A callable that takes no arguments and returns a new ConnectionPool
+    :return: The ConnectionPool owned by this process
+    """
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = factory()
+            pool = _pool
+    return pool
@@ -0,0 +1,121 @@
+import threading
+
+# The most statements `compiled` keeps. Only statements whose text depends
+# on a request, such as the number of ids in an IN list, make it grow, and
+# going over simply starts it over
+MAX_STATEMENTS = 4096
+
+# The comparison operators `DbEntity.all` accepts
+OPERATORS = frozenset(["=", "!=", "<>", "<", "<=", ">", ">=", "LIKE", "NOT LIKE", "BETWEEN"])
+COMBINATORS = frozenset(["AND", "OR"])
+
+
+class StatementCache(object):
+    """
+    Process-wide cache of the SQL text of the statements the entities run,
+    keyed by the shape of each statement: everything its text depends on,
+    i.e. the table, the operation and the shape of its arguments (the columns
+    written, the columns and operators compared, whether a page is
+    requested...), but never the values, which are always bound as parameters. Building a statement, and checking
+    the column names in it against the metadata, happens once per shape. The
+    metadata registry clears the cache when it is refreshed after a migration
+    """
+
+    def __init__(self, size=MAX_STATEMENTS):
+        self.size = size
+        self._statements = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, shape, build):
+        """
+        The statement for a shape, built with `build()` on first use
+        :param shape: A hashable tuple identifying the statement's shape
+        :param build: A callable returning the statement, raising if it can not be built
+        :return: Whatever `build` returned for the shape
+        """
+        ret = self._statements.get(shape, None)
+        if ret is not None:
+            self.hits += 1
+            return ret
+        ret = build()
+        with self._lock:
+            self.misses += 1
+            if len(self._statements) >= self.size:
+                self._statements.clear()
+            self._statements[shape] = ret
+        return ret
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+
+    def stats(self):
+        """
+        :return: A dict of counters, for /cache/stats/
+        """
+        return {"statements": len(self._statements), "hits": self.hits, "misses": self.misses}
+
+
+statements = StatementCache()
+
+
+# Shorthand for `statements.get`
+compiled = statements.get
+
+
+def placeholders(count):
+    """
+    :param count: The number of parameters
+    :return: "%s, %s, ..." for a list of `count` parameters
+    """
+    return ", ".join(["%s"] * count)
+
+
+def comparison_shape(combinator, comparisons, prep):
+    """
+    Splits a comparisons dictionary (see `DbEntity.all`) into the part the
+    text of its WHERE clause depends on and the parameters of that clause
+    :param combinator: See `DbEntity.all`
+    :param comparisons: See `DbEntity.all`
+    :param prep: A callable converting a value to its query parameter
+    :return: A tuple of a hashable shape for `build_where` and a tuple of values
+    """
+    shape = [combinator]
+    values = []
+    for column, (operator, value) in comparisons.items():
+        shape.append((column, operator))
+        if operator.upper() == "BETWEEN":
+            values.append(prep(value[0]))
+            values.append(prep(value[1]))
+        else:
+            values.append(prep(value))
+    return tuple(shape), tuple(values)
+
+
+def build_where(meta, shape, qualifier):
+    """
+    Builds the WHERE clause of a comparisons shape, raising a TypeError if it
+    compares a column the table does not have or uses an unknown operator
+    :param meta: The TableMetadata of the table compared
+    :param shape: A shape from `comparison_shape`
+    :param qualifier: If given, every column name is qualified with it
+    :return: The clause
+    """
+    combinator = shape[0].strip().upper()
+    if combinator not in COMBINATORS:
+        raise TypeError("Invalid combinator {}".format(shape[0]))
+    conditions = []
+    for column, operator in shape[1:]:
+        if column not in meta:
+            raise TypeError("Invalid column name")
+        if operator.strip().upper() not in OPERATORS:
+            raise TypeError("Invalid comparison {}".format(operator))
+        if qualifier:
+            column = "{}.{}".format(qualifier, column)
+        if operator.upper() == "BETWEEN":
+            conditions.append("{} {} %s AND %s".format(column, operator))
+        else:
+            conditions.append("{}{}%s".format(column, operator))
+    return "WHERE {}".format(" {} ".format(combinator).join(conditions))
@@ -0,0 +1,301 @@
+import keyword
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+from flask import current_app, g
+
+from dialects import dialect_of
+from metadata import registry
+
+# The relation names of each table, see `register`
+_relations = dict()
+_classes = dict()
+
+_MISSING = object()
+
+
+class Record(object):
+    """
+    A compact, dict-like row. Subclasses generated by `record_class` keep
+    each column, and each relation of the table's entity, in a slot of
+    its own, so a row costs a fraction of the memory of a dict. Keys that
+    are neither go to a dict made only when one is first set
+    """
+    __slots__ = ("_extra",)
+    _fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            value = getattr(self, key, _MISSING)
+        else:
+            value = self._extra.get(key, _MISSING) if self._extra else _MISSING
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if not self._extra:
+                self._extra = dict()
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            if getattr(self, key, _MISSING) is _MISSING:
+                raise KeyError(key)
+            delattr(self, key)
+        else:
+            if not self._extra or key not in self._extra:
+                raise KeyError(key)
+            del self._extra[key]
+            if not self._extra:
+                self._extra = None
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        for field in self._fields:
+            if getattr(self, field, _MISSING) is not _MISSING:
+                yield field
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, dict(self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def as_dict(self):
+        """
+        The record as a plain dict, e.g. for a JSON encoder
+        :return:
+        """
+        return dict(self.items())
+
+    def copy(self):
+        """
+        A shallow copy, made slot by slot
+        :return:
+        """
+        ret = type(self).__new__(type(self))
+        for field in self._fields:
+            value = getattr(self, field, _MISSING)
+            if value is not _MISSING:
+                setattr(ret, field, value)
+        ret._extra = dict(self._extra) if self._extra else None
+        return ret
+
+    __hash__ = None
+
+
+MutableMapping.register(Record)
+
+
+def register(*entities):
+    """
+    Register entity classes, so the records of their tables get a slot for each relation
+    :param entities: DbEntity subclasses
+    :return:
+    """
+    for entity in entities:
+        _relations[entity.__table__] = sorted(entity.__relations__)
+
+
+def record_class(table, columns):
+    """
+    The Record subclass of a table, generated on first use with a slot per
+    column and per relation, an __init__ taking the columns in order, and
+    an as_dict and a copy reading the column slots directly
+    :param table: The table name
+    :param columns: The table's columns, in table order
+    :return:
+    """
+    columns = tuple(columns)
+    cls = _classes.get(table, None)
+    if cls is not None and cls._columns == columns:
+        return cls
+    fields = columns + tuple(r for r in _relations.get(table, []) if r not in columns)
+    for field in fields:
+        if not _identifier(field) or hasattr(Record, field):
+            raise ValueError("{}.{} can not be the slot of a record".format(table, field))
+    source = "def __init__(self, {args}):\n    {assign}\n    self._extra = None\n".format(
+        args=", ".join(columns),
+        assign="\n    ".join("self.{column} = {column}".format(column=column) for column in columns))
+    # Columns are only missing once deleted, in which case the generic methods take over
+    source += ("def as_dict(self):\n"
+               "    try:\n"
+               "        ret = {{{items}}}\n"
+               "    except AttributeError:\n"
+               "        return Record.as_dict(self)\n"
+               "    for name in {relations!r}:\n"
+               "        value = getattr(self, name, _MISSING)\n"
+               "        if value is not _MISSING:\n"
+               "            ret[name] = value\n"
+               "    if self._extra:\n"
+               "        ret.update(self._extra)\n"
+               "    return ret\n"
+               "def copy(self):\n"
+               "    ret = object.__new__(type(self))\n"
+               "    try:\n"
+               "        {copy}\n"
+               "    except AttributeError:\n"
+               "        return Record.copy(self)\n"
+               "    for name in {relations!r}:\n"
+               "        value = getattr(self, name, _MISSING)\n"
+               "        if value is not _MISSING:\n"
+               "            setattr(ret, name, value)\n"
+               "    ret._extra = dict(self._extra) if self._extra else None\n"
+               "    return ret\n").format(
+        items=", ".join("{column!r}: self.{column}".format(column=column) for column in columns),
+        copy="\n        ".join("ret.{column} = self.{column}".format(column=column) for column in columns),
+        relations=tuple(str(field) for field in fields[len(columns):]))
+    namespace = dict(Record=Record, _MISSING=_MISSING)
+    exec(source, namespace)
+    cls = type(str("{}Record".format("".join(part.title() for part in table.split("_")))), (Record,), {
+        "__slots__": fields,
+        "__init__": namespace["__init__"],
+        "as_dict": namespace["as_dict"],
+        "copy": namespace["copy"],
+        "_fields": fields,
+        "_field_set": frozenset(fields),
+        "_columns": columns,
+    })
+    _classes[table] = cls
+    return cls
+
+
+def _identifier(name):
+    return (name.replace("_", "a").isalnum() and not name[0].isdigit() and not name.startswith("_")
+            and not keyword.iskeyword(name))
+
+
+def compact_rows():
+    """
+    Whether the current request reads rows as Records, see COMPACT_ROWS
+    :return:
+    """
+    return current_app.config['COMPACT_ROWS']
+
+
+def row_cursor(db):
+    """
+    A cursor for reading rows to be passed to `fetch_records`: one returning
+    plain tuples when rows are read as Records, so no dict is ever built for
+    them, and the usual dict cursor otherwise
+    :param db: A connection
+    :return:
+    """
+    if compact_rows():
+        return dialect_of(db).tuple_cursor(db)
+    return db.cursor()
+
+
+def fetch_records(cursor, table):
+    """
+    Reads every remaining row of a cursor from `row_cursor`
+    :param cursor: A cursor that ran a statement selecting every column of `table`,
+    in any order, and possibly more columns, which are kept too
+    :param table: The table the rows are read from
+    :return: A list of Records if COMPACT_ROWS is on, or of dicts otherwise
+    """
+    rows = cursor.fetchall()
+    if not compact_rows():
+        return rows
+    make = _maker(cursor, table)
+    return [make(row) for row in rows]
+
+
+def from_mappings(table):
+    """
+    A function turning dict rows holding every column of `table` into
+    Records, or returning them as they are when COMPACT_ROWS is off.
+    Empty rows, e.g. a missing related record, are returned as they are
+    :param table: The table name
+    :return:
+    """
+    if not compact_rows():
+        return lambda row: row
+    cls = record_class(table, registry.get(table, g.db).columns)
+
+    def make(row):
+        if not row:
+            return row
+        ret = cls(*[row.pop(column) for column in cls._columns])
+        if row:
+            ret.update(row)
+        return ret
+
+    return make
+
+
+def _maker(cursor, table):
+    # Builds rows of the cursor's shape into Records. Columns the table
+    # does not have, e.g. computed or joined ones, are set as extra keys
+    cls = record_class(table, registry.get(table, g.db).columns)
+    names = [d[0] for d in cursor.description]
+    if tuple(names) == cls._columns:
+        return lambda row: cls(*row)
+    positions = [names.index(column) for column in cls._columns]
+    extra = [(i, name) for i, name in enumerate(names) if name not in cls._field_set]
+
+    def make(row):
+        record = cls(*[row[i] for i in positions])
+        for i, name in extra:
+            record[name] = row[i]
+        return record
+
+    return make
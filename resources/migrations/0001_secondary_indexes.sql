@@ -0,0 +1,25 @@
+-- Secondary indexes for every predicate the API filters or joins on.
+-- Without them each of these lookups is a full table scan.
+
+-- Association tables: loading a recipe's ingredients or a menu's recipes
+-- seeks on the owner column, and the delete triggers seek on the other one
+CREATE INDEX ix_ingredients_recipe_id ON ingredients (recipe_id, food_id);
+CREATE INDEX ix_ingredients_food_id ON ingredients (food_id);
+CREATE INDEX ix_serves_menu_id ON serves (menu_id, recipe_id);
+CREATE INDEX ix_serves_recipe_id ON serves (recipe_id);
+
+-- Name lookups (/food/<name>/, /recipe/<name>/)
+CREATE INDEX ix_food_food_name ON food (food_name);
+CREATE INDEX ix_recipes_rec_name ON recipes (rec_name);
+
+-- The fridge, paged by food_id
+CREATE INDEX ix_food_in_fridge ON food (in_fridge, food_id);
+
+-- The nutritional_fact delete trigger nulls food.fk_nfact_id
+CREATE INDEX ix_food_fk_nfact_id ON food (fk_nfact_id);
+
+-- Menus by date and date range, and by time of day, all paged by (date, id).
+-- InnoDB appends the primary key to every secondary index, so these are
+-- really (date, id) and (time_of_day, date, id)
+CREATE INDEX ix_menu_date ON menu (`date`);
+CREATE INDEX ix_menu_time_of_day_date ON menu (time_of_day, `date`);
@@ -0,0 +1,88 @@
+-- The schema of resources/mysql_schema.sql translated for SQLite.
+-- ENUMs become CHECK constraints, AUTO_INCREMENT becomes INTEGER PRIMARY KEY
+-- AUTOINCREMENT (so ids are never reused, like in MySQL) and the triggers
+-- keep the same cascades. Secondary indexes come from resources/migrations.
+
+CREATE TABLE menu (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  time_of_day TEXT CHECK (time_of_day IN ('breakfast', 'lunch', 'dinner')),
+  `date`      DATE NOT NULL
+);
+
+CREATE TABLE recipes (
+  rec_id       INTEGER PRIMARY KEY AUTOINCREMENT,
+  rec_name     VARCHAR(50) NOT NULL,
+  instructions TEXT,
+  category     TEXT DEFAULT 'entree' CHECK (category IN ('entree', 'appetizer', 'dessert'))
+);
+
+CREATE TABLE nutritional_fact (
+  nfact_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+  sodium     DECIMAL(6, 2) DEFAULT 0.00,
+  fat        DECIMAL(6, 2) DEFAULT 0.00,
+  calories   DECIMAL(6, 2) DEFAULT 0.00,
+  sugar      DECIMAL(6, 2) DEFAULT 0.00,
+  protein    DECIMAL(6, 2) DEFAULT 0.00,
+  food_group TEXT NOT NULL CHECK (food_group IN ('grain', 'meat', 'veggies')),
+  amount     DECIMAL(6, 2) DEFAULT 0.00
+);
+
+CREATE TABLE food (
+  food_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+  in_fridge   BOOLEAN DEFAULT 1,
+  food_name   VARCHAR(50) NOT NULL,
+  fk_nfact_id INT REFERENCES nutritional_fact (nfact_id)
+);
+
+CREATE TABLE serves (
+  menu_id   INT REFERENCES menu (id),
+  recipe_id INT REFERENCES recipes (rec_id)
+);
+
+CREATE TABLE ingredients (
+  recipe_id INT REFERENCES recipes (rec_id),
+  food_id   INT REFERENCES food (food_id)
+);
+
+CREATE TRIGGER on_food_delete
+BEFORE DELETE ON food
+FOR EACH ROW
+  BEGIN
+    -- When a food is deleted, its nutritional fact should also be deleted
+    DELETE FROM nutritional_fact
+    WHERE nfact_id = OLD.fk_nfact_id;
+    -- And its entry binding it to a recipe should also be deleted
+    DELETE FROM ingredients
+    WHERE food_id = OLD.food_id;
+  END;
+
+CREATE TRIGGER on_recipe_delete
+BEFORE DELETE ON recipes
+FOR EACH ROW
+  BEGIN
+    -- When a recipe is deleted, its entry in the ingredients table should also be deleted
+    DELETE FROM ingredients
+    WHERE recipe_id = OLD.rec_id;
+    -- And its entry binding it to a menu should also be deleted
+    DELETE FROM serves
+    WHERE recipe_id = OLD.rec_id;
+  END;
+
+CREATE TRIGGER on_menu_delete
+BEFORE DELETE ON menu
+FOR EACH ROW
+  BEGIN
+    -- When a menu item is deleted, its entry in the serves table should be deleted
+    DELETE FROM serves
+    WHERE menu_id = OLD.id;
+  END;
+
+CREATE TRIGGER on_nutritional_fact_delete
+BEFORE DELETE ON nutritional_fact
+FOR EACH ROW
+  BEGIN
+    -- When a nutritional fact is deleted, its id on the food entry should be set to null
+    UPDATE food
+    SET fk_nfact_id = NULL
+    WHERE fk_nfact_id = OLD.nfact_id;
+  END;
@@ -0,0 +1,312 @@
+from bisect import bisect_left, insort
+from heapq import merge
+
+from flask import current_app
+
+from indexes import TableIndex
+
+# The share of a misspelled word's trigrams a word must hold to be suggested for it
+MIN_SIMILARITY = 0.5
+
+# Words shorter than this are never matched as misspellings
+MIN_FUZZY_LENGTH = 3
+
+# The most words a misspelled word is matched as
+MAX_SUGGESTIONS = 8
+
+# How many names of a word's postings are scored one by one before the
+# postings of every word of the query are intersected instead
+MAX_SCANNED = 128
+
+# The most matches /search/ returns per table
+MAX_RESULTS = 100
+
+
+def fold(name):
+    """
+    The form names are compared in: lower case, with runs of whitespace collapsed
+    :param name:
+    :return:
+    """
+    return u" ".join(name.lower().split())
+
+
+def trigrams(word):
+    """
+    The trigrams of a folded word, padded so its first letters count twice
+    :param word:
+    :return: A set of three character strings
+    """
+    padded = u"  {} ".format(word)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameIndex(TableIndex):
+    """
+    The names of one table, kept in memory by each worker (see indexes.TableIndex)
+    for type-ahead search.
+
+    Folded names are kept sorted, so the names starting with a query are found by
+    bisection. Every word of the names maps to the sorted ids of the names holding
+    it, and the trigrams of the distinct words map to the words holding them, so the
+    words of a query are matched, misspelled or not, against the vocabulary rather
+    than every name, and the names holding them are then read in id order until
+    no name left can rank higher.
+    """
+
+    def __init__(self, entity, column, interval=300):
+        """
+        :param entity: See indexes.TableIndex
+        :param column: The name column
+        :param interval: See indexes.TableIndex
+        """
+        super(NameIndex, self).__init__(entity, interval)
+        self.column = column
+        self._names = dict()
+        self._sorted = []
+        self._postings = dict()
+        self._vocabulary = []
+        self._grams = dict()
+
+    def search(self, query, limit=10):
+        """
+        The names best matching a query: the names starting with it, in alphabetical
+        order, then the names holding every word of it, the last one possibly only
+        begun, or words it may be a misspelling of, best match first
+        :param query: The text typed so far
+        :param limit: The most matches returned
+        :return: A list of (id, name, score) tuples. The score is 1.0 when every
+        word matched as typed, and the product of the similarities of the
+        misspelled words and the words they matched otherwise
+        """
+        folded = fold(query)
+        if not folded or limit <= 0:
+            return []
+        matches = []
+        with self._lock:
+            i = bisect_left(self._sorted, (folded,))
+            while len(matches) < limit and i < len(self._sorted) and self._sorted[i][0].startswith(folded):
+                id = self._sorted[i][1]
+                matches.append((id, self._names[id], 1.0))
+                i += 1
+            if len(matches) < limit:
+                found = set(id for id, _, _ in matches)
+                matches.extend(self.word_matches(folded.split(), limit - len(matches), found))
+        return matches
+
+    def word_matches(self, words, limit, exclude):
+        """
+        The names holding a match for every word of a query. The names are read
+        from the postings of the word with the fewest, best matches first
+        :param words: The folded words of the query
+        :param limit: The most matches returned
+        :param exclude: Ids not to return
+        :return: A list of (id, name, score) tuples, best match first
+        """
+        terms = [self.alternatives(word, prefix=(i == len(words) - 1)) for i, word in enumerate(words)]
+        if not all(scores or prefixed for scores, prefixed in terms):
+            return []
+        driver = min(terms, key=lambda term: sum(len(self._postings[word]) for word in self.expand(term)))
+        scores, prefixed = driver
+        tiers = [(1.0, prefixed)] if prefixed else []
+        for word, score in scores.items():
+            tiers.append((score, [word]))
+        tiers.sort(key=lambda tier: -tier[0])
+        # The best score a name can reach on top of the score of the driver's word
+        ceiling = 1.0
+        for term_scores, term_prefixed in terms:
+            ceiling *= 1.0 if term_prefixed else max(term_scores.values())
+        ceiling /= 1.0 if driver[1] else max(driver[0].values())
+
+        found = []
+        seen = set(exclude)
+        for best, tier in tiers:
+            best *= ceiling
+            if len(found) >= limit and found[limit - 1][0] <= -best:
+                break
+            scanned = 0
+            for id in unique(merge(*[self._postings[word] for word in tier])):
+                if id in seen:
+                    continue
+                seen.add(id)
+                self.add_match(found, id, terms)
+                if len(found) >= limit and found[limit - 1][0] <= -best:
+                    break
+                scanned += 1
+                if scanned >= MAX_SCANNED:
+                    # Few names hold every word, so only score those
+                    ids = set().union(*[self._postings[word] for word in tier])
+                    for term in terms:
+                        if term is not driver:
+                            ids = set().union(*[ids.intersection(self._postings[word]) for word in self.expand(term)])
+                    for id in sorted(ids - seen):
+                        seen.add(id)
+                        self.add_match(found, id, terms)
+                        if len(found) >= limit and found[limit - 1][0] <= -best:
+                            break
+                    break
+        return [(id, self._names[id], -score) for score, _, id in found[:limit]]
+
+    def add_match(self, found, id, terms):
+        """
+        Adds a name to the matches found so far, if it matches every term
+        :param found: A sorted list of (-score, length of the name, id) tuples
+        :param id: The id of the name
+        :param terms: See `score`
+        :return:
+        """
+        score = self.score(self._names[id], terms)
+        if score:
+            insort(found, (-score, len(self._names[id]), id))
+
+    def alternatives(self, word, prefix=False):
+        """
+        The words of the vocabulary a query word matches
+        :param word: A folded word of the query
+        :param prefix: Whether the word may be only begun, i.e. it is the last one typed
+        :return: A tuple of a dict of word to similarity for the words it matches
+        whole or as a misspelling, and a list of the words it begins, if `prefix`
+        """
+        scores = dict()
+        if word in self._postings:
+            scores[word] = 1.0
+        prefixed = []
+        if prefix:
+            i = bisect_left(self._vocabulary, word)
+            while i < len(self._vocabulary) and self._vocabulary[i].startswith(word):
+                prefixed.append(self._vocabulary[i])
+                i += 1
+        if len(word) >= MIN_FUZZY_LENGTH and not scores:
+            grams = trigrams(word)
+            ordered = sorted(grams, key=lambda gram: len(self._grams.get(gram, ())))
+            needed = max(1, int(len(grams) * MIN_SIMILARITY + 0.999))
+            candidates = set()
+            # A word holding `needed` of the trigrams holds one of the rarest ones
+            for gram in ordered[:len(grams) - needed + 1]:
+                candidates.update(self._grams.get(gram, ()))
+            suggested = []
+            for candidate in candidates:
+                common = len(grams & trigrams(candidate))
+                if common >= needed:
+                    suggested.append((-float(common) / (len(grams) + len(trigrams(candidate)) - common), candidate))
+            for similarity, candidate in sorted(suggested)[:MAX_SUGGESTIONS]:
+                scores[candidate] = -similarity
+        return scores, prefixed
+
+    @staticmethod
+    def expand(term):
+        """
+        :param term: A term from `alternatives`
+        :return: Every word the term matches
+        """
+        scores, prefixed = term
+        return list(scores) + prefixed
+
+    @staticmethod
+    def score(name, terms):
+        """
+        How well a name matches the terms of a query
+        :param name: The name
+        :param terms: A term from `alternatives` per word of the query
+        :return: The product of the best similarity of each term among the words of the name, or 0
+        """
+        words = fold(name).split()
+        total = 1.0
+        for scores, prefixed in terms:
+            best = 0
+            for word in words:
+                if prefixed and word in prefixed:
+                    best = 1.0
+                    break
+                best = max(best, scores.get(word, 0))
+            if not best:
+                return 0
+            total *= best
+        return total
+
+    def records(self):
+        return self.entity().all()
+
+    def load(self, records):
+        key = self.entity.__keys__[0]
+        self._names = dict()
+        self._postings = dict()
+        for record in records:
+            if record[self.column] is not None:
+                self._names[record[key]] = record[self.column]
+        self._sorted = sorted((fold(name), id) for id, name in self._names.items())
+        for folded, id in self._sorted:
+            for word in set(folded.split()):
+                self._postings.setdefault(word, []).append(id)
+        for ids in self._postings.values():
+            ids.sort()
+        self._vocabulary = sorted(self._postings)
+        self._grams = dict()
+        for word in self._vocabulary:
+            for gram in trigrams(word):
+                self._grams.setdefault(gram, set()).add(word)
+
+    def update(self, table, id, record):
+        name = self._names.pop(id, None)
+        if name is not None:
+            folded = fold(name)
+            del self._sorted[bisect_left(self._sorted, (folded, id))]
+            for word in set(folded.split()):
+                ids = self._postings[word]
+                del ids[bisect_left(ids, id)]
+                if not ids:
+                    del self._postings[word]
+                    del self._vocabulary[bisect_left(self._vocabulary, word)]
+                    for gram in trigrams(word):
+                        self._grams[gram].discard(word)
+        if record is not None and record[self.column] is not None:
+            name = self._names[id] = record[self.column]
+            folded = fold(name)
+            insort(self._sorted, (folded, id))
+            for word in set(folded.split()):
+                if word not in self._postings:
+                    self._postings[word] = []
+                    insort(self._vocabulary, word)
+                    for gram in trigrams(word):
+                        self._grams.setdefault(gram, set()).add(word)
+                insort(self._postings[word], id)
+
+    def __len__(self):
+        return len(self._names)
+
+
+def unique(ids):
+    """
+    :param ids: Sorted ids
+    :return: The ids, each once
+    """
+    last = None
+    for id in ids:
+        if id != last:
+            last = id
+            yield id
+
+
+def search_indexes():
+    """
+    The NameIndex of each searchable table of the running app, or None if search indexes are turned off
+    :return: A dict of table name to NameIndex
+    """
+    return current_app.extensions.get('search_indexes', None)
+
+
+def search(entity, column, query, limit=10):
+    """
+    Search the names of a table, through its NameIndex when it is up to date
+    for the request, or else through an index of the names read right away
+    :param entity: The DbEntity class of the table
+    :param column: The name column
+    :param query: See `NameIndex.search`
+    :param limit: See `NameIndex.search`
+    :return: See `NameIndex.search`
+    """
+    index = (search_indexes() or {}).get(entity.__table__, None)
+    if index is None or not index.usable():
+        index = NameIndex(entity, column)
+        index.load(index.records())
+    return index.search(query, limit)
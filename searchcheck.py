@@ -0,0 +1,114 @@
+"""
+Checks that search.NameIndex ranks names the same whatever the number of
+matches asked for: the first `limit` matches of a search must be the first
+`limit` of the same search with a much larger limit, up to the order of
+names scoring the same. The early stops of `NameIndex.word_matches` rest on
+an upper bound of the scores of the names left unread, and a bound set too
+low shows up here as a better match missing from a short result list.
+
+The names are made up from the words bench.generate uses, plus the names
+of cases that went wrong before, so no database is needed.
+
+Usage: python searchcheck.py [--names 20000] [--queries 500] [--seed 545]
+"""
+import argparse
+import random
+import sys
+
+from bench import generate
+from entities import Food
+from search import NameIndex
+
+# (names, query, limit, ids): searches once ranked wrongly, over names given
+# ids 1, 2... in order, and the ids they must find
+CASES = [
+    ([u"chicken tomatoes rice", u"chicken tomato rice"], u"chikn tomatos ric", 1, [2]),
+]
+
+
+def index_of(names):
+    """
+    :param names: A list of names, given ids 1, 2... in order
+    :return: A NameIndex over them
+    """
+    index = NameIndex(Food, "food_name")
+    index.load([{"food_id": id, "food_name": name} for id, name in enumerate(names, 1)])
+    return index
+
+
+def misspelled(rng, word):
+    """
+    :param rng: A random.Random
+    :param word: A word
+    :return: The word with one letter dropped, as a typo would, if it is long enough
+    """
+    if len(word) < 4:
+        return word
+    i = rng.randint(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+
+def queries(rng, count):
+    """
+    Multi-word queries, some words misspelled and the last one often only begun
+    :param rng: A random.Random
+    :param count: The number of queries
+    :return: A list of queries
+    """
+    ret = []
+    for _ in range(count):
+        words = [rng.choice(generate.ADJECTIVES), rng.choice(generate.NOUNS), rng.choice(generate.DISHES)]
+        words = [misspelled(rng, word) if rng.random() < 0.5 else word for word in words[:rng.randint(1, 3)]]
+        if rng.random() < 0.5:
+            words[-1] = words[-1][:rng.randint(1, len(words[-1]))]
+        ret.append(u" ".join(words))
+    return ret
+
+
+def check(index, query, limit):
+    """
+    :param index: A NameIndex
+    :param query: The text searched
+    :param limit: The number of matches asked for
+    :return: A tuple of the matches found with `limit` and the first `limit` of a
+    longer search, or None if they score the same
+    """
+    short = index.search(query, limit)
+    full = index.search(query, 1000)[:limit]
+    return (short, full) if [score for _, _, score in short] != [score for _, _, score in full] else None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--names", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=545)
+    args = parser.parse_args(argv)
+
+    failures = []
+    for names, query, limit, ids in CASES:
+        index = index_of(names)
+        failure = check(index, query, limit)
+        if failure or [id for id, _, _ in index.search(query, limit)] != ids:
+            failures.append((query, limit) + (failure or (index.search(query, limit), ids)))
+
+    rng = random.Random(args.seed)
+    index = index_of([u"{} {} {}".format(rng.choice(generate.ADJECTIVES), rng.choice(generate.NOUNS),
+                                         rng.choice(generate.DISHES)) for _ in range(args.names)])
+    for query in queries(rng, args.queries):
+        for limit in (1, 5, 10):
+            failure = check(index, query, limit)
+            if failure:
+                failures.append((query, limit) + failure)
+
+    for query, limit, short, full in failures:
+        print(u"{!r} limit {}: {} instead of {}".format(query, limit, short, full))
+    if failures:
+        print("{} search(es) ranked differently with a smaller limit".format(len(failures)))
+        return 1
+    print("Searches rank the same at every limit")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
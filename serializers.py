@@ -0,0 +1,184 @@
+import timeit
+from datetime import date, datetime
+
+from flask import current_app, has_app_context
+from simplejson import dumps as simplejson_dumps
+
+from entities import Food, NutritionalFact, Recipe, Menu, ManyToMany
+from instrument import current_trace
+from records import Record
+
+try:
+    import ujson
+except ImportError:
+    # The fast backend is optional; simplejson is always there
+    ujson = None
+
+ENTITIES = {entity.__table__: entity for entity in (Food, NutritionalFact, Recipe, Menu)}
+
+
+def _simplejson(value):
+    return simplejson_dumps(value, separators=(",", ":"))
+
+
+def _ujson(value):
+    return ujson.dumps(value, ensure_ascii=True, escape_forward_slashes=False, double_precision=15)
+
+
+# Each backend turns converted records into compact JSON text. Only simplejson
+# encodes Decimal values, which MySQL returns for DECIMAL columns, as they are
+BACKENDS = {"simplejson": _simplejson}
+if ujson is not None:
+    BACKENDS["ujson"] = _ujson
+DECIMAL_BACKENDS = ("simplejson",)
+
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def _float(value):
+    return float(value)
+
+
+class EntitySerializer(object):
+    """
+    Converts the records of one entity, and the related records nested in
+    them, to values the JSON backend encodes natively. What each column needs
+    is worked out once, from the python types in the entity's __columns__,
+    so converting a record only touches the columns that need it: dates become
+    ISO strings, and DECIMAL values become floats for backends without
+    Decimal support. Dict records needing nothing are passed through uncopied,
+    and Records (see records.py), wherever they are nested, become dicts
+    """
+
+    def __init__(self, entity, backend):
+        """
+        :param entity: A DbEntity subclass
+        :param backend: A name from BACKENDS
+        """
+        self.entity = entity
+        converters = {date: _isoformat}
+        if backend not in DECIMAL_BACKENDS:
+            converters[float] = _float
+        self.columns = tuple((column, converters[kind]) for column, kind in sorted(entity.__columns__.items())
+                             if isinstance(kind, type) and kind in converters)
+        self.relations = tuple((name, serializer(ENTITIES[relation.table], backend), isinstance(relation, ManyToMany))
+                               for name, relation in sorted(entity.__relations__.items()))
+        self.passthrough = not self.columns and all(r[1].passthrough for r in self.relations)
+
+    def convert(self, record):
+        """
+        :param record: A dict-like record of the entity. Anything else, such as the
+        ids a record's relation was just set to, is returned as it is
+        :return: A record safe to hand to the backend
+        """
+        if isinstance(record, Record):
+            ret = record.as_dict()
+        elif not isinstance(record, dict) or (self.passthrough and not self.holds_records(record)):
+            return record
+        else:
+            ret = dict(record)
+        for column, convert in self.columns:
+            value = ret.get(column, None)
+            if value is not None:
+                ret[column] = convert(value)
+        for name, related, many in self.relations:
+            value = ret.get(name, None)
+            if value:
+                ret[name] = related.convert_many(value) if many else related.convert(value)
+        return ret
+
+    def convert_many(self, records):
+        """
+        :param records: A list of dict-like records of the entity
+        :return: A list of records safe to hand to the backend
+        """
+        if self.passthrough and not self.holds_records(records):
+            return records
+        convert = self.convert
+        return [convert(record) for record in records]
+
+    def holds_records(self, value):
+        """
+        Whether a record of the entity, or a list of them, is or nests a Record,
+        e.g. one a relation of a record sent in a request was loaded with
+        :param value: A record, a list of records, or anything else
+        :return:
+        """
+        if isinstance(value, list):
+            return any(self.holds_records(v) for v in value)
+        if isinstance(value, Record):
+            return True
+        if not isinstance(value, dict):
+            return False
+        return any(related.holds_records(value.get(name, None)) for name, related, _ in self.relations)
+
+
+_serializers = dict()
+
+
+def serializer(entity, backend):
+    """
+    The EntitySerializer of an entity for a backend, built on first use
+    :param entity: A DbEntity subclass
+    :param backend: A name from BACKENDS
+    :return:
+    """
+    ret = _serializers.get((entity, backend), None)
+    if ret is None:
+        ret = _serializers[(entity, backend)] = EntitySerializer(entity, backend)
+    return ret
+
+
+def backend_name():
+    """
+    The backend picked by JSON_BACKEND: "auto" uses ujson when it is installed
+    :return: A name from BACKENDS
+    """
+    wanted = current_app.config['JSON_BACKEND'] if has_app_context() else "auto"
+    if wanted == "auto":
+        return "ujson" if "ujson" in BACKENDS else "simplejson"
+    if wanted not in BACKENDS:
+        raise ValueError("JSON backend {} is not available".format(wanted))
+    return wanted
+
+
+def serialize(entity, records):
+    """
+    Prepares records of an entity for `dumps`
+    :param entity: A DbEntity subclass
+    :param records: A list of records, or a single record
+    :return:
+    """
+    compiled = serializer(entity, backend_name())
+    if isinstance(records, list):
+        return compiled.convert_many(records)
+    return compiled.convert(records)
+
+
+def dumps(value):
+    """
+    Encodes a value built from `serialize`d records as compact JSON. The time
+    spent is reported in the request's Server-Timing header
+    :param value:
+    :return: The JSON text
+    """
+    start = timeit.default_timer()
+    try:
+        return BACKENDS[backend_name()](value)
+    finally:
+        trace = current_trace() if has_app_context() else None
+        if trace is not None:
+            trace.serialize_time += timeit.default_timer() - start
+
+
+def json_response(payload, status=200):
+    """
+    A JSON response holding `payload`, which must only contain values
+    the backends encode natively, e.g. records passed through `serialize`
+    :param payload: The dict to send
+    :param status: The status code
+    :return: A flask Response
+    """
+    return current_app.response_class(dumps(payload), status=status, mimetype='application/json')
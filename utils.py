@@ -1,11 +1,23 @@
+import hashlib
+import timeit
+from collections import OrderedDict
 from datetime import date
 from datetime import datetime
 from functools import wraps, update_wrapper
 
-from flask import make_response
+from flask import make_response, g, request, current_app, Response, stream_with_context, has_app_context
 from simplejson import JSONEncoder
 from werkzeug.routing import BaseConverter
 
+from entities import InvalidPage
+from instrument import current_trace
+from serializers import serialize, dumps
+from versions import table_versions
+
+# The most ids one request to a multi-get route may ask for, which SQLite
+# still reads with one statement (see dialects.SQLiteDialect.batch_size)
+MAX_IDS = 500
+
 
 class CustomJSONEncoder(JSONEncoder):
     """
@@ -23,6 +35,16 @@ class CustomJSONEncoder(JSONEncoder):
             return "".join(list(iterable))
         return JSONEncoder.default(self, obj)
 
+    def encode(self, obj):
+        # The time spent encoding is reported in the request's Server-Timing header
+        start = timeit.default_timer()
+        try:
+            return JSONEncoder.encode(self, obj)
+        finally:
+            trace = current_trace() if has_app_context() else None
+            if trace is not None:
+                trace.serialize_time += timeit.default_timer() - start
+
 
 class DateConverter(BaseConverter):
     """
@@ -37,6 +59,50 @@ class DateConverter(BaseConverter):
         return value.isoformat()
 
 
+def stream_json(key, records, entity, batch_size=100):
+    """
+    Builds a chunked response with the JSON object {key: [records...]}, encoding
+    the records as they are pulled from `records` instead of holding the whole
+    body in memory. Pair it with DbEntity.iterate to stream a table straight
+    from a server-side cursor to the client
+    :param key: The name of the top-level attribute holding the list
+    :param records: An iterable of records
+    :param entity: The DbEntity subclass of the records, see serializers.serialize
+    :param batch_size: How many records are encoded into each chunk sent to the client
+    :return: A streamed flask Response
+    """
+    def generate():
+        yield '{{"{}":['.format(key)
+        batch = []
+        separator = ""
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                # Strip the brackets of the encoded list
+                yield separator + dumps(serialize(entity, batch))[1:-1]
+                separator = ","
+                batch = []
+        if batch:
+            yield separator + dumps(serialize(entity, batch))[1:-1]
+        yield "]}"
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def no_cache_headers(response):
+    """
+    Sets the headers that prevent clients from caching a response
+    :param response: A flask response
+    :return: The response
+    """
+    response.headers['Last-Modified'] = datetime.now()
+    response.headers[
+        'Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '-1'
+    return response
+
+
 def nocache(view):
     """
     Adds response headers to prevent clients from caching
@@ -46,27 +112,166 @@ def nocache(view):
     """
     @wraps(view)
     def no_cache(*args, **kwargs):
-        response = make_response(view(*args, **kwargs))
-        response.headers['Last-Modified'] = datetime.now()
-        response.headers[
-            'Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '-1'
-        return response
+        return no_cache_headers(make_response(view(*args, **kwargs)))
 
     return update_wrapper(no_cache, view)
 
 
-def check_date(date):
+def cached(*tables):
     """
-    Checks the validity of a string as a date string suitable
-    for the database.
-    :param date:
+    Lets clients cache a GET route and revalidate it with If-None-Match. The
+    ETag is built from the versions of the tables the route reads, which
+    every write through a DbEntity or a DELETE route bumps, so a matching
+    request is answered with a 304 before the view runs and without touching
+    the database. Responses other than a 200 are sent with the `nocache`
+    headers, as they are when CONDITIONAL_GETS is off
+    :param tables: The names of the tables the route's response is built from
+    :return:
+    """
+    def decorator(view):
+        uncached = nocache(view)
+
+        @wraps(view)
+        def conditional(*args, **kwargs):
+            if not current_app.config['CONDITIONAL_GETS']:
+                return uncached(*args, **kwargs)
+            versions = table_versions()
+            etag = hashlib.sha1("{}|{}|{}".format(repr(versions.epoch),
+                                                  request.full_path,
+                                                  versions.get(*tables)).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return no_cache_headers(response)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return update_wrapper(conditional, view)
+
+    return decorator
+
+
+def autocommit(view):
+    """
+    Opts a view out of the request transaction: every write the
+    view makes through a DbEntity is committed as soon as it is made
+    :param view:
+    :return:
+    """
+    @wraps(view)
+    def autocommitted(*args, **kwargs):
+        db = getattr(g, '_db', None)
+        if db is not None and not getattr(g, 'autocommit', False):
+            db.commit()
+        g.autocommit = True
+        return view(*args, **kwargs)
+
+    return update_wrapper(autocommitted, view)
+
+
+def max_queries(cap):
+    """
+    Caps the number of statements (including the BEGIN and COMMIT of the
+    request's transaction) a view may run, in place of SQL_QUERY_CAP. A view
+    going over its cap raises instrument.TooManyQueries in testing mode, so
+    a change that brings back a query per record fails loudly
+    :param cap: The most statements the view may run
     :return:
     """
+    def decorator(view):
+        @wraps(view)
+        def capped(*args, **kwargs):
+            trace = current_trace()
+            if trace is not None:
+                trace.cap = cap
+            return view(*args, **kwargs)
+
+        return update_wrapper(capped, view)
+
+    return decorator
+
+
+def page_args():
+    """
+    Reads the keyset pagination parameters from the query string: `limit`,
+    the page size, and `after`, the cursor returned as "next" by the
+    previous page. Raises an InvalidPage error for a malformed limit
+    :return: A tuple of (limit, after), each None when not given
+    """
+    limit = request.args.get('limit', None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise InvalidPage("Page size must be a positive number")
+    return limit, request.args.get('after', None)
+
+
+def id_args():
+    """
+    Reads the `ids` query string parameter of the multi-get routes: record
+    ids separated by commas, e.g. ?ids=3,1,2. Repeated ids are read once
+    :return: A list of the ids in the order given, or None if the parameter
+    is missing, holds something other than ids or more than MAX_IDS of them
+    """
     try:
-        import datetime
-        datetime.datetime.strptime(date, '%Y-%m-%d')
+        ids = list(OrderedDict.fromkeys(int(value) for value in request.args.get('ids', '').split(',')))
     except ValueError:
+        return None
+    return ids if len(ids) <= MAX_IDS else None
+
+
+def in_order(ids, found):
+    """
+    Lines the records found by a multi-get route up with the ids requested
+    :param ids: The ids requested, from `id_args`
+    :param found: A dict of id to record, such as `DbEntity.find_by_ids` returns
+    :return: A tuple of the records found, in the order of `ids`, and the ids not found
+    """
+    return [found[id] for id in ids if id in found], [id for id in ids if id not in found]
+
+
+def paged(payload, entity, limit):
+    """
+    Adds the cursor of the next page to a response payload
+    when the records in it were requested a page at a time
+    :param payload: The dict to be sent as the response
+    :param entity: The DbEntity the page was loaded with
+    :param limit: The requested page size, or None
+    :return: The payload
+    """
+    if limit is not None:
+        payload['next'] = entity.next_page
+    return payload
+
+
+def check_date(value):
+    """
+    Checks the validity of a string as a date string suitable
+    for the database. Dates already parsed by the `date` URL
+    converter are always valid
+    :param value:
+    :return:
+    """
+    if isinstance(value, date):
+        return True
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
         return False
     return True
+
+
+def as_date(value):
+    """
+    :param value: A date, or a DATE column value as a 'YYYY-MM-DD' string
+    :return: A date
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d").date()
@@ -0,0 +1,196 @@
+import fcntl
+import mmap
+import os
+import struct
+import uuid
+
+from flask import current_app, g
+
+# The tables a delete cascades to through the triggers in
+# resources/mysql_schema.sql. Deleting from a table also changes
+# the data of every table it cascades to
+CASCADES = {
+    "food": ["nutritional_fact", "ingredients"],
+    "recipes": ["ingredients", "serves"],
+    "menu": ["serves"],
+    "nutritional_fact": ["food"],
+}
+
+TABLES = ["food", "nutritional_fact", "recipes", "ingredients", "menu", "serves"]
+
+# Callables told about every published write, see `publish_changes`
+listeners = []
+
+_EPOCH = struct.Struct("16s")
+_COUNTER = struct.Struct("Q")
+
+
+class TableVersions(object):
+    """
+    Per-table change counters shared by every process serving the app. The
+    counters live in a small memory-mapped file, so a gunicorn worker sees the
+    writes made through any other worker without asking the database. The file
+    starts with a random epoch written when it is created, so versions handed out
+    before the file was recreated (e.g. after a reboot cleaned /tmp) never match
+    versions handed out after.
+    """
+
+    def __init__(self, path, tables=TABLES):
+        """
+        :param path: The file the counters are kept in. Created if it does not exist
+        :param tables: The table names to keep counters for
+        """
+        self.path = path
+        self.tables = list(tables)
+        self._offsets = {table: _EPOCH.size + i * _COUNTER.size for i, table in enumerate(self.tables)}
+        self._size = _EPOCH.size + len(self.tables) * _COUNTER.size
+        self._map = None
+        self._pid = None
+
+    def _mapped(self):
+        # Map the file lazily and again after a fork, so each process
+        # holds its own mapping of the shared file
+        if self._map is None or self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < self._size:
+                        os.ftruncate(fd, 0)
+                        os.write(fd, _EPOCH.pack(uuid.uuid4().bytes) + b"\0" * (self._size - _EPOCH.size))
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._map = mmap.mmap(fd, self._size)
+                self._fd = fd
+            except Exception:
+                os.close(fd)
+                raise
+            self._pid = os.getpid()
+        return self._map
+
+    @property
+    def epoch(self):
+        """
+        The random id of the current counter file
+        :return:
+        """
+        return _EPOCH.unpack_from(self._mapped(), 0)[0]
+
+    def get(self, *tables):
+        """
+        Read the current version of each table
+        :param tables: Table names
+        :return: A tuple of versions in the same order as `tables`
+        """
+        mapped = self._mapped()
+        return tuple(_COUNTER.unpack_from(mapped, self._offsets[table])[0] for table in tables)
+
+    def bump(self, *tables):
+        """
+        Advance the version of each table
+        :param tables: Table names
+        :return: A dict of table name to its new version
+        """
+        mapped = self._mapped()
+        bumped = dict()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for table in set(tables):
+                if table in self._offsets:
+                    offset = self._offsets[table]
+                    bumped[table] = _COUNTER.unpack_from(mapped, offset)[0] + 1
+                    _COUNTER.pack_into(mapped, offset, bumped[table])
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return bumped
+
+
+def table_versions():
+    """
+    The TableVersions of the running app
+    :return:
+    """
+    return current_app.extensions['table_versions']
+
+
+def cascaded(table):
+    """
+    A table plus every table that deleting from it changes through the triggers
+    :param table: A table name
+    :return: A list of table names
+    """
+    return [table] + CASCADES.get(table, [])
+
+
+def mark_changed(*tables):
+    """
+    Record that the current request wrote to tables. Their versions are
+    bumped by `publish_changes` once the writes have been committed, so
+    no other worker can pair a new version with data that is not yet visible.
+    Entries read from the tables are dropped from this process' entity cache
+    :param tables: Table names
+    :return:
+    """
+    keys = _changed(tables)
+    for table in tables:
+        keys[table] = None
+
+
+def mark_keys_changed(table, ids):
+    """
+    Like `mark_changed`, for a write that only touched the rows of a table
+    with the given primary keys. The keys are handed to the `listeners`
+    when the write is published, unless the request also wrote to the table
+    in a way it did not record with this function
+    :param table: A table name
+    :param ids: The primary keys of the rows written. For an association table,
+    the keys of the owning rows whose links were replaced, e.g. recipe ids for ingredients
+    :return:
+    """
+    keys = _changed([table])
+    if table not in keys:
+        keys[table] = set()
+    if keys[table] is not None:
+        keys[table].update(ids)
+
+
+def _changed(tables):
+    changed = getattr(g, 'changed_tables', None)
+    if changed is None:
+        changed = g.changed_tables = set()
+        g.changed_keys = dict()
+    changed.update(tables)
+    cache = current_app.extensions.get('entity_cache', None)
+    if cache is not None:
+        cache.invalidate(*tables)
+    return g.changed_keys
+
+
+def publish_changes():
+    """
+    Bump the versions of every table the current request has written to
+    since the last call, then call each of the `listeners` with a dict of
+    those tables to their new versions and a dict of the same tables to the
+    set of primary keys written (see `mark_keys_changed`), or to None where
+    the rows written are not known. Call right after committing
+    :return:
+    """
+    changed = getattr(g, 'changed_tables', None)
+    if changed:
+        bumped = table_versions().bump(*changed)
+        keys = g.changed_keys
+        for listener in listeners:
+            listener(bumped, dict((table, keys.get(table, None)) for table in changed))
+        changed.clear()
+        keys.clear()
+
+
+def discard_changes():
+    """
+    Forget the tables written by the current request, e.g. after a rollback
+    :return:
+    """
+    changed = getattr(g, 'changed_tables', None)
+    if changed:
+        changed.clear()
+        g.changed_keys.clear()
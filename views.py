@@ -1,23 +1,66 @@
-from copy import deepcopy
-
-from flask import request, jsonify, g
+from flask import request, jsonify, g, abort, Response
 
 from app import app
-from entities import Food, Menu, NutritionalFact, Recipe
-from utils import nocache, check_date
+from cache import entity_cache
+from metrics import request_metrics
+from entities import Food, Menu, NutritionalFact, Recipe, InvalidPage, InvalidRecord, RecordNotFound
+from cookable import cookable, cookable_index
+from fridge import fridge_index, in_fridge
+from menu_calendar import at, between, calendar_index
+from nutrition import NUTRIENTS, report
+from queries import statements
+from search import search, search_indexes, MAX_RESULTS
+from versions import mark_changed, mark_keys_changed, cascaded
+from serializers import serialize, json_response
+from utils import nocache, cached, max_queries, check_date, stream_json, page_args, paged, id_args, in_order, MAX_IDS
+
+
+@app.errorhandler(InvalidPage)
+def invalid_page(error):
+    """
+    Answers requests for a page with a bad `limit` or `after` parameter
+    :param error:
+    :return:
+    """
+    return jsonify({"error": str(error)}), 400
+
+
+@app.errorhandler(InvalidRecord)
+def invalid_record(error):
+    """
+    Answers writes holding a primary key that is not a valid id
+    :param error:
+    :return:
+    """
+    return jsonify({"error": str(error)}), 400
+
+
+@app.errorhandler(RecordNotFound)
+def record_not_found(error):
+    """
+    Answers writes updating records that do not exist. Nothing they hold is written
+    :param error:
+    :return:
+    """
+    return jsonify({"error": str(error), "missing": error.ids}), 404
 
 
 ################
 # FRIDGE ROUTE #
 ################
 @app.route('/fridge/', methods=["GET"])
-@nocache
+@cached("food")
+@max_queries(4)
 def fridge():
     """
-    Gets all food records that have their in_fridge attribute set to true
+    Gets all food records that have their in_fridge attribute set to true. Accepts the
+    `limit` and `after` query parameters to fetch the records a page at a time
     :return: A JSON object of {"fridge": [<a list of food records in the form of JSON objects>]}
     """
-    return jsonify({"fridge": [food for food in Food().all(comparisons={"in_fridge": ["=", True]})]})
+    limit, after = page_args()
+    food = Food()
+    fridge = in_fridge(food, limit=limit, after=after)
+    return json_response(paged({"fridge": serialize(Food, fridge)}, food, limit))
 
 
 #################
@@ -52,35 +95,25 @@ def recipe_update_create():
     """
     if not request.json or len(request.json) == 0:
         return jsonify({"error": "No JSON supplied"}), 400
-    id_column = Recipe.__keys__[0]
-    ret_val = []
     rec = Recipe()
     j = request.json
     if not j.get('recipes', None):
         return jsonify({"error": "Invalid input schema"}), 400
 
     for recipe in j['recipes']:
-        recipe_id = recipe.get(id_column, None)
         # Enforce enums
         if recipe.get("category", None) and recipe['category'] not in Recipe.__columns__['category']:
             return jsonify({
                 "error": "Categories must be one of the following: {}".format(Recipe.__columns__['category'])}
             ), 400
-        if recipe_id:
-            rec.find_by_id(recipe_id)
-            rec.update(**recipe)
-            rec.flush()
-        else:
-            rec.create(**recipe)
-        if recipe.get('ingredients', None):
-            try:
-                rec.ingredients = recipe['ingredients']
-            except TypeError:
-                return jsonify({
-                    "error": "Ingredient entries must be a list of ids referencing food items in the database"
-                }), 400
-        ret_val.append(deepcopy(rec.data))
-    return jsonify({"recipes": ret_val})
+    ret_val = rec.bulk_save(j['recipes'])
+    try:
+        rec.set_relations([recipe for recipe in ret_val if recipe.get('ingredients', None)], "ingredients")
+    except TypeError:
+        return jsonify({
+            "error": "Ingredient entries must be a list of ids referencing food items in the database"
+        }), 400
+    return json_response({"recipes": serialize(Recipe, ret_val)})
 
 
 @app.route('/recipe/<int:rec_id>/del/', methods=["DELETE"])
@@ -95,38 +128,85 @@ def recipe_delete(rec_id):
     cursor = g.db.cursor()
     res = cursor.execute("DELETE FROM {table} WHERE {key}=%s".format(table=Recipe.__table__,
                                                                      key=Recipe.__keys__[0]), (rec_id,))
-    g.db.commit()
     cursor.close()
+    if res:
+        mark_changed(*cascaded(Recipe.__table__))
     return jsonify({"success": res != 0})
 
 
 @app.route("/recipe/all/", methods=["GET"])
-@nocache
+@cached("recipes", "ingredients", "food")
+@max_queries(6)
 def get_all_recipes():
     """
-    Fetch all recipes in the database
+    Fetch all recipes in the database. Accepts the `limit` and `after` query
+    parameters to fetch the recipes a page at a time
     :return: JSON data in the form of {"recipes":[<list of JSON objects representing the recipes and their ingredients>]}
     """
-    recipes = Recipe().all()
-    cursor = g.db.cursor()
+    limit, after = page_args()
+    if app.config['STREAM_RESPONSES'] and limit is None:
+        return stream_json("recipes", Recipe().iterate(relation="ingredients"), Recipe)
+    rec = Recipe()
+    recipes = rec.all(limit=limit, after=after)
+    rec.load_relations(recipes, "ingredients")
+
+    return json_response(paged({"recipes": serialize(Recipe, recipes)}, rec, limit))
+
+
+@app.route("/recipe/cookable/", methods=["GET"])
+@cached("recipes", "ingredients", "food")
+@max_queries(7)
+def get_cookable_recipes():
+    """
+    Get the recipes that can be cooked with the food in the fridge. Accepts `missing`,
+    the most ingredients a recipe may lack (0 by default), and the `limit` and `after`
+    query parameters to fetch the recipes a page at a time. Recipes with no ingredients
+    are left out
+    :return: JSON data in the form of {"recipes":[<list of JSON objects representing the recipes,
+    their ingredients, and as "missing" the ids of their ingredients not in the fridge>]}
+    """
+    try:
+        missing = int(request.args.get('missing', 0))
+    except ValueError:
+        missing = -1
+    if missing < 0:
+        return jsonify({"error": "missing must be a number of ingredients"}), 400
+    limit, after = page_args()
+    rec = Recipe()
+    key = Recipe.__keys__[0]
+    # The page and its cursor follow the index, so a recipe deleted since it was read is only left out
+    found = rec.paginate([{key: id, "missing": lacking} for id, lacking in cookable(rec, missing, limit, after)], limit)
+    recipes, _ = in_order([entry[key] for entry in found], rec.find_many([entry[key] for entry in found]))
+    lacking = dict((entry[key], entry["missing"]) for entry in found)
     for recipe in recipes:
-        id_val = recipe[Recipe.__keys__[0]]
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.food\n"
-            "WHERE food_id IN (SELECT food_id\n"
-            "                  FROM mongoose.ingredients\n"
-            "                  WHERE recipe_id = %s)",
-            (id_val,))
-        ingredients = cursor.fetchall()
-        recipe['ingredients'] = ingredients
-    cursor.close()
+        recipe["missing"] = lacking[recipe[key]]
+    rec.load_relations(recipes, "ingredients")
+    return json_response(paged({"recipes": serialize(Recipe, recipes)}, rec, limit))
 
-    return jsonify({"recipes": recipes})
+
+@app.route("/recipe/many/", methods=["GET"])
+@cached("recipes", "ingredients", "food")
+@max_queries(6)
+def get_many_recipes():
+    """
+    Gets many recipes by their ids, given as the `ids` query parameter (e.g.
+    ?ids=3,1,2). The recipes are read with one query, and their ingredients with another
+    :return: JSON data in the form of {"recipes":[<list of JSON objects representing the recipes
+    found and their ingredients, in the order of the ids>], "missing": [<the ids not found>]}
+    """
+    ids = id_args()
+    if ids is None:
+        return jsonify({"error": "ids must be a comma separated list of at most {} ids".format(MAX_IDS)}), 400
+
+    rec = Recipe()
+    recipes, missing = in_order(ids, rec.find_by_ids(ids))
+    rec.load_relations(recipes, "ingredients")
+    return json_response({"recipes": serialize(Recipe, recipes), "missing": missing})
 
 
 @app.route("/recipe/<int:rec_id>/", methods=["GET"])
-@nocache
+@cached("recipes", "ingredients", "food")
+@max_queries(6)
 def get_recipe_by_id(rec_id):
     """
     Gets a single recipe by its id
@@ -137,46 +217,27 @@ def get_recipe_by_id(rec_id):
     if not recipe:
         return jsonify({"error": "No recipe with id {} found".format(rec_id)}), 404
 
-    id_val = recipe[Recipe.__keys__[0]]
-    cursor = g.db.cursor()
-    cursor.execute(
-        "SELECT *\n"
-        "FROM mongoose.food\n"
-        "WHERE food_id IN (SELECT food_id\n"
-        "                  FROM mongoose.ingredients\n"
-        "                  WHERE recipe_id = %s)",
-        (id_val,))
-    ingredients = cursor.fetchall()
-    recipe['ingredients'] = ingredients
-    cursor.close()
-    return jsonify(recipe)
+    Recipe().load_relations([recipe], "ingredients")
+    return json_response(serialize(Recipe, recipe))
 
 
 @app.route("/recipe/<string:rec_name>/", methods=["GET"])
-@nocache
+@cached("recipes", "ingredients", "food")
+@max_queries(6)
 def get_recipe_by_name(rec_name):
     """
-    Get all recipes that match a name
+    Get all recipes that match a name. Accepts the `limit` and `after` query
+    parameters to fetch the recipes a page at a time
     :param rec_name: A string value with a recipe name
     :return: JSON data in the form of {"recipes":[<list of JSON objects representing the recipes and their ingredients>]}
     """
-    recipes = Recipe().find_by_attribute("rec_name", rec_name, limit=-1)
-    if not recipes:
+    limit, after = page_args()
+    rec = Recipe()
+    recipes = rec.all(comparisons={"rec_name": ["=", rec_name]}, limit=limit, after=after)
+    if not recipes and after is None:
         return jsonify(({"error": "No recipes with name \"{}\" found".format(rec_name)})), 404
-    cursor = g.db.cursor()
-    for recipe in recipes:
-        id_val = recipe[Recipe.__keys__[0]]
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.food\n"
-            "WHERE food_id IN (SELECT food_id\n"
-            "                  FROM mongoose.ingredients\n"
-            "                  WHERE recipe_id = %s)",
-            (id_val,))
-        ingredients = cursor.fetchall()
-        recipe['ingredients'] = ingredients
-    cursor.close()
-    return jsonify({"recipes": recipes})
+    rec.load_relations(recipes, "ingredients")
+    return json_response(paged({"recipes": serialize(Recipe, recipes)}, rec, limit))
 
 
 ###############
@@ -211,28 +272,20 @@ def food_update_create():
     """
     if not request.json or len(request.json) == 0:
         return jsonify({"error": "No JSON supplied"}), 400
-    id_column = Food.__keys__[0]
-    ret_val = []
     f = Food()
     j = request.json
     if not j.get('food', None):
         return jsonify({"error": "Invalid schema"}), 400
-    for food in j['food']:
-        food_id = food.get(id_column, None)
-        if food_id:
-            f.find_by_id(food_id)
-            f.update(**food)
-            f.flush()
-        else:
-            f.create(**food)
-        if j.get('nutrition', None):
-            try:
-                f.nutrition = j['nutrition']
-            except TypeError:
-                return jsonify({"error": "Nutrition entries must be objects similar to nutritional_fact schema"}), 400
-        ret_val.append(deepcopy(f.data))
-
-    return jsonify({"food": ret_val})
+    if j.get('nutrition', None) and not isinstance(j['nutrition'], dict):
+        return jsonify({"error": "Nutrition entries must be objects similar to nutritional_fact schema"}), 400
+    ret_val = f.bulk_save(j['food'])
+    if j.get('nutrition', None):
+        f.load_relations(ret_val, "nutrition")
+        for food in ret_val:
+            food['nutrition'] = dict(food['nutrition'])
+            food['nutrition'].update(j['nutrition'])
+
+    return json_response({"food": serialize(Food, ret_val)})
 
 
 @app.route("/food/<int:id>/del/", methods=["DELETE"])
@@ -245,59 +298,85 @@ def delete_food_item(id):
     """
     id_col = Food.__keys__[0]
     cursor = g.db.cursor()
-    ret = cursor.execute("DELETE FROM mongoose.food WHERE {key}=%s".format(key=id_col), (id,))
-    g.db.commit()
+    ret = cursor.execute("DELETE FROM {table} WHERE {key}=%s".format(table=Food.__table__, key=id_col), (id,))
     cursor.close()
+    if ret:
+        mark_changed(*cascaded(Food.__table__))
     return jsonify({"success": ret != 0})
 
 
 @app.route("/food/all/", methods=["GET"])
-@nocache
+@cached("food", "nutritional_fact")
+@max_queries(4)
 def get_all_food():
     """
-    Get all food in the database
+    Get all food in the database. Accepts the `limit` and `after` query
+    parameters to fetch the food a page at a time
     :return: A JSON structure in the form of
     {"food":[<list of JSON objects representing food records in the database and their nutrition facts>]}
     """
-    all_food = Food().all()
-    for food in all_food:
-        food['nutrition'] = NutritionalFact().find_by_id(food['fk_nfact_id']) or dict()
+    limit, after = page_args()
+    if app.config['STREAM_RESPONSES'] and limit is None:
+        return stream_json("food", Food().iterate(relation="nutrition"), Food)
+    f = Food()
+    all_food = f.all_joined("nutrition", limit=limit, after=after)
+
+    return json_response(paged({"food": serialize(Food, all_food)}, f, limit))
+
+
+@app.route("/food/many/", methods=["GET"])
+@cached("food", "nutritional_fact")
+@max_queries(5)
+def get_many_food():
+    """
+    Get many food records by their ids, given as the `ids` query parameter (e.g.
+    ?ids=3,1,2). The food is read with one query, and its nutritional facts with another
+    :return: A JSON structure in the form of {"food":[<list of JSON objects representing the food
+    records found and their nutrition facts, in the order of the ids>], "missing": [<the ids not found>]}
+    """
+    ids = id_args()
+    if ids is None:
+        return jsonify({"error": "ids must be a comma separated list of at most {} ids".format(MAX_IDS)}), 400
 
-    return jsonify({"food": all_food})
+    f = Food()
+    food, missing = in_order(ids, f.find_by_ids(ids))
+    f.load_relations(food, "nutrition")
+    return json_response({"food": serialize(Food, food), "missing": missing})
 
 
 @app.route("/food/<int:id>/", methods=["GET"])
-@nocache
+@cached("food", "nutritional_fact")
+@max_queries(4)
 def get_food_by_id(id):
     """
     Get a single food record by its id
     :param id: The numeric id of the food record to find
     :return: A JSON object representation of the food record along with its nutritional facts
     """
-    food = Food().find_by_id(id)
+    food = Food().all_joined("nutrition", comparisons={Food.__keys__[0]: ["=", id]})
     if not food:
         return jsonify({"error": "No food with id {} found".format(id)}), 404
 
-    food['nutrition'] = NutritionalFact().find_by_id(food['fk_nfact_id']) or dict()
-
-    return jsonify(food)
+    return json_response(serialize(Food, food[0]))
 
 
 @app.route("/food/<string:food_name>/", methods=["GET"])
-@nocache
+@cached("food", "nutritional_fact")
+@max_queries(4)
 def get_food_by_name(food_name):
     """
-    Get all foods that have the food name
+    Get all foods that have the food name. Accepts the `limit` and `after` query
+    parameters to fetch the food a page at a time
     :param food_name: The food name to search for
     :return: A JSON structure in the form of
     {"food":[<list of JSON objects representing food records in the database and their nutrition facts>]}
     """
-    food = Food().find_by_attribute("food_name", food_name, limit=-1)
-    if not food:
+    limit, after = page_args()
+    f = Food()
+    food = f.all_joined("nutrition", comparisons={"food_name": ["=", food_name]}, limit=limit, after=after)
+    if not food and after is None:
         return jsonify({"error": "No food with name {} found".format(food_name)}), 404
-    for f in food:
-        f['nutrition'] = NutritionalFact().find_by_id(f['fk_nfact_id']) or dict()
-    return jsonify({"food": food})
+    return json_response(paged({"food": serialize(Food, food)}, f, limit))
 
 
 ####################
@@ -336,22 +415,10 @@ def nutrition_post():
     """
     if not request.json or len(request.json) == 0:
         return jsonify({"error": "No JSON supplied"}), 400
-    id_column = NutritionalFact.__keys__[0]
-    ret_val = []
-    nfact = NutritionalFact()
     j = request.json
     if not j.get('facts', None):
         return jsonify({"error": "Invalid schema"}), 400
-    for fact in j['facts']:
-        fact_id = fact.get(id_column, None)
-        if fact_id:
-            nfact.find_by_id(fact_id)
-            nfact.update(**fact)
-            nfact.flush()
-        else:
-            nfact.create(**fact)
-        ret_val.append(deepcopy(nfact.data))
-    return jsonify({"nutritional_facts": ret_val})
+    return json_response({"nutritional_facts": serialize(NutritionalFact, NutritionalFact().bulk_save(j['facts']))})
 
 
 @app.route("/nutrition/<int:nfact_id>/del/", methods=["DELETE"])
@@ -369,24 +436,51 @@ def nutrition_delete(nfact_id):
     res = cursor.execute(
         "DELETE FROM {table} WHERE {id_column}=%s".format(table=NutritionalFact.__table__, id_column=id_column),
         (nfact_id,))
-    g.db.commit()
     cursor.close()
+    if res:
+        mark_changed(*cascaded(NutritionalFact.__table__))
     return jsonify({"success": res != 0})
 
 
 @app.route("/nutrition/all/", methods=["GET"])
-@nocache
+@cached("nutritional_fact")
+@max_queries(4)
 def get_all_nutrition():
     """
-    Get all nutrition facts in the database
+    Get all nutrition facts in the database. Accepts the `limit` and `after` query
+    parameters to fetch the facts a page at a time
     :return: A JSON object of the following structure
     {"nutritional_facts":[<list of objects with similar structure to nutritional_fact schema>]}
     """
-    return jsonify({"nutritional_facts": NutritionalFact().all()})
+    limit, after = page_args()
+    if app.config['STREAM_RESPONSES'] and limit is None:
+        return stream_json("nutritional_facts", NutritionalFact().iterate(), NutritionalFact)
+    nfact = NutritionalFact()
+    facts = nfact.all(limit=limit, after=after)
+    return json_response(paged({"nutritional_facts": serialize(NutritionalFact, facts)}, nfact, limit))
+
+
+@app.route("/nutrition/many/", methods=["GET"])
+@cached("nutritional_fact")
+@max_queries(4)
+def get_many_nutrition():
+    """
+    Get many nutritional facts by their ids, given as the `ids` query parameter
+    (e.g. ?ids=3,1,2), with one query
+    :return: A JSON structure in the form of {"nutritional_facts":[<list of JSON objects representing
+    the nutritional facts found, in the order of the ids>], "missing": [<the ids not found>]}
+    """
+    ids = id_args()
+    if ids is None:
+        return jsonify({"error": "ids must be a comma separated list of at most {} ids".format(MAX_IDS)}), 400
+
+    facts, missing = in_order(ids, NutritionalFact().find_by_ids(ids))
+    return json_response({"nutritional_facts": serialize(NutritionalFact, facts), "missing": missing})
 
 
 @app.route('/nutrition/<int:nfact_id>/', methods=["GET"])
-@nocache
+@cached("nutritional_fact")
+@max_queries(4)
 def get_nutrition_by_id(nfact_id):
     """
     Get a nutrtional fact by its id
@@ -397,7 +491,7 @@ def get_nutrition_by_id(nfact_id):
     if not nutritional_fact:
         return jsonify({"error": "No nutritional fact with id {} found".format(nfact_id)}), 404
 
-    return jsonify(nutritional_fact)
+    return json_response(serialize(NutritionalFact, nutritional_fact))
 
 
 ###############
@@ -432,13 +526,10 @@ def menu_post():
     if not request.json or len(request.json) == 0:
         return jsonify({"error": "No JSON supplied"}), 400
 
-    id_col = Menu.__keys__[0]
     menu = Menu()
-    ret_val = []
     if not request.json.get('menus', None):
         return jsonify({"error": "Invalid schema"}), 400
     for m in request.json['menus']:
-        menu_id = m.get(id_col, None)
         # check for data validity
         # Enforce a datetime format
         if m.get('date', None) and not check_date(m['date']):
@@ -448,51 +539,59 @@ def menu_post():
             if m['time_of_day'] not in Menu.__columns__['time_of_day']:
                 return jsonify({"error": "{} is not a valid time of day".format(m['time_of_day'])}), 400
 
-        if menu_id:
-            menu.find_by_id(menu_id)
-            menu.update(**m)
-            menu.flush()
-        else:
-            menu.create(**m)
-        if m.get('recipes', None) is not None:
-            try:
-                menu.recipes = m['recipes']
-            except TypeError:
-                return jsonify(
-                    {"error": "Invalid data. The recipes attribute must be a list of numeric recipe ids"}), 400
-
-        ret_val.append(deepcopy(menu.data))
+    ret_val = menu.bulk_save(request.json['menus'])
+    try:
+        menu.set_relations([m for m in ret_val if m.get('recipes', None) is not None], "recipes")
+    except TypeError:
+        return jsonify(
+            {"error": "Invalid data. The recipes attribute must be a list of numeric recipe ids"}), 400
 
-    return jsonify({"menus": ret_val})
+    return json_response({"menus": serialize(Menu, ret_val)})
 
 
 @app.route("/menu/all/", methods=["GET"])
-@nocache
+@cached("menu", "serves", "recipes")
+@max_queries(6)
 def get_all_menus():
     """
-    Get all menu items in the database
+    Get all menu items in the database. Accepts the `limit` and `after` query
+    parameters to fetch the menus a page at a time, ordered by date
     :return: A JSON format in the form of
     {"menus": [<list of JSON objects representing a menu record that also contains a list of recipe objects for that menu record>]}
     """
-    cursor = g.db.cursor()
-    menus = Menu().all()
-
-    for menu in menus:
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.recipes\n"
-            "WHERE rec_id IN (SELECT recipe_id\n"
-            "                 FROM mongoose.serves\n"
-            "                 WHERE menu_id = %s)",
-            (menu['id'],))
-        menu['recipes'] = cursor.fetchall()
-    cursor.close()
+    limit, after = page_args()
+    if app.config['STREAM_RESPONSES'] and limit is None:
+        return stream_json("menus", Menu().iterate(relation="recipes"), Menu)
+    menu = Menu()
+    menus = menu.all(limit=limit, after=after)
+    menu.load_relations(menus, "recipes")
+
+    return json_response(paged({"menus": serialize(Menu, menus)}, menu, limit))
 
-    return jsonify({"menus": menus})
+
+@app.route("/menu/many/", methods=["GET"])
+@cached("menu", "serves", "recipes")
+@max_queries(6)
+def get_many_menus():
+    """
+    Get many menu records by their ids, given as the `ids` query parameter (e.g.
+    ?ids=3,1,2). The menus are read with one query, and their recipes with another
+    :return: A JSON format in the form of {"menus": [<list of JSON objects representing the menu
+    records found and their recipes, in the order of the ids>], "missing": [<the ids not found>]}
+    """
+    ids = id_args()
+    if ids is None:
+        return jsonify({"error": "ids must be a comma separated list of at most {} ids".format(MAX_IDS)}), 400
+
+    menu = Menu()
+    menus, missing = in_order(ids, menu.find_by_ids(ids))
+    menu.load_relations(menus, "recipes")
+    return json_response({"menus": serialize(Menu, menus), "missing": missing})
 
 
 @app.route("/menu/<int:id>/", methods=["GET"])
-@nocache
+@cached("menu", "serves", "recipes")
+@max_queries(6)
 def get_menu_by_id(id):
     """
     Get a menu record by its id
@@ -507,7 +606,7 @@ def get_menu_by_id(id):
 
     menu_data['recipes'] = menu.recipes
 
-    return jsonify(menu_data)
+    return json_response(serialize(Menu, menu_data))
 
 
 @app.route("/menu/<int:id>/del/", methods=["DELETE"])
@@ -524,42 +623,39 @@ def delete_menu(id):
     res = cursor.execute("DELETE FROM {table} WHERE {column}=%s".format(table=Menu.__table__,
                                                                         column=id_column), (id,))
     cursor.close()
-    g.db.commit()
+    if res:
+        # Only the deleted menu's row leaves the menu table, so the calendar index drops just that one
+        mark_keys_changed(Menu.__table__, [id])
+        mark_changed(*cascaded(Menu.__table__)[1:])
 
     return jsonify({"success": res != 0})
 
 
 @app.route("/menu/<string:time_of_day>/", methods=["GET"])
-@nocache
+@cached("menu", "serves", "recipes")
+@max_queries(6)
 def get_menus_by_time_of_day(time_of_day):
     """
-    Get all menus for a time of day
+    Get all menus for a time of day. Accepts the `limit` and `after` query
+    parameters to fetch the menus a page at a time, ordered by date
     :param time_of_day: A lowercase string of one of the following: ('breakfast', 'lunch', 'dinner')
     :return: A JSON format in the form of
     {"menus": [<list of JSON objects representing a menu record that also contains a list of recipe objects for that menu record>]}
     """
-    menus = Menu().find_by_attribute("time_of_day", time_of_day, limit=-1)
-    if not menus:
+    limit, after = page_args()
+    menu = Menu()
+    menus = menu.all(comparisons={"time_of_day": ["=", time_of_day]}, limit=limit, after=after)
+    if not menus and after is None:
         return jsonify({"error": "No menus with the time of day {} found".format(time_of_day)}), 404
 
-    cursor = g.db.cursor()
-    for menu in menus:
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.recipes\n"
-            "WHERE rec_id IN (SELECT recipe_id\n"
-            "                 FROM mongoose.serves\n"
-            "                 WHERE menu_id = %s)",
-            (menu['id'],))
-        menu['recipes'] = cursor.fetchall()
+    menu.load_relations(menus, "recipes")
 
-    cursor.close()
-
-    return jsonify({"menus": menus})
+    return json_response(paged({"menus": serialize(Menu, menus)}, menu, limit))
 
 
 @app.route("/menu/<string:time_of_day>/<date:date>/", methods=["GET"])
-@nocache
+@cached("menu")
+@max_queries(4)
 def get_menu_by_time_of_day_and_date(time_of_day, date):
     """
     Get a menu given its time of day and date
@@ -574,19 +670,20 @@ def get_menu_by_time_of_day_and_date(time_of_day, date):
     if time_of_day not in Menu.__columns__['time_of_day']:
         return jsonify({"error": "Time of day must be one of {}".format(Menu.__columns__['time_of_day'])}), 400
 
-    menu = Menu().find_by_attribute("date", date, limit=-1)
-    menu = filter(lambda x: x['time_of_day'] == time_of_day, menu)
+    menu = at(Menu(), date, time_of_day)
     if not menu:
         return jsonify({"error": "No menu found for the time of day {} at date {}".format(time_of_day, date)}), 404
 
-    return jsonify({"menu": menu})
+    return json_response({"menu": serialize(Menu, menu)})
 
 
 @app.route("/menu/date/<date:date>/", methods=["GET"])
-@nocache
+@cached("menu", "serves", "recipes")
+@max_queries(6)
 def get_menu_by_date(date):
     """
-    Get menus on a specific date
+    Get menus on a specific date. Accepts the `limit` and `after` query
+    parameters to fetch the menus a page at a time
     :param date: A date string in the format YYYY-MM-DD
     :return: A JSON format in the form of
     {"menus": [<list of JSON objects representing a menu record that also contains a list of recipe objects for that menu record>]}
@@ -594,30 +691,24 @@ def get_menu_by_date(date):
     if not check_date(date):
         return jsonify({"error": "Dates must be in YYYY-MM-DD format"}), 400
 
-    menus = Menu().find_by_attribute("date", date, limit=-1)
-    if not menus:
+    limit, after = page_args()
+    menu = Menu()
+    menus = between(menu, date, date, limit, after)
+    if not menus and after is None:
         return jsonify({"error": "No menus for the date {}".format(date)}), 404
 
-    cursor = g.db.cursor()
-    for menu in menus:
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.recipes\n"
-            "WHERE rec_id IN (SELECT recipe_id\n"
-            "                 FROM mongoose.serves\n"
-            "                 WHERE menu_id = %s)",
-            (menu['id'],))
-        menu['recipes'] = cursor.fetchall()
-    cursor.close()
+    menu.load_relations(menus, "recipes")
 
-    return jsonify({"menus": menus})
+    return json_response(paged({"menus": serialize(Menu, menus)}, menu, limit))
 
 
 @app.route("/menu/date/between/<date:begin>/<date:end>/", methods=["GET"])
-@nocache
+@cached("menu", "serves", "recipes")
+@max_queries(6)
 def get_menu_in_date_range(begin, end):
     """
-    Get menus in-between two dates (inclusive)
+    Get menus in-between two dates (inclusive). Accepts the `limit` and `after`
+    query parameters to fetch the menus a page at a time, ordered by date
     :param begin: A string in the format of YYYY-MM-DD specifying the start day (inclusive)
     :param end: A string in the format of YYYY-MM-DD specifying the end day (inclusive)
     :return: A JSON format in the form of
@@ -626,20 +717,112 @@ def get_menu_in_date_range(begin, end):
     if not check_date(begin) or not check_date(end):
         return jsonify({"error": "Dates must be in YYYY-MM-DD format"}), 400
 
-    menus = Menu().all(comparisons={"date": ["BETWEEN", [begin, end]]})
-    if not menus:
+    limit, after = page_args()
+    menu = Menu()
+    menus = between(menu, begin, end, limit, after)
+    if not menus and after is None:
         return jsonify({"error": "No menus between dates {} and {} found".format(begin, end)}), 404
 
-    cursor = g.db.cursor()
-    for menu in menus:
-        cursor.execute(
-            "SELECT *\n"
-            "FROM mongoose.recipes\n"
-            "WHERE rec_id IN (SELECT recipe_id\n"
-            "                 FROM mongoose.serves\n"
-            "                 WHERE menu_id = %s)",
-            (menu['id'],))
-        menu['recipes'] = cursor.fetchall()
-    cursor.close()
+    menu.load_relations(menus, "recipes")
+
+    return json_response(paged({"menus": serialize(Menu, menus)}, menu, limit))
+
+
+@app.route("/menu/date/between/<date:begin>/<date:end>/nutrition/", methods=["GET"])
+@cached("menu", "serves", "ingredients", "food", "nutritional_fact")
+@max_queries(4)
+def get_nutrition_in_date_range(begin, end):
+    """
+    Get the nutrition totals of the menus in-between two dates (inclusive): the
+    calories, fat, sugar, protein and sodium of the food of every recipe served,
+    per day, time of day and food group, and per week
+    :param begin: A string in the format of YYYY-MM-DD specifying the start day (inclusive)
+    :param end: A string in the format of YYYY-MM-DD specifying the end day (inclusive)
+    :return: A JSON format in the form of
+    {"nutrition": {"totals": {"calories": 1200.5, "fat": ..., "sugar": ..., "protein": ..., "sodium": ...},
+    "days": [{"date": "2016-01-01", "totals": {...}, "time_of_day": {"breakfast": {...}, ...},
+    "food_group": {"grain": {...}, ...}}, ...], "weeks": [{"week_of": <the Monday>, "totals": {...},
+    "food_group": {...}}, ...]}}
+    """
+    if not check_date(begin) or not check_date(end):
+        return jsonify({"error": "Dates must be in YYYY-MM-DD format"}), 400
+
+    rows = Menu().nutrition_between(begin, end, NUTRIENTS)
+    if not rows:
+        return jsonify({"error": "No menus between dates {} and {} found".format(begin, end)}), 404
+
+    return json_response({"nutrition": report(rows)})
+
+
+#################
+# SEARCH ROUTES #
+#################
+@app.route("/search/", methods=["GET"])
+@cached("food", "recipes")
+@max_queries(5)
+def search_names():
+    """
+    Type-ahead search of food and recipe names. Takes the text typed so far as the
+    `q` query parameter, and the most matches to return per table as `limit` (10 by
+    default, at most 100). Names starting with the text come first, then names the
+    text may be a misspelling of, most similar first.
+    :return: A JSON object of {"food": [{"food_id": 1, "food_name": "Rice", "score": 1.0}, ...],
+    "recipes": [{"rec_id": 1, "rec_name": "Chicken and Rice", "score": 0.75}, ...]}
+    """
+    query = request.args.get('q', '')
+    if not query.strip():
+        return jsonify({"error": "No search text supplied"}), 400
+    limit, _ = page_args()
+    if limit is None:
+        limit = 10
+    if limit < 1:
+        raise InvalidPage("Page size must be a positive number")
+    limit = min(limit, MAX_RESULTS)
+    ret = dict()
+    for name, entity, column in (("food", Food, "food_name"), ("recipes", Recipe, "rec_name")):
+        key = entity.__keys__[0]
+        ret[name] = [{key: id, column: value, "score": score}
+                     for id, value, score in search(entity, column, query, limit)]
+    return json_response(ret)
+
 
-    return jsonify({"menus": menus})
+################
+# CACHE ROUTES #
+################
+@app.route("/cache/stats/", methods=["GET"])
+@nocache
+def cache_stats():
+    """
+    Get the hit/miss counters and size of this worker's entity cache, statement cache and in-memory indexes
+    :return: A JSON object of {"entity_cache": <counters, or null if the cache is turned off>,
+    "statements": <counters>, "fridge": <counters, or null if the index is turned off>,
+    "cookable": <counters, or null if the index is turned off>,
+    "calendar": <counters, or null if the index is turned off>,
+    "search": <counters of each table's name index, or null if they are turned off>}
+    """
+    cache = entity_cache()
+    index = fridge_index()
+    recipes = cookable_index()
+    names = search_indexes()
+    menus = calendar_index()
+    return jsonify({"entity_cache": cache.stats() if cache is not None else None, "statements": statements.stats(),
+                    "fridge": index.stats() if index is not None else None,
+                    "cookable": recipes.stats() if recipes is not None else None,
+                    "calendar": menus.stats() if menus is not None else None,
+                    "search": dict((table, i.stats()) for table, i in names.items()) if names is not None else None})
+
+
+##################
+# METRICS ROUTES #
+##################
+@app.route("/metrics", methods=["GET"])
+@nocache
+def metrics():
+    """
+    Get the request, connection pool and entity cache metrics of every worker
+    :return: The metrics in the Prometheus text format, or a 404 if metrics are turned off
+    """
+    collected = request_metrics()
+    if collected is None:
+        abort(404)
+    return Response(collected.render(), content_type="text/plain; version=0.0.4; charset=utf-8")